@@ -5,70 +5,312 @@ Scaffold TypeScript templates for Doubao/ARK (Responses API).
 Copies this skill's `assets/typescript/` into a target directory, without
 overwriting existing files unless `--force` is provided.
 
+With `--sync`, only added or changed templates are written: each file is
+compared by size, mtime and SHA-256 against a manifest kept in the target,
+and identical files are left untouched (mtime included) so incremental
+builds stay warm. Files edited locally since the last sync are reported as
+conflicts unless `--force` is provided.
+
+Several `--out` directories can be populated in one run; targets are handled
+concurrently (`--jobs`). Files are cloned with a reflink (FICLONE) or
+`copy_file_range` where the filesystem supports it, falling back to a plain
+copy; `--hardlink` links targets to the templates instead.
+
 Usage:
   python scaffold_typescript_client.py --out <dir>
   python scaffold_typescript_client.py --out <dir> --target doubao-ark --force
+  python scaffold_typescript_client.py --out <dir> --sync
+  python scaffold_typescript_client.py --out packages/* --sync --jobs 8
 """
 
 from __future__ import annotations
 
 import argparse
+import hashlib
+import json
+import os
 import shutil
 import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX
+    fcntl = None
+
+MANIFEST_NAME = ".scaffold-manifest.json"
+MANIFEST_VERSION = 1
+# ioctl FICLONE from <linux/fs.h>
+_FICLONE = 0x40049409
+
+_print_lock = threading.Lock()
+
+
+def _log(message: str) -> None:
+    # Targets run concurrently; keep each message on its own lines.
+    with _print_lock:
+        print(message, flush=True)
+
 
-def copy_tree(src_dir: Path, dst_dir: Path, *, force: bool) -> None:
+def _list_files(src_dir: Path) -> list[Path]:
     if not src_dir.exists() or not src_dir.is_dir():
         raise FileNotFoundError(f"Source directory not found: {src_dir}")
+    return sorted(p.relative_to(src_dir) for p in src_dir.rglob("*") if p.is_file())
+
+
+def _report_conflicts(conflicts: list[Path], hint: str) -> None:
+    lines = [f"[ERROR] {hint} Re-run with --force to overwrite:"]
+    lines.extend(f"  - {p}" for p in conflicts[:20])
+    if len(conflicts) > 20:
+        lines.append(f"  ... and {len(conflicts) - 20} more")
+    _log("\n".join(lines))
+    raise SystemExit(1)
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            return False
+    return True
+
+
+def _copy_file_range(src: Path, dst: Path) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if n == 0:
+                    break
+                remaining -= n
+        except OSError:
+            return False
+    return remaining <= 0
+
+
+def _place_file(src: Path, dst: Path, *, hardlink: bool) -> str:
+    """Write src to dst via a temp file + rename; returns the method used."""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f".{dst.name}.scaffold-tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        method = ""
+        if hardlink:
+            try:
+                os.link(src, tmp)
+                method = "hardlink"
+            except OSError:
+                pass  # e.g. cross-device; fall back to a copy
+        if not method:
+            if _reflink(src, tmp):
+                method = "reflink"
+            elif _copy_file_range(src, tmp):
+                method = "copy_file_range"
+            else:
+                shutil.copyfile(src, tmp)
+                method = "copy"
+            shutil.copystat(src, tmp)
+        # Replacing (rather than writing into) dst never modifies a hardlinked template.
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return method
+
+
+def _load_manifest(dst_dir: Path) -> dict[str, dict]:
+    try:
+        data = json.loads((dst_dir / MANIFEST_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != MANIFEST_VERSION:
+        return {}
+    files = data.get("files")
+    return files if isinstance(files, dict) else {}
+
+
+def _write_manifest(dst_dir: Path, files: dict[str, dict]) -> None:
+    path = dst_dir / MANIFEST_NAME
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(
+        json.dumps({"version": MANIFEST_VERSION, "files": files}, indent=2, sort_keys=True) + "\n",
+        encoding="utf-8",
+    )
+    os.replace(tmp, path)
+
+
+def _dst_digest(dst_path: Path, entry: dict | None) -> str:
+    """Hash of the target file, reusing the manifest when size and mtime still match."""
+    st = dst_path.stat()
+    if entry and entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns:
+        return entry["sha256"]
+    return _sha256(dst_path)
+
+
+def _manifest_entry(dst_path: Path, digest: str) -> dict:
+    st = dst_path.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+
 
+def copy_tree(
+    src_dir: Path,
+    dst_dir: Path,
+    *,
+    force: bool,
+    files: list[Path] | None = None,
+    hardlink: bool = False,
+) -> Counter:
+    files = _list_files(src_dir) if files is None else files
+
+    conflicts = [dst_dir / rel for rel in files if (dst_dir / rel).exists()]
+    if conflicts and not force:
+        _report_conflicts(conflicts, "Target has existing files.")
+
+    methods: Counter = Counter()
+    for rel in files:
+        dst_path = dst_dir / rel
+        methods[_place_file(src_dir / rel, dst_path, hardlink=hardlink)] += 1
+        _log(f"[OK] {dst_path}")
+    return methods
+
+
+def sync_tree(
+    src_dir: Path,
+    dst_dir: Path,
+    *,
+    force: bool,
+    files: list[Path] | None = None,
+    src_digests: dict[Path, str] | None = None,
+    hardlink: bool = False,
+) -> Counter:
+    files = _list_files(src_dir) if files is None else files
+    if src_digests is None:
+        src_digests = {rel: _sha256(src_dir / rel) for rel in files}
+    manifest = _load_manifest(dst_dir)
+
+    # rel -> (source digest, state); state is added / changed / unchanged
+    plan: dict[Path, tuple[str, str]] = {}
     conflicts: list[Path] = []
-    for src_path in src_dir.rglob("*"):
-        if not src_path.is_file():
-            continue
-        rel = src_path.relative_to(src_dir)
+    for rel in files:
+        key = rel.as_posix()
+        src_digest = src_digests[rel]
         dst_path = dst_dir / rel
-        if dst_path.exists() and not force:
+        if not dst_path.exists():
+            plan[rel] = (src_digest, "added")
+            continue
+        entry = manifest.get(key)
+        dst_digest = _dst_digest(dst_path, entry)
+        if dst_digest == src_digest:
+            plan[rel] = (src_digest, "unchanged")
+            continue
+        # Only overwrite what this script wrote last time; local edits need --force.
+        if not force and (entry is None or entry.get("sha256") != dst_digest):
             conflicts.append(dst_path)
+        plan[rel] = (src_digest, "changed")
 
-    if conflicts and not force:
-        print("[ERROR] Target has existing files. Re-run with --force to overwrite:")
-        for p in conflicts[:20]:
-            print(f"  - {p}")
-        if len(conflicts) > 20:
-            print(f"  ... and {len(conflicts) - 20} more")
-        raise SystemExit(1)
-
-    for src_path in src_dir.rglob("*"):
-        if not src_path.is_file():
-            continue
-        rel = src_path.relative_to(src_dir)
+    if conflicts:
+        _report_conflicts(conflicts, "Target files were modified since the last sync.")
+
+    counts = {"added": 0, "changed": 0, "unchanged": 0}
+    methods: Counter = Counter()
+    new_manifest: dict[str, dict] = {}
+    for rel, (digest, state) in plan.items():
         dst_path = dst_dir / rel
-        dst_path.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(src_path, dst_path)
-        print(f"[OK] {dst_path}")
+        if state != "unchanged":
+            methods[_place_file(src_dir / rel, dst_path, hardlink=hardlink)] += 1
+            _log(f"[{state.upper()}] {dst_path}")
+        counts[state] += 1
+        new_manifest[rel.as_posix()] = _manifest_entry(dst_path, digest)
+
+    if new_manifest != manifest:
+        _write_manifest(dst_dir, new_manifest)
+    _log(f"[OK] {dst_dir}: added={counts['added']} changed={counts['changed']} unchanged={counts['unchanged']}")
+    return methods
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(description="Scaffold Doubao/ARK TypeScript templates.")
-    parser.add_argument("--out", required=True, help="Output directory to write templates into.")
+    parser.add_argument(
+        "--out",
+        required=True,
+        nargs="+",
+        action="extend",
+        help="Output directory to write templates into (repeatable; several may follow one --out).",
+    )
     parser.add_argument(
         "--target",
         default="doubao-ark",
         help="Subdirectory name under --out (default: doubao-ark).",
     )
     parser.add_argument("--force", action="store_true", help="Overwrite existing files.")
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help=f"Copy only added/changed files, tracked via {MANIFEST_NAME} in the target.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=0,
+        help="Targets processed concurrently (default: auto).",
+    )
+    parser.add_argument(
+        "--hardlink",
+        action="store_true",
+        help="Hardlink files to the templates instead of copying (same filesystem only). "
+        "Linked files share content with assets/typescript, so do not edit them in place.",
+    )
     args = parser.parse_args()
 
     skill_root = Path(__file__).resolve().parents[1]
     src_dir = skill_root / "assets" / "typescript"
-    dst_dir = Path(args.out).expanduser().resolve() / args.target
+    dst_dirs = list(dict.fromkeys(Path(out).expanduser().resolve() / args.target for out in args.out))
+
+    # Walk (and hash) the templates once, shared by every target.
+    files = _list_files(src_dir)
+    src_digests = {rel: _sha256(src_dir / rel) for rel in files} if args.sync else None
 
-    dst_dir.mkdir(parents=True, exist_ok=True)
-    copy_tree(src_dir, dst_dir, force=args.force)
-    return 0
+    def run(dst_dir: Path) -> Counter | None:
+        try:
+            dst_dir.mkdir(parents=True, exist_ok=True)
+            if args.sync:
+                return sync_tree(
+                    src_dir, dst_dir, force=args.force, files=files, src_digests=src_digests, hardlink=args.hardlink
+                )
+            return copy_tree(src_dir, dst_dir, force=args.force, files=files, hardlink=args.hardlink)
+        except SystemExit:
+            return None
+        except OSError as e:
+            _log(f"[ERROR] {dst_dir}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=args.jobs or None) as pool:
+        results = list(pool.map(run, dst_dirs))
+
+    if len(dst_dirs) > 1:
+        methods: Counter = sum((r for r in results if r is not None), Counter())
+        written = " ".join(f"{k}={v}" for k, v in sorted(methods.items())) or "none"
+        failed = sum(r is None for r in results)
+        print(f"[DONE] {len(dst_dirs)} targets, {failed} failed; files written: {written}")
+    return 1 if any(r is None for r in results) else 0
 
 
 if __name__ == "__main__":
     sys.exit(main())
-
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+DMXAPI 图片脚本热点函数的微基准与回归检查。
+
+用途：
+  - 用合成的 1K/2K/4K 图片负载测量每张图片都会经过的辅助函数：
+      gemini：_encode_image_part / _iter_parts / _extract_inline_blob /
+              _extract_data_url_blob / _save_image_bytes
+      openai：_encode_multipart / _guess_image_mime_by_bytes / _save_image_bytes
+  - 传输用例（transfer.*）：本机 HTTP 桩返回 base64 图片 JSON，经 _http_post_bytes 完整走一遍
+    请求、按 Content-Encoding 解压与 JSON 解析，分别测原样与 gzip（--compressed）两种响应；
+    额外报告线上字节数，并按 --bandwidth-mbps 估算真实链路上的单次耗时
+  - 编解码用例（codec.stdlib.* / codec.orjson.*）：同一份负载分别用标准库 json 与 orjson
+    （已安装时）序列化 Gemini 四图融合请求、解析 Gemini 图片响应与 OpenAI 编辑响应（b64_json）
+  - 报告 ops/s（多轮计时的中位数）、吞吐（MB/s）与单次调用的峰值内存分配（tracemalloc）
+  - --save-baseline 保存基线；--baseline 与基线对比，吞吐下降、峰值分配或线上字节数上升超过
+    --threshold 且重新测量后依然超出时退出码为 1，便于在 CI 中拦截性能回归
+  - 每轮计时把同一用例连续调用 N 次（N 使一轮至少持续 _MIN_ROUND_S），计时器分辨率被摊薄；
+    每轮之后紧接着计时一段固定的参考循环，ops/s 下降超过阈值时还要求“相对参考循环的吞吐”也下降
+    超过阈值才判定回归，以排除虚拟机/降频等整机速度漂移，因此亚微秒级用例也参与判定；
+    落盘类用例每次写完即删除，测到的是写入本身而不是目录膨胀
+
+注意：
+  - 基线只在同一台机器、同一 Python 版本之间可比。
+  - 合成图片为随机字节（与真实 PNG 一样几乎不可压缩），体积按典型 PNG 估算。
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import gc
+import gzip
+import http.server
+import importlib.util
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import dmxapi_common as common
+import dmxapi_gemini_image as gemini
+
+try:  # 可选依赖：未安装 orjson 时只测标准库编解码
+    import orjson as _orjson
+except ImportError:  # pragma: no cover
+    _orjson = None
+
+# 合成负载体积：按对应分辨率 PNG 的典型大小估算
+_PAYLOAD_SIZES = {"1K": 1_400_000, "2K": 5_500_000, "4K": 20_000_000}
+# 峰值分配的比较容差下限：过小的分配量受解释器内部缓存影响，不参与判定
+_PEAK_SLACK_BYTES = 64 * 1024
+# 每轮计时至少持续的秒数（不足时加大每轮的调用次数），轮数由 --repeat 决定
+_MIN_ROUND_S = 0.2
+# 每轮用例计时后参考循环的计时时长
+_REFERENCE_ROUND_S = 0.1
+# 参考循环遍历的固定文档：与解析响应同类的纯解释器工作，不依赖被测脚本，基线之间保持不变
+_REFERENCE_DOC = {"candidates": [{"content": {"parts": [{"text": "a"}, {"inlineData": {"mimeType": "image/png", "data": "x"}}]}}]}
+# 传输用例中桩服务返回 gzip 响应时的压缩级别（与常见网关默认值一致）
+_GZIP_LEVEL = 6
+
+
+class _Case(NamedTuple):
+    name: str
+    fn: Callable[[], Any]
+    # 传输用例：返回最近一次响应的线上字节数
+    wire_bytes: Optional[Callable[[], int]] = None
+
+
+class _StubServer:
+    """本机 HTTP 桩：对任意 POST 返回同一份 JSON，请求带 Accept-Encoding: gzip 时返回 gzip 压缩体。"""
+
+    def __init__(self) -> None:
+        self.body = b"{}"
+        self.gzipped = gzip.compress(self.body)
+        self.last_wire_bytes = 0
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self) -> None:
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                compressed = "gzip" in (self.headers.get("Accept-Encoding") or "")
+                data = stub.gzipped if compressed else stub.body
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                if compressed:
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                stub.last_wire_bytes = len(data)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/v1beta/models/bench:generateContent"
+
+    def serve(self, body: bytes) -> None:
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=_GZIP_LEVEL)
+
+    def wire_bytes(self) -> int:
+        return self.last_wire_bytes
+
+    def close(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def _default_openai_script() -> str:
+    here = Path(__file__).resolve().parent
+    return str(here.parent.parent / "openai-img-skill" / "scripts" / "dmxapi_openai_img.py")
+
+
+def _load_openai_module(path: str) -> Any:
+    if not os.path.isfile(path):
+        raise SystemExit(f"找不到 OpenAI 脚本：{path}（可用 --openai-script 指定）")
+    spec = importlib.util.spec_from_file_location("dmxapi_openai_img", path)
+    if spec is None or spec.loader is None:
+        raise SystemExit(f"无法加载 OpenAI 脚本：{path}")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _synthetic_png(size: int) -> bytes:
+    return b"\x89PNG\r\n\x1a\n" + os.urandom(size - 8)
+
+
+def _with_codec(codec: Any, fn: Callable[[], Any]) -> Callable[[], Any]:
+    """在调用期间把 dmxapi_common 的 JSON 实现切换为 codec（None 表示标准库）。"""
+
+    def run() -> Any:
+        saved = common._orjson
+        common._orjson = codec
+        try:
+            return fn()
+        finally:
+            common._orjson = saved
+
+    return run
+
+
+def _codec_cases(raw_path: str, response: Dict[str, Any], b64: str) -> List[_Case]:
+    parts: List[Any] = [{"text": "把四张图融合成一张海报"}] + [gemini._LazyImagePart(raw_path) for _ in range(4)]
+    fusion = gemini._materialize_payload(
+        {
+            "model": "gemini-3-pro-image-preview",
+            "contents": [{"parts": parts}],
+            "generationConfig": {"responseModalities": ["TEXT", "IMAGE"], "imageConfig": {"imageSize": "4K"}},
+        }
+    )
+    gemini_response = json.dumps(response).encode("utf-8")
+    openai_response = json.dumps({"created": 0, "data": [{"b64_json": b64}, {"b64_json": b64}]}).encode("utf-8")
+    codecs = [("stdlib", None)] + ([("orjson", _orjson)] if _orjson is not None else [])
+    cases = []
+    for label, codec in codecs:
+        cases += [
+            _Case(f"codec.{label}.dumps_gemini_fusion", _with_codec(codec, lambda: common._json_dumps_bytes(fusion))),
+            _Case(f"codec.{label}.loads_gemini_resp", _with_codec(codec, lambda: common._json_loads_bytes(gemini_response))),
+            _Case(f"codec.{label}.loads_openai_edit", _with_codec(codec, lambda: common._json_loads_bytes(openai_response))),
+        ]
+    return cases
+
+
+def _build_cases(openai_mod: Any, raw: bytes, workdir: str, stub: _StubServer) -> List[_Case]:
+    b64 = base64.b64encode(raw).decode("ascii")
+    path = os.path.join(workdir, "input.png")
+    with open(path, "wb") as f:
+        f.write(raw)
+    out_dir = os.path.join(workdir, "out")
+    part = {"inlineData": {"mimeType": "image/png", "data": b64}, "thoughtSignature": "sig"}
+    response = {"candidates": [{"content": {"role": "model", "parts": [{"text": "好的"}, part]}}]}
+    data_url = f"data:image/png;base64,{b64}"
+    fields = [("model", "gpt-image-1.5"), ("prompt", "bench")]
+    files = [("image", "input.png", "image/png", raw)]
+    stub.serve(json.dumps(response).encode("utf-8"))
+    return [
+        _Case("gemini._encode_image_part", lambda: gemini._encode_image_part(path)),
+        _Case("gemini._iter_parts", lambda: list(gemini._iter_parts(response))),
+        _Case("gemini._extract_inline_blob", lambda: gemini._extract_inline_blob(part)),
+        _Case("gemini._extract_data_url_blob", lambda: gemini._extract_data_url_blob(data_url)),
+        _Case(
+            "gemini._save_image_bytes",
+            lambda: os.unlink(gemini._save_image_bytes(out_dir=out_dir, prefix="gemini", mime_type="image/png", raw_bytes=raw, index=0)),
+        ),
+        _Case("openai._encode_multipart", lambda: openai_mod._encode_multipart(fields=fields, files=files, boundary="bench")),
+        _Case("openai._guess_image_mime_by_bytes", lambda: openai_mod._guess_image_mime_by_bytes(raw)),
+        _Case(
+            "openai._save_image_bytes",
+            lambda: os.unlink(openai_mod._save_image_bytes(out_dir=out_dir, prefix="openai", index=0, mime_type="image/png", raw=raw)),
+        ),
+        _Case("transfer.identity", lambda: gemini._http_post_bytes(stub.url, {}, b"{}", 60), stub.wire_bytes),
+        _Case(
+            "transfer.gzip",
+            lambda: gemini._http_post_bytes(stub.url, {"Accept-Encoding": "gzip, deflate"}, b"{}", 60),
+            stub.wire_bytes,
+        ),
+        *_codec_cases(path, response, b64),
+    ]
+
+
+def _reference_workload() -> int:
+    n = 0
+    for candidate in _REFERENCE_DOC["candidates"]:
+        for part in candidate["content"]["parts"]:
+            n += len(part)
+    return n
+
+
+def _calls_per_round(timer: timeit.Timer, round_s: float) -> int:
+    number, elapsed = timer.autorange()
+    # autorange 按 1/2/5×10^k 递增到一轮 ≥0.2s 即停，按比例补足到 round_s，
+    # 让每轮（而不是单次调用）都远长于计时器分辨率
+    return max(1, int(number * round_s / max(elapsed, 1e-9)) + 1)
+
+
+def _measure(fn: Callable[[], Any], *, repeat: int) -> Tuple[float, float, int]:
+    """返回 (各轮 ops/s 的中位数, 各轮相对参考循环吞吐之比的中位数, 单次调用峰值分配字节数)。"""
+    timer = timeit.Timer(fn)
+    reference = timeit.Timer(_reference_workload)
+    number = _calls_per_round(timer, _MIN_ROUND_S)
+    ref_number = _calls_per_round(reference, _REFERENCE_ROUND_S)
+    rounds, ratios = [], []
+    for _ in range(repeat):
+        elapsed = timer.timeit(number)
+        ref_elapsed = reference.timeit(ref_number)
+        rounds.append(elapsed)
+        ratios.append((number / elapsed) / (ref_number / ref_elapsed))
+    median = statistics.median(rounds)
+    relative = statistics.median(ratios)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return number / median, relative, peak
+
+
+def _compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> Optional[str]:
+    """超出阈值时返回回归描述。"""
+    problems = []
+    if current["ops_per_s"] < baseline["ops_per_s"] * (1 - threshold):
+        # 整机变慢时参考循环同样变慢：相对吞吐仍在阈值内则不算回归
+        if "vs_reference" not in current or "vs_reference" not in baseline:
+            problems.append(f"ops/s {baseline['ops_per_s']:.1f} -> {current['ops_per_s']:.1f}")
+        elif current["vs_reference"] < baseline["vs_reference"] * (1 - threshold):
+            problems.append(
+                f"ops/s {baseline['ops_per_s']:.1f} -> {current['ops_per_s']:.1f}，"
+                f"相对参考循环 {baseline['vs_reference']:.4g} -> {current['vs_reference']:.4g}"
+            )
+    if current["peak_bytes"] > baseline["peak_bytes"] * (1 + threshold) + _PEAK_SLACK_BYTES:
+        problems.append(f"峰值分配 {baseline['peak_bytes']} -> {current['peak_bytes']} 字节")
+    if "wire_bytes" in current and "wire_bytes" in baseline and current["wire_bytes"] > baseline["wire_bytes"] * (1 + threshold):
+        problems.append(f"线上字节 {baseline['wire_bytes']} -> {current['wire_bytes']}")
+    return "；".join(problems) or None
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="DMXAPI 图片脚本热点函数微基准（可与基线对比拦截回归）")
+    parser.add_argument("--sizes", default="1K,2K,4K", help="合成负载尺寸，逗号分隔（1K/2K/4K）")
+    parser.add_argument("--filter", default="", help="只运行名称匹配该正则的用例，如 multipart|data_url")
+    parser.add_argument("--repeat", type=int, default=7, help="每个用例重复计时的轮数（取中位数）")
+    parser.add_argument("--baseline", default="", help="与该基线 JSON 对比，回归超过阈值时退出码为 1")
+    parser.add_argument("--save-baseline", default="", help="把本次结果保存为基线 JSON")
+    parser.add_argument("--threshold", type=float, default=0.25, help="回归阈值：吞吐下降或峰值分配/线上字节上升超过该比例即判定回归")
+    parser.add_argument(
+        "--bandwidth-mbps", type=float, default=50.0, help="传输用例按该链路带宽（Mbit/s）估算单次耗时：本机实测耗时 + 线上字节传输时间"
+    )
+    parser.add_argument("--openai-script", default=_default_openai_script(), help="dmxapi_openai_img.py 路径")
+    return parser
+
+
+def main(argv: List[str]) -> int:
+    args = build_parser().parse_args(argv)
+    sizes = [s.strip().upper() for s in args.sizes.split(",") if s.strip()]
+    unknown = [s for s in sizes if s not in _PAYLOAD_SIZES]
+    if unknown:
+        raise SystemExit(f"未知尺寸：{', '.join(unknown)}（可选 {', '.join(_PAYLOAD_SIZES)}）")
+    pattern = re.compile(args.filter) if args.filter else None
+    openai_mod = _load_openai_module(args.openai_script)
+    if _orjson is None:
+        print("ℹ️ 未安装 orjson，编解码用例只测标准库（pip install orjson 后可对比）")
+
+    baseline: Dict[str, Any] = {}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+
+    results: Dict[str, Dict[str, Any]] = {}
+    regressions: List[str] = []
+    print(f"{'用例':<36} {'尺寸':>4} {'ops/s':>12} {'MB/s':>9} {'峰值分配':>11}  对比基线")
+    stub = _StubServer()
+    with tempfile.TemporaryDirectory(prefix="dmxapi-bench-") as workdir:
+        for size in sizes:
+            raw = _synthetic_png(_PAYLOAD_SIZES[size])
+            for name, fn, wire_bytes in _build_cases(openai_mod, raw, workdir, stub):
+                if pattern and not pattern.search(name):
+                    continue
+                ops, relative, peak = _measure(fn, repeat=args.repeat)
+                key = f"{name}@{size}"
+                results[key] = {"ops_per_s": round(ops, 3), "vs_reference": float(f"{relative:.6g}"), "peak_bytes": peak}
+                if wire_bytes is not None:
+                    results[key]["wire_bytes"] = wire_bytes()
+                note = ""
+                if key in baseline:
+                    base = baseline[key]
+                    problem = _compare(results[key], base, args.threshold)
+                    if problem:
+                        # 单次超出可能是机器瞬时抖动：重新测量，两次都超出才算回归
+                        retry_ops, retry_relative, retry_peak = _measure(fn, repeat=args.repeat)
+                        ops, relative = max(ops, retry_ops), max(relative, retry_relative)
+                        results[key].update(ops_per_s=round(ops, 3), vs_reference=float(f"{relative:.6g}"))
+                        peak = results[key]["peak_bytes"] = min(peak, retry_peak)
+                        problem = _compare(results[key], base, args.threshold)
+                    note = f"{(ops / base['ops_per_s'] - 1) * 100:+.0f}%"
+                    if "vs_reference" in base:
+                        note += f"（相对 {(relative / base['vs_reference'] - 1) * 100:+.0f}%）"
+                    if problem:
+                        regressions.append(f"{key}：{problem}")
+                        note += " ❌"
+                print(f"{name:<36} {size:>4} {ops:>12.1f} {ops * len(raw) / 1e6:>9.0f} {peak / 1e6:>9.2f}MB  {note}")
+                if wire_bytes is not None:
+                    wire = results[key]["wire_bytes"]
+                    link_s = 1 / ops + wire * 8 / (args.bandwidth_mbps * 1e6) if args.bandwidth_mbps > 0 else 1 / ops
+                    print(f"{'':<36} {'':>4}   线上 {wire / 1e6:.2f}MB，按 {args.bandwidth_mbps:g} Mbit/s 估算单次耗时 {link_s * 1000:.0f}ms")
+            del raw
+    stub.close()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(
+                {"python": platform.python_version(), "machine": platform.machine(), "results": results},
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+        print(f"💾 已保存基线：{args.save_baseline}")
+
+    if regressions:
+        print(f"❌ {len(regressions)} 个用例超过回归阈值 {args.threshold:.0%}：")
+        for line in regressions:
+            print(f"  - {line}")
+        return 1
+    if baseline:
+        print(f"✅ 未发现超过 {args.threshold:.0%} 的回归")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
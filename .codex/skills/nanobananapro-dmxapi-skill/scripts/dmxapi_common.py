@@ -0,0 +1,1976 @@
+#!/usr/bin/env python3
+"""
+DMXAPI 图片脚本的公共基础设施（仅标准库），供 dmxapi_gemini_image.py 与 dmxapi_openai_img.py 共用。
+
+nanobananapro 与 openai-img 两个 skill 的 scripts/ 下各有一份内容相同的副本，
+每个 skill 都能单独分发；修改时两份同步改（单元测试会校验二者一致）。
+
+包含：
+  - JSON 编解码（可选 orjson）、连接预热、gzip/deflate 响应解压、HTTP 状态错误
+  - 录制/回放（--cassette）、NDJSON 事件流（--output ndjson）、Prometheus 指标与 --metrics-file
+  - 跨进程限流（RPM + 并发）、API Key 池、多线路熔断
+  - 批量模式：AIMD 并发、相同请求合并（single-flight）、SJF 调度、内存预算、journal、参数网格
+
+各脚本只保留与上游接口相关的部分（请求体构造、响应解析、命令行参数），
+通过 run_job / build_job_args / request_fingerprint 等回调接入这里的批量与重试逻辑。
+"""
+
+from __future__ import annotations
+
+import argparse
+import atexit
+import base64
+import collections
+import contextlib
+import csv
+import datetime as _dt
+import hashlib
+import heapq
+import http.client
+import http.server
+import io
+import itertools
+import json
+import os
+import re
+import shutil
+import ssl
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import urllib.response
+import uuid
+import zlib
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Callable, ContextManager, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows 下改用 msvcrt
+    fcntl = None  # type: ignore[assignment]
+
+try:  # 可选依赖：有 orjson 时用它编解码请求/响应 JSON（bytes 直进直出，大 base64 负载明显更快）
+    import orjson as _orjson
+except ImportError:  # pragma: no cover - 未安装时退化为标准库 json
+    _orjson = None
+
+if os.environ.get("DMXAPI_JSON_CODEC") == "stdlib":  # 对比/排查用：强制使用标准库
+    _orjson = None
+
+
+# 常见图片扩展名 -> MIME
+_IMAGE_MIME_BY_EXT = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+}
+# --fit-inputs 逐级尝试的最长边；None 表示保持原尺寸仅重新编码
+_FIT_MAX_SIDES: Tuple[Optional[int], ...] = (None, 4096, 3072, 2048, 1536, 1024, 768, 512)
+
+
+def _mask_secret(value: str, keep: int = 6) -> str:
+    if not value:
+        return ""
+    if len(value) <= keep:
+        return "*" * len(value)
+    return value[:keep] + "*" * (len(value) - keep)
+
+
+def _image_mime_type(path: str) -> Optional[str]:
+    """按扩展名判断图片 MIME；不是常见图片格式时返回 None。"""
+    return _IMAGE_MIME_BY_EXT.get(os.path.splitext(path)[1].lower())
+
+
+def _json_dumps_bytes(obj: Any) -> bytes:
+    """请求体序列化：紧凑分隔符，非 ASCII 原样输出为 UTF-8；两种实现输出一致。"""
+    if _orjson is not None:
+        return _orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _json_loads_bytes(raw: Any) -> Any:
+    """响应解析：直接接受 bytes（或 str），不经过中间的 decode。"""
+    if _orjson is not None:
+        return _orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _default_cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "dmxapi-image")
+
+
+# 批量模式下记录当前线程（即当前 job）落盘的文件，供合并请求的其他 job 复用
+_output_sink = threading.local()
+
+
+@contextlib.contextmanager
+def _collect_outputs() -> Iterator[List[str]]:
+    """可嵌套：内外层收集器都会收到本线程落盘的文件。"""
+    paths: List[str] = []
+    stack = getattr(_output_sink, "stack", None)
+    if stack is None:
+        stack = _output_sink.stack = []
+    stack.append(paths)
+    try:
+        yield paths
+    finally:
+        stack.remove(paths)
+
+
+def _note_output(path: str) -> str:
+    for paths in getattr(_output_sink, "stack", None) or ():
+        paths.append(path)
+    return path
+
+
+def _share_output(src: str, *, src_prefix: str, out_dir: str, prefix: str, mode: str) -> str:
+    """把另一个 job 的输出按本 job 的 out_dir/prefix 硬链接（跨设备时退化为复制）或复制一份。"""
+    name = os.path.basename(src)
+    name = prefix + name[len(src_prefix) :] if name.startswith(src_prefix) else f"{prefix}_{name}"
+    dst = os.path.join(out_dir, name)
+    if os.path.abspath(dst) == os.path.abspath(src):
+        return dst
+    os.makedirs(out_dir, exist_ok=True)
+    if mode == "link":
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return dst
+
+
+# --output ndjson：生命周期事件逐行写到原 stdout，人读的输出改走 stderr
+_event_stream: Optional[Any] = None
+
+
+_event_lock = threading.Lock()
+
+
+# 批量模式下当前线程正在执行的 job id，自动附加到事件上
+_event_job = threading.local()
+
+
+def _start_event_stream() -> None:
+    global _event_stream
+    _event_stream = sys.stdout
+    sys.stdout = sys.stderr
+
+
+def _emit_event(event: str, **fields: Any) -> None:
+    """输出一行事件 {"event", "ts", "job", ...}；未开启 --output ndjson 时什么也不做。"""
+    if _event_stream is None:
+        return
+    row: Dict[str, Any] = {"event": event, "ts": round(time.time(), 3)}
+    job_id = getattr(_event_job, "id", None)
+    if job_id is not None:
+        row["job"] = job_id
+    row.update(fields)
+    line = json.dumps(row, ensure_ascii=False, default=str) + "\n"
+    with _event_lock:
+        _event_stream.write(line)
+        _event_stream.flush()
+
+
+def _emit_image_saved(path: str, mime_type: str, raw: Optional[bytes] = None, **extra: Any) -> None:
+    if _event_stream is None:
+        return
+    if raw is None:
+        with open(path, "rb") as f:
+            raw = f.read()
+    _emit_event(
+        "image_saved",
+        path=os.path.abspath(path),
+        size=len(raw),
+        mime=mime_type,
+        sha256=hashlib.sha256(raw).hexdigest(),
+        **extra,
+    )
+
+
+def _error_event_fields(exc: BaseException) -> Dict[str, Any]:
+    if isinstance(exc, SystemExit):
+        message = exc.code if isinstance(exc.code, str) else "参数解析失败"
+    else:
+        message = str(exc)
+    return {"class": type(exc).__name__, "status": getattr(exc, "status", None), "message": message[:300]}
+
+
+def _start_prewarm(url: str, timeout_s: int, executor: Executor) -> Optional[Future]:
+    """在后台提前完成 DNS + TCP/TLS 建连，与读盘/图片编码重叠；配置了代理时交给 urllib 自行处理。"""
+    if _cassette is not None:
+        return None  # 录制/回放时请求必须经过 urllib 全局 opener
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return None
+    proxies = urllib.request.getproxies()
+    if parts.scheme in proxies and not urllib.request.proxy_bypass(parts.hostname):
+        return None
+
+    def connect() -> http.client.HTTPConnection:
+        if parts.scheme == "https":
+            conn: http.client.HTTPConnection = http.client.HTTPSConnection(
+                parts.netloc, timeout=timeout_s, context=ssl.create_default_context()
+            )
+        else:
+            conn = http.client.HTTPConnection(parts.netloc, timeout=timeout_s)
+        conn.connect()
+        return conn
+
+    return executor.submit(connect)
+
+
+class _PrewarmedMixin:
+    """首个请求复用预建连接；预建失败时静默回退为普通建连。"""
+
+    _prewarmed: Optional[Future] = None
+
+    def _connection_factory(self, base_cls: Any) -> Any:
+        def factory(host: str, **kwargs: Any) -> http.client.HTTPConnection:
+            future, self._prewarmed = self._prewarmed, None
+            if future is not None:
+                try:
+                    conn = future.result()
+                except OSError:
+                    conn = None
+                if conn is not None and conn.host == urllib.parse.urlsplit(f"//{host}").hostname:
+                    return conn
+            return base_cls(host, **kwargs)
+
+        return factory
+
+
+class _PrewarmedHTTPHandler(_PrewarmedMixin, urllib.request.HTTPHandler):
+    def http_open(self, req: urllib.request.Request) -> Any:
+        return self.do_open(self._connection_factory(http.client.HTTPConnection), req)
+
+
+class _PrewarmedHTTPSHandler(_PrewarmedMixin, urllib.request.HTTPSHandler):
+    def https_open(self, req: urllib.request.Request) -> Any:
+        return self.do_open(self._connection_factory(http.client.HTTPSConnection), req, context=self._context)
+
+
+def _build_opener(prewarmed: Optional[Future]) -> Optional[urllib.request.OpenerDirector]:
+    if prewarmed is None:
+        return None
+    http_handler = _PrewarmedHTTPHandler()
+    https_handler = _PrewarmedHTTPSHandler()
+    http_handler._prewarmed = https_handler._prewarmed = prewarmed
+    return urllib.request.build_opener(http_handler, https_handler)
+
+
+class _HttpStatusError(RuntimeError):
+    """HTTP 非 2xx：保留状态码与 Retry-After，便于限流/重试逻辑判断；消息格式与原先一致。"""
+
+    def __init__(self, message: str, *, status: int, retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _http_status_error(e: urllib.error.HTTPError, url: str) -> _HttpStatusError:
+    raw = e.read()
+    # --compressed 时错误响应同样可能是 gzip/deflate，解压后再截取片段；解压失败则保留原始字节
+    encoding = ((e.headers or {}).get("Content-Encoding") or "").strip().lower()
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        try:
+            raw = _InflateReader(io.BytesIO(raw), "deflate" if encoding == "deflate" else "gzip").readall()
+        except zlib.error:
+            pass
+    retry_after: Optional[float] = None
+    try:
+        retry_after = float((e.headers or {}).get("Retry-After") or "")
+    except ValueError:
+        pass
+    return _HttpStatusError(
+        "HTTP 请求失败："
+        f"status={getattr(e, 'code', 'unknown')} url={url}\n"
+        f"响应片段：\n{raw[:1200].decode('utf-8', errors='replace')}",
+        status=int(getattr(e, "code", 0) or 0),
+        retry_after=retry_after,
+    )
+
+
+# 压缩响应边收边解压的分块大小
+_INFLATE_CHUNK = 64 * 1024
+
+
+class _InflateReader(io.RawIOBase):
+    """边读边解压 gzip/deflate 响应体：JSON 路径一次 readall()，SSE 路径经 BufferedReader 逐行读取。"""
+
+    def __init__(self, raw: Any, encoding: str) -> None:
+        self._raw = raw
+        self._encoding = encoding
+        self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+        self._pending = memoryview(b"")
+        self._eof = False
+        self.wire_bytes = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _inflate(self, chunk: bytes) -> bytes:
+        first = self.wire_bytes == 0
+        self.wire_bytes += len(chunk)
+        try:
+            return self._inflater.decompress(chunk)
+        except zlib.error:
+            if self._encoding != "deflate" or not first:
+                raise
+            # 部分服务端的 deflate 不带 zlib 头（raw deflate）
+            self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._inflater.decompress(chunk)
+
+    def _fill(self) -> None:
+        while not self._pending and not self._eof:
+            chunk = self._raw.read(_INFLATE_CHUNK)
+            if chunk:
+                self._pending = memoryview(self._inflate(chunk))
+            else:
+                self._eof = True
+                self._pending = memoryview(self._inflater.flush())
+
+    def readinto(self, b: Any) -> int:
+        self._fill()
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def readall(self) -> bytes:
+        parts = [bytes(self._pending)]
+        self._pending = memoryview(b"")
+        while not self._eof:
+            chunk = self._raw.read(_INFLATE_CHUNK)
+            if not chunk:
+                self._eof = True
+                parts.append(self._inflater.flush())
+            else:
+                parts.append(self._inflate(chunk))
+        return b"".join(parts)
+
+
+# --cassette：响应体中至少这么长的 base64 串单独按内容去重存放
+_CASSETTE_BLOB_MIN = 4096
+
+
+_CASSETTE_BLOB_RE = re.compile(rb"[A-Za-z0-9+/]{%d,}={0,2}" % _CASSETTE_BLOB_MIN)
+
+
+_CASSETTE_BLOB_REF_RE = re.compile(rb"@@b64:([0-9a-f]{64})@@")
+
+
+# 录制时不落盘的响应头
+_CASSETTE_SKIP_HEADERS = frozenset({"set-cookie"})
+
+
+_cassette: Optional["_Cassette"] = None
+
+
+class _ReplayBody(io.BytesIO):
+    """回放的响应体：首次读取时补上录制时“首字节 → 读完”的耗时。"""
+
+    def __init__(self, data: bytes, delay_s: float) -> None:
+        super().__init__(data)
+        self._delay_s = delay_s
+
+    def _wait(self) -> None:
+        if self._delay_s > 0:
+            time.sleep(self._delay_s)
+            self._delay_s = 0.0
+
+    def read(self, n: Optional[int] = -1) -> bytes:
+        self._wait()
+        return super().read(n)
+
+    def readline(self, limit: Optional[int] = -1) -> bytes:
+        self._wait()
+        return super().readline(limit)
+
+
+class _Cassette:
+    """上游交互的录制/回放存储（离线性能回归用）。
+
+    目录结构：index.jsonl 每行一次交互（请求元数据、状态码、响应头、首字节/总耗时、响应体模板），
+    响应体中的长 base64 串解码后按 sha256 存到 blobs/，相同图片只存一份；压缩或非 UTF-8 的响应体整体存为 blob。
+    回放按 (方法, 路径, 规范化请求体哈希) 精确匹配，用尽或匹配不到时按同一路径的录制顺序轮流返回。
+    """
+
+    def __init__(self, path: str, mode: str, *, speed: float = 1.0) -> None:
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._exact: Dict[Tuple[str, str, str], "collections.deque[Dict[str, Any]]"] = {}
+        self._by_route: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self._cursor: Dict[Tuple[str, str], int] = {}
+        self._bodies: Dict[int, bytes] = {}
+        os.makedirs(os.path.join(path, "blobs"), exist_ok=True)
+        if mode == "replay":
+            self._load()
+
+    @staticmethod
+    def _route(req: urllib.request.Request) -> Tuple[str, str]:
+        # 只按路径匹配，回放时可以换 --base-url
+        parts = urllib.parse.urlsplit(req.full_url)
+        return req.get_method(), parts.path + (f"?{parts.query}" if parts.query else "")
+
+    @staticmethod
+    def _request_sha(req: urllib.request.Request) -> str:
+        body = req.data if isinstance(req.data, bytes) else b""
+        # multipart 边界每次随机生成，哈希前替换为固定值
+        _, sep, boundary = (req.get_header("Content-type") or "").partition("boundary=")
+        if sep and boundary:
+            body = body.replace(boundary.encode("ascii"), b"BOUNDARY")
+        return hashlib.sha256(body).hexdigest()
+
+    def _blob_path(self, sha: str) -> str:
+        return os.path.join(self.path, "blobs", sha[:2], sha)
+
+    def _put_blob(self, data: bytes) -> str:
+        sha = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return sha
+
+    def _get_blob(self, sha: str) -> bytes:
+        with open(self._blob_path(sha), "rb") as f:
+            return f.read()
+
+    def _strip_blobs(self, body: bytes) -> bytes:
+        def replace(m: "re.Match[bytes]") -> bytes:
+            text = m.group(0)
+            try:
+                raw = base64.b64decode(text, validate=True)
+            except ValueError:
+                return text
+            if base64.b64encode(raw) != text:
+                return text  # 非规范编码，解码后无法原样还原
+            return b"@@b64:" + self._put_blob(raw).encode("ascii") + b"@@"
+
+        return _CASSETTE_BLOB_RE.sub(replace, body)
+
+    def _restore_blobs(self, template: bytes) -> bytes:
+        return _CASSETTE_BLOB_REF_RE.sub(lambda m: base64.b64encode(self._get_blob(m.group(1).decode("ascii"))), template)
+
+    def record(self, req: urllib.request.Request, resp: Any) -> Any:
+        ttfb = time.perf_counter() - getattr(req, "_cassette_started", time.perf_counter())
+        body = resp.read()
+        total = time.perf_counter() - getattr(req, "_cassette_started", time.perf_counter())
+        method, path = self._route(req)
+        entry: Dict[str, Any] = {
+            "method": method,
+            "path": path,
+            "host": urllib.parse.urlsplit(req.full_url).netloc,
+            "req_sha": self._request_sha(req),
+            "req_bytes": len(req.data) if isinstance(req.data, bytes) else 0,
+            "status": resp.status,
+            "reason": getattr(resp, "reason", "") or getattr(resp, "msg", ""),
+            "headers": [[k, v] for k, v in resp.headers.items() if k.lower() not in _CASSETTE_SKIP_HEADERS],
+            "ttfb_s": round(ttfb, 4),
+            "total_s": round(total, 4),
+        }
+        template = self._strip_blobs(body) if not resp.headers.get("Content-Encoding") else None
+        try:
+            entry["body"] = template.decode("utf-8") if template is not None else None
+        except UnicodeDecodeError:
+            entry["body"] = None
+        if entry["body"] is None:
+            del entry["body"]
+            entry["body_blob"] = self._put_blob(body)
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(os.path.join(self.path, "index.jsonl"), "a", encoding="utf-8") as f:
+                f.write(line)
+            self.recorded += 1
+        return self._response(req, entry, body, delay_s=0.0)
+
+    def _load(self) -> None:
+        index = os.path.join(self.path, "index.jsonl")
+        if not os.path.isfile(index):
+            raise SystemExit(f"cassette 不存在或尚未录制：{index}")
+        with open(index, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                route = (entry["method"], entry["path"])
+                self._exact.setdefault((*route, entry["req_sha"]), collections.deque()).append(entry)
+                self._by_route.setdefault(route, []).append(entry)
+
+    def _match(self, req: urllib.request.Request) -> Optional[Dict[str, Any]]:
+        route = self._route(req)
+        with self._lock:
+            exact = self._exact.get((*route, self._request_sha(req)))
+            if exact:
+                return exact.popleft()
+            entries = self._by_route.get(route)
+            if not entries:
+                return None
+            i = self._cursor.get(route, 0)
+            self._cursor[route] = i + 1
+            return entries[i % len(entries)]
+
+    def replay(self, req: urllib.request.Request) -> Any:
+        started = time.perf_counter()
+        entry = self._match(req)
+        if entry is None:
+            method, path = self._route(req)
+            raise urllib.error.URLError(f"cassette 中没有 {method} {path} 的录制")
+        body = self._bodies.get(id(entry))
+        if body is None:
+            if "body_blob" in entry:
+                body = self._get_blob(entry["body_blob"])
+            else:
+                body = self._restore_blobs(entry["body"].encode("utf-8"))
+            self._bodies[id(entry)] = body
+        ttfb = entry["ttfb_s"] / self.speed if self.speed > 0 else 0.0
+        rest = (entry["total_s"] - entry["ttfb_s"]) / self.speed if self.speed > 0 else 0.0
+        # 还原响应体本身的耗时计入首字节延迟，避免回放比录制更慢
+        wait = ttfb - (time.perf_counter() - started)
+        if wait > 0:
+            time.sleep(wait)
+        return self._response(req, entry, body, delay_s=rest)
+
+    @staticmethod
+    def _response(req: urllib.request.Request, entry: Dict[str, Any], body: bytes, *, delay_s: float) -> Any:
+        headers = http.client.HTTPMessage()
+        for k, v in entry["headers"]:
+            headers[k] = v
+        resp = urllib.response.addinfourl(_ReplayBody(body, delay_s), headers, req.full_url, entry["status"])
+        resp.msg = entry.get("reason") or ""
+        return resp
+
+
+class _CassetteRecorder(urllib.request.BaseHandler):
+    # 排在 HTTPErrorProcessor（1000）之前，4xx/5xx 响应也会被录下
+    handler_order = 100
+
+    def __init__(self, cassette: _Cassette) -> None:
+        self.cassette = cassette
+
+    def http_request(self, req: urllib.request.Request) -> urllib.request.Request:
+        req._cassette_started = time.perf_counter()  # type: ignore[attr-defined]
+        return req
+
+    def http_response(self, req: urllib.request.Request, resp: Any) -> Any:
+        return self.cassette.record(req, resp)
+
+    https_request = http_request
+    https_response = http_response
+
+
+class _CassetteReplayer(urllib.request.BaseHandler):
+    # 排在默认 HTTPHandler（500）之前，请求不会真正发出
+    handler_order = 100
+
+    def __init__(self, cassette: _Cassette) -> None:
+        self.cassette = cassette
+
+    def http_open(self, req: urllib.request.Request) -> Any:
+        return self.cassette.replay(req)
+
+    https_open = http_open
+
+
+def _install_cassette(args: argparse.Namespace) -> None:
+    """录制/回放挂在 urllib 全局 opener 上，覆盖 JSON、SSE、multipart、URL 下载等所有请求。"""
+    global _cassette
+    if not args.cassette:
+        return
+    _cassette = _Cassette(args.cassette, args.cassette_mode, speed=args.replay_speed)
+    handler = _CassetteRecorder(_cassette) if args.cassette_mode == "record" else _CassetteReplayer(_cassette)
+    urllib.request.install_opener(urllib.request.build_opener(handler))
+    if args.cassette_mode == "record":
+        atexit.register(lambda: print(f"📼 已录制 {_cassette.recorded} 次交互到 {args.cassette}", file=sys.stderr))
+    else:
+        speed = "即时" if args.replay_speed <= 0 else f"{args.replay_speed:g}x"
+        print(f"📼 回放 cassette：{args.cassette}（{speed}）", file=sys.stderr)
+
+
+class _CountingReader:
+    """透传 read/readline，并把从连接读到的字节数计入 download 流量。"""
+
+    __slots__ = ("_raw",)
+
+    def __init__(self, raw: Any) -> None:
+        self._raw = raw
+
+    def read(self, n: int = -1) -> bytes:
+        data = self._raw.read() if n is None or n < 0 else self._raw.read(n)
+        _METRICS.inc("dmxapi_image_transfer_bytes_total", len(data), direction="download")
+        return data
+
+    def readline(self, limit: int = -1) -> bytes:
+        data = self._raw.readline(limit)
+        _METRICS.inc("dmxapi_image_transfer_bytes_total", len(data), direction="download")
+        return data
+
+
+def _response_reader(resp: Any) -> Any:
+    """按 Content-Encoding 返回可 read()/readline() 的响应体，并统计线上字节数。"""
+    encoding = (resp.headers.get("Content-Encoding") or "").strip().lower()
+    counted = _CountingReader(resp)
+    if encoding in ("gzip", "x-gzip"):
+        return io.BufferedReader(_InflateReader(counted, "gzip"), buffer_size=_INFLATE_CHUNK)
+    if encoding == "deflate":
+        return io.BufferedReader(_InflateReader(counted, "deflate"), buffer_size=_INFLATE_CHUNK)
+    return counted
+
+
+@contextlib.contextmanager
+def _locked_file(path: str) -> Iterator[None]:
+    """跨进程互斥：POSIX 用 flock，Windows 用 msvcrt.locking。"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:  # pragma: no cover - Windows
+            import msvcrt
+
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:  # pragma: no cover - Windows
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _pid_alive(pid: int) -> bool:
+    if os.name == "nt":  # Windows 上 os.kill 会直接结束进程，只能依赖超时回收
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _RateLimiter:
+    """跨进程共享的客户端限流：每分钟请求数（令牌桶）+ 同时在途请求数。
+
+    状态按 scope（通常是 host + 模型）存放在 state_dir 下的 JSON 文件中，读改写全程持有文件锁，
+    多个 worker 进程共用同一目录即可协调速率；遇到 429 时按 Retry-After 让所有进程一起暂停。
+    """
+
+    def __init__(self, state_dir: str, *, rpm: float, burst: int = 1, max_concurrent: int = 0, stale_s: float = 900.0) -> None:
+        self.state_dir = state_dir
+        self.rpm = rpm
+        self.burst = max(1, burst)
+        self.max_concurrent = max_concurrent
+        # 持有槽位的进程异常退出时，超过 stale_s 的在途记录会被回收
+        self.stale_s = stale_s
+
+    def _paths(self, scope: str) -> Tuple[str, str]:
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in scope)[:120]
+        base = os.path.join(self.state_dir, safe)
+        return f"{base}.json", f"{base}.lock"
+
+    @staticmethod
+    def _read(path: str) -> Dict[str, Any]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    @staticmethod
+    def _write(path: str, state: Dict[str, Any]) -> None:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+
+    def acquire(self, scope: str) -> str:
+        state_path, lock_path = self._paths(scope)
+        ticket = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        while True:
+            with _locked_file(lock_path):
+                state = self._read(state_path)
+                now = time.time()
+                tokens = float(state.get("tokens", self.burst))
+                updated = float(state.get("updated", now))
+                if self.rpm > 0:
+                    tokens = min(float(self.burst), tokens + (now - updated) * self.rpm / 60.0)
+                inflight = {
+                    k: v
+                    for k, v in dict(state.get("inflight") or {}).items()
+                    if now - float(v.get("ts", 0)) < self.stale_s and _pid_alive(int(v.get("pid", 0)))
+                }
+                blocked_until = float(state.get("blocked_until", 0))
+                rate_ok = self.rpm <= 0 or tokens >= 1.0
+                slot_ok = self.max_concurrent <= 0 or len(inflight) < self.max_concurrent
+                if now >= blocked_until and rate_ok and slot_ok:
+                    if self.rpm > 0:
+                        tokens -= 1.0
+                    inflight[ticket] = {"pid": os.getpid(), "ts": now}
+                    self._write(state_path, {**state, "tokens": tokens, "updated": now, "inflight": inflight})
+                    return ticket
+                self._write(state_path, {**state, "tokens": tokens, "updated": now, "inflight": inflight})
+            if now < blocked_until:
+                wait = blocked_until - now
+            elif not rate_ok:
+                wait = (1.0 - tokens) * 60.0 / self.rpm
+            else:
+                wait = 0.2
+            time.sleep(min(max(wait, 0.01), 1.0))
+
+    def release(self, scope: str, ticket: str, *, retry_after: Optional[float] = None) -> None:
+        state_path, lock_path = self._paths(scope)
+        with _locked_file(lock_path):
+            state = self._read(state_path)
+            inflight = dict(state.get("inflight") or {})
+            inflight.pop(ticket, None)
+            state["inflight"] = inflight
+            if retry_after is not None:
+                # 429：所有共享该 scope 的进程一起暂停，并清空令牌，恢复后按速率重新发放
+                state["blocked_until"] = max(float(state.get("blocked_until", 0)), time.time() + retry_after)
+                state["tokens"] = 0.0
+                state["updated"] = time.time()
+            self._write(state_path, state)
+
+    @contextlib.contextmanager
+    def slot(self, scope: str) -> Iterator[None]:
+        ticket = self.acquire(scope)
+        retry_after: Optional[float] = None
+        try:
+            yield
+        except _HttpStatusError as e:
+            if e.status == 429:
+                retry_after = e.retry_after
+                if retry_after is None:
+                    retry_after = max(60.0 / self.rpm, 1.0) if self.rpm > 0 else 5.0
+            raise
+        finally:
+            self.release(scope, ticket, retry_after=retry_after)
+
+
+def _rate_limited(args: argparse.Namespace, *parts: str) -> ContextManager[None]:
+    """按 host + 模型等维度限流；未配置 --rate-limit-rpm / --max-concurrent 时不做任何事。"""
+    if not getattr(args, "rate_limit_rpm", 0) and not getattr(args, "max_concurrent", 0):
+        return contextlib.nullcontext()
+    limiter = _RateLimiter(
+        args.rate_limit_dir or os.path.join(args.cache_dir, "ratelimit"),
+        rpm=args.rate_limit_rpm,
+        burst=args.rate_limit_burst,
+        max_concurrent=args.max_concurrent,
+        stale_s=args.timeout_s + 60,
+    )
+    # 使用 Key 池时按 Key 分开限流，各 Key 的配额互不影响
+    return limiter.slot("_".join(p for p in (*parts, getattr(args, "rate_limit_scope", "")) if p))
+
+
+class _PooledKey:
+    """Key 池中的单个 Key：各自的限流参数与健康状态。"""
+
+    __slots__ = ("key", "fingerprint", "rpm", "max_concurrent", "inflight", "uses", "benched_until", "bench_reason")
+
+    def __init__(self, key: str, *, rpm: float, max_concurrent: int) -> None:
+        self.key = key
+        self.fingerprint = hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+        self.rpm = rpm
+        self.max_concurrent = max_concurrent
+        self.inflight = 0
+        self.uses = 0
+        self.benched_until = 0.0
+        self.bench_reason = ""
+
+    def apply(self, args: argparse.Namespace, *, pooled: bool) -> None:
+        """让本次 job 使用该 Key 及其限流参数；多 Key 时限流状态按 Key 分开存放。"""
+        args.api_key = self.key
+        args.rate_limit_rpm = self.rpm
+        args.max_concurrent = self.max_concurrent
+        if pooled:
+            args.rate_limit_scope = self.fingerprint
+            args.api_key_fp = self.fingerprint
+
+
+def _load_api_keys(args: argparse.Namespace) -> List[_PooledKey]:
+    """汇总 --api-key（可逗号分隔多个）与 --api-keys-file（每行 `KEY [rpm=N] [concurrent=N]`）。"""
+    specs: List[Tuple[str, Dict[str, str]]] = [(k, {}) for k in args.api_key.replace(",", " ").split()]
+    if args.api_keys_file:
+        with open(args.api_keys_file, "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split("#", 1)[0].split()
+                if fields:
+                    specs.append((fields[0], dict(item.split("=", 1) for item in fields[1:] if "=" in item)))
+    keys: Dict[str, _PooledKey] = {}
+    for key, opts in specs:
+        if key in keys:
+            continue
+        keys[key] = _PooledKey(
+            key,
+            rpm=float(opts.get("rpm", args.rate_limit_rpm)),
+            max_concurrent=int(opts.get("concurrent", args.max_concurrent)),
+        )
+    return list(keys.values())
+
+
+def _is_key_error(exc: BaseException) -> bool:
+    """鉴权失败或配额/限流：换一个 Key 可能就能成功。"""
+    return isinstance(exc, _HttpStatusError) and exc.status in (401, 403, 429)
+
+
+class _KeyPool:
+    """进程内的 API Key 池：按最少在途（或轮询）分配 Key，鉴权/配额错误后暂时停用该 Key。"""
+
+    def __init__(self, keys: List[_PooledKey], *, strategy: str = "least-loaded", auth_bench_s: float = 600.0, quota_bench_s: float = 60.0) -> None:
+        self.keys = keys
+        self.strategy = strategy
+        self.auth_bench_s = auth_bench_s
+        self.quota_bench_s = quota_bench_s
+        self._next = 0
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _usable(self, key: _PooledKey, now: float) -> bool:
+        return now >= key.benched_until and (key.max_concurrent <= 0 or key.inflight < key.max_concurrent)
+
+    def available(self) -> int:
+        now = time.monotonic()
+        return sum(1 for k in self.keys if now >= k.benched_until)
+
+    def _acquire(self) -> _PooledKey:
+        with self._cond:
+            waiting_noted = False
+            while True:
+                now = time.monotonic()
+                usable = [k for k in self.keys if self._usable(k, now)]
+                if usable:
+                    if self.strategy == "round-robin":
+                        ordered = self.keys[self._next :] + self.keys[: self._next]
+                        key = next(k for k in ordered if k in usable)
+                        self._next = (self.keys.index(key) + 1) % len(self.keys)
+                    else:
+                        key = min(usable, key=lambda k: (k.inflight, k.uses))
+                    key.inflight += 1
+                    key.uses += 1
+                    return key
+                wake = min((k.benched_until for k in self.keys if k.benched_until > now), default=now + 1.0)
+                if not waiting_noted and all(k.benched_until > now for k in self.keys):
+                    print(f"⏸️ 所有 API Key 暂不可用，{wake - now:.0f}s 后重试", file=sys.stderr)
+                    waiting_noted = True
+                self._cond.wait(timeout=min(max(wake - now, 0.05), 5.0))
+
+    def _release(self, key: _PooledKey, exc: Optional[BaseException]) -> None:
+        with self._cond:
+            key.inflight -= 1
+            if isinstance(exc, _HttpStatusError) and _is_key_error(exc):
+                if exc.status == 429:
+                    seconds = exc.retry_after if exc.retry_after is not None else self.quota_bench_s
+                    reason = "配额/限流 HTTP 429"
+                else:
+                    seconds = self.auth_bench_s
+                    reason = f"鉴权失败 HTTP {exc.status}"
+                key.benched_until = max(key.benched_until, time.monotonic() + seconds)
+                key.bench_reason = reason
+                print(f"🔑 Key {_mask_secret(key.key)} 暂停使用 {seconds:.0f}s：{reason}", file=sys.stderr)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def lease(self) -> Iterator[_PooledKey]:
+        key = self._acquire()
+        exc: Optional[BaseException] = None
+        try:
+            yield key
+        except BaseException as e:
+            exc = e
+            raise
+        finally:
+            self._release(key, exc)
+
+
+def _run_with_key_pool(pool: Optional[_KeyPool], args: argparse.Namespace, run_job: Callable[[argparse.Namespace], int]) -> int:
+    """从 Key 池租用一个 Key 执行 job；鉴权/配额错误时停用该 Key 并换下一个可用 Key 重试。"""
+    if pool is None or not len(pool):
+        return run_job(args)
+    attempts_left = len(pool)
+    while True:
+        try:
+            with pool.lease() as key:
+                key.apply(args, pooled=len(pool) > 1)
+                return run_job(args)
+        except _HttpStatusError as e:
+            attempts_left -= 1
+            if not _is_key_error(e) or attempts_left <= 0 or not pool.available():
+                raise
+            print("🔁 换用下一个 API Key 重试")
+            _METRICS.inc("dmxapi_image_retries_total", reason="key")
+
+
+def _is_route_failure(exc: BaseException) -> bool:
+    """线路本身的故障（超时/网络错误/5xx），而非请求参数或 Key 的问题。"""
+    if isinstance(exc, _HttpStatusError):
+        return exc.status >= 500
+    if isinstance(exc, (TimeoutError, ConnectionError, http.client.HTTPException)):
+        return True
+    return isinstance(exc, RuntimeError) and isinstance(exc.__cause__, urllib.error.URLError)
+
+
+class _RouteBreakers:
+    """按线路（base_url + 模型）维护熔断器与 EWMA 延迟，状态存放在 JSON 文件中、跨进程共享。
+
+    连续失败 failures 次后熔断 cooldown_s 秒；冷却结束后只放行一个探测请求（半开），
+    成功即恢复，失败则再次熔断。挑选线路时先排除本 job 已试过的线路（仍有未试过的可用线路时），
+    其次优先主模型，同一模型内选连续失败最少、EWMA 延迟最低的 base_url。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        routes: List[Tuple[str, str]],
+        *,
+        failures: int = 3,
+        cooldown_s: float = 60.0,
+        probe_timeout_s: float = 300.0,
+        alpha: float = 0.3,
+    ) -> None:
+        self.path = path
+        self.routes = routes
+        self.failures = max(1, failures)
+        self.cooldown_s = cooldown_s
+        self.probe_timeout_s = probe_timeout_s
+        self.alpha = alpha
+        models: List[str] = []
+        for _, model in routes:
+            if model not in models:
+                models.append(model)
+        self._model_rank = {m: i for i, m in enumerate(models)}
+
+    @staticmethod
+    def route_key(route: Tuple[str, str]) -> str:
+        return f"{route[0].rstrip('/')}|{route[1]}"
+
+    def pick(
+        self, tried: Iterable[Tuple[str, str]] = ()
+    ) -> Tuple[Optional[Tuple[str, str]], Dict[str, Any], float]:
+        """返回 (线路, 该线路的状态快照, 无可用线路时需等待的秒数)；tried 为本 job 已失败过的线路。"""
+        tried = set(tried)
+        with _locked_file(self.path + ".lock"):
+            state = _RateLimiter._read(self.path)
+            now = time.time()
+            best: Optional[Tuple[Tuple[bool, int, int, float, int], Tuple[str, str], bool]] = None
+            wake = now + self.cooldown_s
+            for rank, route in enumerate(self.routes):
+                st = state.get(self.route_key(route)) or {}
+                half_open = False
+                if st.get("state") == "open":
+                    ready_at = max(float(st.get("open_until", 0)), float(st.get("probe_until", 0)))
+                    if now < ready_at:
+                        wake = min(wake, ready_at)
+                        continue
+                    half_open = True
+                # 近期有连续失败的线路排在健康线路之后（连接被拒时失败得很“快”，不能只看延迟）；
+                # 超过冷却时间后不再降权，让恢复的主线路重新有机会被选中
+                recent_failures = int(st.get("failures", 0)) if now - float(st.get("failed_at", 0)) < self.cooldown_s else 0
+                score = (route in tried, self._model_rank[route[1]], recent_failures, float(st.get("ewma_s") or 0.0), rank)
+                if best is None or score < best[0]:
+                    best = (score, route, half_open)
+            if best is None:
+                return None, {}, max(wake - now, 0.05)
+            _, route, half_open = best
+            st = dict(state.get(self.route_key(route)) or {})
+            if half_open:
+                # 半开：只放行这一个探测请求，其余进程在探测结束前继续视为熔断
+                st["probe_until"] = now + self.probe_timeout_s
+                state[self.route_key(route)] = st
+                _RateLimiter._write(self.path, state)
+            return route, {"breaker": "half_open" if half_open else st.get("state", "closed"), "route_ewma_s": st.get("ewma_s")}, 0.0
+
+    def record(self, route: Tuple[str, str], *, ok: bool, latency_s: Optional[float]) -> Optional[str]:
+        """记录一次结果，返回熔断器状态变化（"open"/"closed"），无变化时返回 None。"""
+        with _locked_file(self.path + ".lock"):
+            state = _RateLimiter._read(self.path)
+            key = self.route_key(route)
+            st = dict(state.get(key) or {})
+            before = st.get("state", "closed")
+            if latency_s is not None:
+                ewma = st.get("ewma_s")
+                st["ewma_s"] = round(latency_s if ewma is None else self.alpha * latency_s + (1 - self.alpha) * float(ewma), 3)
+            if ok:
+                st.update({"state": "closed", "failures": 0, "open_until": 0, "probe_until": 0})
+            else:
+                st["failures"] = int(st.get("failures", 0)) + 1
+                st["failed_at"] = time.time()
+                if before == "open" or st["failures"] >= self.failures:
+                    st.update({"state": "open", "open_until": time.time() + self.cooldown_s, "probe_until": 0})
+            state[key] = st
+            _RateLimiter._write(self.path, state)
+        after = st.get("state", "closed")
+        return after if after != before else None
+
+
+def _route_breakers(args: argparse.Namespace) -> Optional[_RouteBreakers]:
+    """主线路 + --fallback-base-url × --fallback-model；只有一条线路时不启用熔断。"""
+    bases = [args.base_url] + [b for b in args.fallback_base_url if b != args.base_url]
+    models = [args.model] + [m for m in args.fallback_model if m != args.model]
+    routes = [(b, m) for m in models for b in bases]
+    if len(routes) < 2 or getattr(args, "endpoint", ""):
+        return None
+    return _RouteBreakers(
+        args.route_state or os.path.join(args.cache_dir, "routes.json"),
+        routes,
+        failures=args.breaker_failures,
+        cooldown_s=args.breaker_cooldown_s,
+        probe_timeout_s=args.timeout_s + 60,
+    )
+
+
+def _run_with_routes(args: argparse.Namespace, run_job: Callable[[argparse.Namespace], int]) -> int:
+    """按熔断器状态与延迟挑选线路执行 job；线路故障时记入熔断器并改走下一条健康线路。"""
+    breakers = _route_breakers(args)
+    if breakers is None:
+        return run_job(args)
+    tried: List[Tuple[str, str]] = []
+    waiting_noted = False
+    while True:
+        route, info, wait_s = breakers.pick(tried)
+        if route is None:
+            if not waiting_noted:
+                print(f"⏸️ 所有线路均已熔断，{wait_s:.0f}s 后重试", file=sys.stderr)
+                waiting_noted = True
+            time.sleep(min(wait_s, 5.0))
+            continue
+        args.base_url, args.model = route
+        args.route_info = {
+            "route": breakers.route_key(route),
+            "route_fallback": route != breakers.routes[0],
+            **info,
+        }
+        if route != breakers.routes[0]:
+            print(f"🔀 使用备用线路：{route[0]} / {route[1]}")
+        t0 = time.perf_counter()
+        try:
+            code = run_job(args)
+        except Exception as e:
+            failed = _is_route_failure(e)
+            if isinstance(e, _HttpStatusError) and not failed:
+                # 4xx 说明线路本身可达，同样算作一次健康响应（也结束半开探测）
+                breakers.record(route, ok=True, latency_s=None)
+            if failed:
+                change = breakers.record(route, ok=False, latency_s=time.perf_counter() - t0)
+                if change == "open":
+                    print(f"⚡ 线路熔断：{route[0]} / {route[1]}（冷却 {breakers.cooldown_s:.0f}s）", file=sys.stderr)
+                    _record_metrics(args, {"event": "breaker_open", "breaker": "open", "status": "error", "error": str(e)[:300]})
+            tried.append(route)
+            if not failed or len(set(tried)) >= len(breakers.routes):
+                raise
+            print(f"🔁 线路故障（{type(e).__name__}），改走下一条线路重试")
+            _METRICS.inc("dmxapi_image_retries_total", reason="route")
+            continue
+        if breakers.record(route, ok=True, latency_s=time.perf_counter() - t0) == "closed":
+            print(f"✅ 线路恢复：{route[0]} / {route[1]}")
+            _record_metrics(args, {"event": "breaker_closed", "breaker": "closed"})
+        return code
+
+
+def _iter_sse_events(resp: Any) -> Iterable[Tuple[str, str]]:
+    """增量解析 text/event-stream：逐行读取，遇到空行即产出 (event, data)，不等待整个响应结束。"""
+    event = ""
+    data_lines: List[str] = []
+    while True:
+        line = resp.readline()
+        if not line:
+            break
+        text = line.decode("utf-8").rstrip("\r\n")
+        if not text:
+            if data_lines:
+                yield event or "message", "\n".join(data_lines)
+            event, data_lines = "", []
+            continue
+        if text.startswith(":"):
+            continue
+        name, _, value = text.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if name == "event":
+            event = value
+        elif name == "data":
+            data_lines.append(value)
+    if data_lines:
+        yield event or "message", "\n".join(data_lines)
+
+
+# 图片请求耗时直方图的桶上限（秒）：覆盖 flash 的数秒到 pro 4K 的数分钟
+_LATENCY_BUCKETS = (1.0, 2.5, 5.0, 10.0, 15.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0, 180.0, 300.0)
+
+
+_METRIC_HELP = {
+    "dmxapi_image_requests_total": ("counter", "上游图片请求数（按模型、尺寸、结果）"),
+    "dmxapi_image_request_latency_seconds": ("histogram", "成功请求的端到端耗时（按模型、尺寸）"),
+    "dmxapi_image_transfer_bytes_total": ("counter", "线上传输字节数（upload 为请求体，download 为响应体，压缩时按压缩后计）"),
+    "dmxapi_image_retries_total": ("counter", "重试次数（throttle：批量限流重排队；key：换 Key；route：换线路）"),
+    "dmxapi_image_cache_hits_total": ("counter", "缓存/复用命中次数"),
+}
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _PromMetrics:
+    """进程内聚合指标：计数器 + 延迟直方图，按 Prometheus 文本格式导出（--prom-textfile / --prom-port）。"""
+
+    def __init__(self, api: str) -> None:
+        self.api = api
+        self.textfile = ""
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+
+    def _key(self, name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+        return name, (("api", self.api),) + tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+        self._maybe_flush()
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            # 每个桶的计数（非累积）+ 末尾两项为 sum、count
+            hist = self._histograms.setdefault(key, [0.0] * (len(_LATENCY_BUCKETS) + 2))
+            for i, upper in enumerate(_LATENCY_BUCKETS):
+                if value <= upper:
+                    hist[i] += 1
+                    break
+            hist[-2] += value
+            hist[-1] += 1
+        self._maybe_flush()
+
+    def observe_record(self, args: argparse.Namespace, record: Dict[str, Any]) -> None:
+        """从 _record_metrics 的单次请求记录中提取聚合指标；事件行（熔断、批次汇总）不计入。"""
+        status = record.get("status")
+        if "event" in record or not status:
+            return
+        if status == "coalesced":
+            self.inc("dmxapi_image_cache_hits_total", cache="coalesced")
+            return
+        model = getattr(args, "model", "") or ""
+        size = getattr(args, "image_size", None) or getattr(args, "size", None) or "default"
+        self.inc("dmxapi_image_requests_total", model=model, size=size, status=status)
+        latency = record.get("latency_s")
+        if status == "ok" and isinstance(latency, (int, float)):
+            self.observe("dmxapi_image_request_latency_seconds", float(latency), model=model, size=size)
+
+    def render(self) -> str:
+        def fmt_labels(labels: Tuple[Tuple[str, str], ...], le: str = "") -> str:
+            pairs = list(labels) + ([("le", le)] if le else [])
+            escaped = (f'{k}="{_escape_label(v)}"' for k, v in pairs)
+            return "{" + ",".join(escaped) + "}"
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, list(v)) for k, v in self._histograms.items())
+        lines: List[str] = []
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                kind, help_text = _METRIC_HELP[name]
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines.append(f"{name}{fmt_labels(labels)} {value:g}")
+        for (name, labels), hist in histograms:
+            if name not in seen:
+                seen.add(name)
+                kind, help_text = _METRIC_HELP[name]
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            cumulative = 0.0
+            for upper, count in zip(_LATENCY_BUCKETS, hist):
+                cumulative += count
+                lines.append(f"{name}_bucket{fmt_labels(labels, f'{upper:g}')} {cumulative:g}")
+            lines.append(f"{name}_bucket{fmt_labels(labels, '+Inf')} {hist[-1]:g}")
+            lines.append(f"{name}_sum{fmt_labels(labels)} {hist[-2]:.3f}")
+            lines.append(f"{name}_count{fmt_labels(labels)} {hist[-1]:g}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def _maybe_flush(self) -> None:
+        # 批量/常驻模式下 textfile 至多每秒重写一次；进程退出时再写最终值
+        if self.textfile and time.monotonic() - self._last_flush >= 1.0:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.textfile:
+            return
+        self._last_flush = time.monotonic()
+        os.makedirs(os.path.dirname(self.textfile) or ".", exist_ok=True)
+        tmp = f"{self.textfile}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        # 原子替换，node_exporter textfile collector 不会读到半个文件
+        os.replace(tmp, self.textfile)
+
+    def serve(self, port: int) -> None:
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:  # noqa: N802 - BaseHTTPRequestHandler 约定
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        # 只监听本机回环地址，避免把内部指标暴露到网络上
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, name="prom-metrics", daemon=True).start()
+        print(f"📈 指标端点：http://127.0.0.1:{server.server_address[1]}/metrics", file=sys.stderr)
+
+
+def _start_metrics_export(args: argparse.Namespace, api: str) -> None:
+    """api 为指标的 api 标签（gemini / openai），须在发出任何请求前设置。"""
+    _METRICS.api = api
+    if args.prom_textfile:
+        _METRICS.textfile = args.prom_textfile
+        atexit.register(_METRICS.flush)
+    if args.prom_port is not None:
+        _METRICS.serve(args.prom_port)
+
+
+_METRICS = _PromMetrics("")
+
+
+def _record_metrics(args: argparse.Namespace, record: Dict[str, Any]) -> None:
+    _METRICS.observe_record(args, record)
+    path = getattr(args, "metrics_file", "")
+    if not path:
+        return
+    row: Dict[str, Any] = {"ts": _dt.datetime.now().isoformat(timespec="milliseconds")}
+    # OpenAI 脚本有子命令（cmd），Gemini 脚本有 --stream；有哪个带哪个
+    for key in ("cmd", "model", "stream"):
+        if hasattr(args, key):
+            row[key] = getattr(args, key)
+    row.update(record)
+    context = getattr(args, "metrics_context", None)
+    if context is not None:
+        # 批量模式：附带 job id 与当前并发上限
+        row.update(context())
+    if getattr(args, "api_key_fp", None):
+        row["key"] = args.api_key_fp
+    # 启用多线路时附带所用线路及其熔断器状态
+    row.update(getattr(args, "route_info", None) or {})
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+# 批量/常驻模式中 job 行里不对应命令行参数的元数据字段
+_JOB_META_KEYS = ("id", "cmd", "priority")
+
+
+def _job_to_argv(job: Dict[str, Any]) -> List[str]:
+    """把 JSON job 转成命令行参数，复用 argparse 的类型/choices 校验：{"image_size": "2K"} -> ["--image-size", "2K"]。"""
+    argv: List[str] = []
+    for key, value in job.items():
+        if key in _JOB_META_KEYS or value is None or value is False:
+            continue
+        flag = "--" + key.replace("_", "-")
+        if value is True:
+            argv.append(flag)
+        elif isinstance(value, list):
+            for item in value:
+                argv.extend([flag, str(item)])
+        else:
+            argv.extend([flag, str(value)])
+    return argv
+
+
+def _iter_batch_jobs(path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """逐行读取 JSON Lines job；path 为 - 时读 stdin，行到即产出（常驻模式）。"""
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        for lineno, line in enumerate(iter(f.readline, ""), start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                print(f"⚠️ 第 {lineno} 行不是合法 JSON，已跳过：{e}", file=sys.stderr)
+                continue
+            if not isinstance(job, dict):
+                print(f"⚠️ 第 {lineno} 行不是 JSON 对象，已跳过", file=sys.stderr)
+                continue
+            yield str(job.get("id") or lineno), job
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class _AimdController:
+    """批量模式的自适应并发（AIMD）：健康时每完成约一个窗口的请求并发 +1，
+    遇到 429/503 或 p90 延迟明显上升时并发减半；两次减半之间至少间隔一个 p90 周期，避免连环踩刹车。
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        *,
+        minimum: int = 1,
+        maximum: int = 16,
+        adaptive: bool = True,
+        latency_window: int = 20,
+        latency_factor: float = 2.0,
+    ) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.adaptive = adaptive
+        self.latency_factor = latency_factor
+        self._latencies: "collections.deque[float]" = collections.deque(maxlen=max(5, latency_window))
+        self._baseline_p90: Optional[float] = None
+        self._last_decrease = 0.0
+        self.increases = 0
+        self.decreases = 0
+        self._lock = threading.Lock()
+
+    @property
+    def current(self) -> int:
+        return int(self.limit)
+
+    def p90(self) -> Optional[float]:
+        if len(self._latencies) < self._latencies.maxlen // 2:  # type: ignore[operator]
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))]
+
+    def on_result(self, *, latency_s: Optional[float], throttled: bool) -> None:
+        if not self.adaptive:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if latency_s is not None:
+                self._latencies.append(latency_s)
+            p90 = self.p90()
+            if p90 is not None and (self._baseline_p90 is None or p90 < self._baseline_p90):
+                self._baseline_p90 = p90
+            slow = p90 is not None and self._baseline_p90 is not None and p90 > self._baseline_p90 * self.latency_factor
+            if throttled or slow:
+                if now - self._last_decrease >= (p90 or 1.0):
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                    self._last_decrease = now
+                    self.decreases += 1
+                    if slow:
+                        # 降速后以新的延迟水平重新观察，避免基线被旧样本卡住
+                        self._latencies.clear()
+                        self._baseline_p90 = None
+                return
+            if latency_s is not None and self.limit < self.maximum:
+                before = self.current
+                self.limit = min(float(self.maximum), self.limit + 1.0 / max(self.limit, 1.0))
+                if self.current > before:
+                    self.increases += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        p90 = self.p90()
+        return {
+            "concurrency_limit": self.current,
+            "concurrency_mode": "aimd" if self.adaptive else "fixed",
+            "latency_p90_s": None if p90 is None else round(p90, 3),
+        }
+
+
+# 两个脚本共有的、不影响生成结果的参数（输出位置、鉴权、限流、调度等），计算请求指纹时忽略；
+# 各脚本在此基础上补充自己的字段
+_SHARED_NON_REQUEST_KEYS = frozenset({
+    "api_key", "api_keys_file", "key_strategy", "key_bench_s", "auth_header",
+    "fallback_base_url", "breaker_failures", "breaker_cooldown_s", "route_state",
+    "timeout_s", "out_dir", "prefix", "metrics_file", "output", "compressed",
+    "prom_textfile", "prom_port", "cassette", "cassette_mode", "replay_speed",
+    "cache_dir", "max_request_bytes",
+    "rate_limit_rpm", "rate_limit_burst", "max_concurrent", "rate_limit_dir",
+    "batch", "concurrency", "min_concurrency", "max_concurrency", "concurrency_mode", "batch_retries", "dedupe",
+    # 运行期附加到 args 上的字段
+    "metrics_context", "route_info", "api_key_fp", "rate_limit_scope",
+})
+
+
+class _Flight:
+    __slots__ = ("job_id", "prefix", "done", "code", "error", "outputs")
+
+    def __init__(self, job_id: str, prefix: str) -> None:
+        self.job_id = job_id
+        self.prefix = prefix
+        self.done = threading.Event()
+        self.code = 0
+        self.error: Optional[BaseException] = None
+        self.outputs: List[str] = []
+
+
+class _SingleFlight:
+    """同一批次内请求指纹相同的 job 只发一次上游请求：首个 job 实际执行，其余 job 等待并复用其输出。"""
+
+    def __init__(self, mode: str = "link") -> None:
+        self.mode = mode
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def run(
+        self,
+        fingerprint: Optional[str],
+        job_id: str,
+        args: argparse.Namespace,
+        run_job: Callable[[argparse.Namespace], int],
+    ) -> int:
+        if fingerprint is None or self.mode == "off":
+            return run_job(args)
+        with self._lock:
+            flight = self._flights.get(fingerprint)
+            leader = flight is None
+            if flight is None:
+                flight = self._flights[fingerprint] = _Flight(job_id, args.prefix)
+        if leader:
+            try:
+                with _collect_outputs() as outputs:
+                    flight.code = run_job(args)
+                flight.outputs = outputs
+                return flight.code
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[fingerprint]
+                flight.done.set()
+
+        print(f"🔗 [job {job_id}] 与 job {flight.job_id} 请求相同，等待复用其结果")
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        shared = []
+        for src in flight.outputs:
+            dst = _note_output(_share_output(src, src_prefix=flight.prefix, out_dir=args.out_dir, prefix=args.prefix, mode=self.mode))
+            shared.append(dst)
+            print(f"✅ 已复用 job {flight.job_id} 的输出：{dst}")
+            # 与首个 job 一致：只有图片发 image_saved，.b64.txt/.signature.txt 等旁路文件只列在 done.outputs 中
+            mime_type = _image_mime_type(dst)
+            if mime_type is not None:
+                _emit_image_saved(dst, mime_type, coalesced_from=flight.job_id)
+        _record_metrics(args, {"status": "coalesced", "leader_job_id": flight.job_id, "outputs": shared})
+        return flight.code
+
+
+def _is_throttle_error(exc: BaseException) -> bool:
+    return isinstance(exc, _HttpStatusError) and exc.status in (429, 503)
+
+
+def _parse_bytes(value: str) -> int:
+    """解析 512M / 2G / 1048576 这类字节数（1K = 1024）。"""
+    text = value.strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+# job 行里的 priority 字段：类别名或 0~9 的整数，数值越小越先派发
+_PRIORITY_CLASSES = {"interactive": 0, "high": 1, "normal": 2, "low": 3, "bulk": 4}
+
+
+def _job_priority(job: Dict[str, Any]) -> int:
+    value = job.get("priority", "normal")
+    if isinstance(value, str) and value.lower() in _PRIORITY_CLASSES:
+        return _PRIORITY_CLASSES[value.lower()]
+    try:
+        return max(0, min(9, int(value)))
+    except (TypeError, ValueError):
+        return _PRIORITY_CLASSES["normal"]
+
+
+class _JobJournal:
+    """批量模式的预写日志（JSON Lines，只追加）：记录每个 job 的 queued / inflight / done / failed / retry 状态。
+
+    每条记录一行、写完即 flush（不 fsync），追加成本很低；进程被中断后用同一个 --journal 重跑，
+    最后状态为 done 的 job 会被跳过，其余 job 重新提交。job 以 id + 内容哈希标识，改过的 job 会重跑。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.done = self._load_done(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._f = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def job_key(job_id: str, job: Dict[str, Any]) -> str:
+        digest = hashlib.sha256(json.dumps(job, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+        return f"{job_id}:{digest}"
+
+    @staticmethod
+    def _load_done(path: str) -> Dict[str, Dict[str, Any]]:
+        last: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # 中断时可能留下半行
+                    if isinstance(entry, dict) and entry.get("key"):
+                        last[entry["key"]] = entry
+        except FileNotFoundError:
+            return {}
+        return {k: v for k, v in last.items() if v.get("state") == "done"}
+
+    def record(self, key: str, state: str, **fields: Any) -> None:
+        line = json.dumps({"ts": round(time.time(), 3), "key": key, "state": state, **fields}, ensure_ascii=False)
+        with self._lock:
+            self._f.write(line + "\n")
+            self._f.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._f.close()
+
+
+class _QueuedJob:
+    __slots__ = ("job_id", "key", "job", "attempt", "priority", "cost_key", "expected_s", "mem_bytes", "enqueued_at", "args", "error")
+
+    def __init__(self, job_id: str, job: Dict[str, Any]) -> None:
+        self.job_id = job_id
+        self.key = _JobJournal.job_key(job_id, job)
+        self.job = job
+        self.attempt = 0
+        self.priority = _job_priority(job)
+        self.cost_key = ""
+        self.expected_s = 0.0
+        self.mem_bytes = 0
+        self.enqueued_at = time.monotonic()
+        # 入队时预先解析好的参数（首次派发直接使用）；解析失败时记录异常，派发后按失败处理
+        self.args: Optional[argparse.Namespace] = None
+        self.error: Optional[BaseException] = None
+
+
+class _JobStats:
+    """各类 job（模型/尺寸/输入张数等）的历史耗时 EWMA，存文件、跨批次累积，供调度估算成本。"""
+
+    def __init__(self, path: str, *, alpha: float = 0.3) -> None:
+        self.path = path
+        self.alpha = alpha
+        self._cache = _RateLimiter._read(path)
+        self._lock = threading.Lock()
+
+    def expected(self, key: str, prior_s: float) -> float:
+        entry = self._cache.get(key) or {}
+        return float(entry.get("ewma_s") or prior_s)
+
+    def observe(self, key: str, latency_s: float) -> None:
+        with self._lock, _locked_file(self.path + ".lock"):
+            data = _RateLimiter._read(self.path)
+            entry = dict(data.get(key) or {})
+            ewma = entry.get("ewma_s")
+            entry["ewma_s"] = round(latency_s if ewma is None else self.alpha * latency_s + (1 - self.alpha) * float(ewma), 3)
+            entry["count"] = int(entry.get("count", 0)) + 1
+            data[key] = entry
+            _RateLimiter._write(self.path, data)
+            self._cache = data
+
+
+class _JobScheduler:
+    """批量模式的派发队列：先按优先级类别，同类别内预计耗时最短优先（SJF），以降低平均完成时间。
+
+    等待会按 aging 速率抵扣预计耗时，长任务不会被源源不断的短任务永远压住；
+    等待超过 max_wait_s 的 job 无视类别与成本最先派发（防饿死的硬上限）。
+    成本 expected - aging × (now - enqueued) 与 expected + aging × enqueued 的排序等价，因此可直接用堆。
+    """
+
+    def __init__(self, *, policy: str = "sjf", aging: float = 0.5, max_wait_s: float = 300.0) -> None:
+        self.policy = policy
+        self.aging = aging
+        self.max_wait_s = max_wait_s
+        self._heap: List[Tuple[Tuple[float, float, int], int]] = []
+        self._arrivals: "collections.deque[int]" = collections.deque()
+        self._items: Dict[int, _QueuedJob] = {}
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def push(self, item: _QueuedJob) -> None:
+        self._seq += 1
+        self._items[self._seq] = item
+        if self.policy == "fifo":
+            score = (0.0, 0.0, self._seq)
+        else:
+            score = (float(item.priority), item.expected_s + self.aging * item.enqueued_at, self._seq)
+        heapq.heappush(self._heap, (score, self._seq))
+        self._arrivals.append(self._seq)
+
+    def peek(self) -> Tuple[int, _QueuedJob]:
+        """下一个应派发的 job（不出队），供内存预算判断能否放行。"""
+        while self._arrivals and self._arrivals[0] not in self._items:
+            self._arrivals.popleft()
+        if self._arrivals and time.monotonic() - self._items[self._arrivals[0]].enqueued_at >= self.max_wait_s:
+            seq = self._arrivals[0]
+            return seq, self._items[seq]
+        while self._heap[0][1] not in self._items:
+            heapq.heappop(self._heap)
+        seq = self._heap[0][1]
+        return seq, self._items[seq]
+
+    def take(self, seq: int) -> _QueuedJob:
+        return self._items.pop(seq)
+
+
+def _run_batch(
+    args: argparse.Namespace,
+    *,
+    build_job_args: Callable[[str, Dict[str, Any]], argparse.Namespace],
+    run_job: Callable[[argparse.Namespace], int],
+    request_fingerprint: Callable[[argparse.Namespace], Optional[str]],
+    estimate_cost: Callable[[argparse.Namespace], Tuple[str, float]],
+    estimate_memory: Callable[[argparse.Namespace], int],
+    jobs: Iterable[Tuple[str, Dict[str, Any]]],
+    preload: bool = False,
+    results: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> int:
+    """批量/常驻执行：逐个读取 job（--batch 文件/stdin 或网格展开），按优先级 + 预计耗时调度，按 AIMD 控制的并发上限派发。
+
+    被 429/503 限流的 job 重新排队（最多 --batch-retries 次），其余失败只影响当前 job；
+    同时在途的相同请求只发一次（--dedupe）；设置 --max-inflight-bytes 时，
+    在途 job 的预估内存峰值之和超出预算便暂停放行（至少放行一个，避免大 job 永远卡住）；
+    设置 --journal 时记录每个 job 的状态，重跑时跳过已完成的 job。
+    """
+    controller = _AimdController(
+        args.concurrency,
+        minimum=args.min_concurrency,
+        maximum=args.max_concurrency,
+        adaptive=args.concurrency_mode == "aimd",
+    )
+    flights = _SingleFlight(args.dedupe)
+    stats = _JobStats(os.path.join(args.cache_dir, "job-latency.json"))
+    queue = _JobScheduler(policy=args.scheduler, aging=args.aging_rate, max_wait_s=args.max_wait_s)
+    cond = threading.Condition()
+    state = {"inflight": 0, "ok": 0, "failed": 0, "retried": 0, "skipped": 0, "reading": True, "inflight_bytes": 0, "peak_inflight_bytes": 0}
+    journal = _JobJournal(args.journal) if args.journal else None
+    if journal and journal.done:
+        print(f"📒 journal 中已有 {len(journal.done)} 个完成的 job，本次将跳过")
+    budget = args.max_inflight_bytes
+    completion_times: List[float] = []
+    started = time.perf_counter()
+
+    def reader() -> None:
+        try:
+            for job_id, job in jobs:
+                item = _QueuedJob(job_id, job)
+                if journal and item.key in journal.done:
+                    _METRICS.inc("dmxapi_image_cache_hits_total", cache="journal")
+                    with cond:
+                        state["skipped"] += 1
+                        if results is not None:
+                            results[job_id] = {"status": "done(journal)", "outputs": journal.done[item.key].get("outputs")}
+                    continue
+                try:
+                    item.args = build_job_args(job_id, job)
+                    item.cost_key, prior_s = estimate_cost(item.args)
+                    item.expected_s = stats.expected(item.cost_key, prior_s)
+                    item.mem_bytes = estimate_memory(item.args)
+                except SystemExit as e:
+                    item.error = e
+                if journal:
+                    journal.record(item.key, "queued", job_id=job_id, priority=item.priority, expected_s=round(item.expected_s, 3))
+                with cond:
+                    queue.push(item)
+                    cond.notify_all()
+                _emit_event("queued", job=job_id, priority=item.priority, expected_s=round(item.expected_s, 3))
+        finally:
+            with cond:
+                state["reading"] = False
+                cond.notify_all()
+
+    def worker(item: _QueuedJob) -> None:
+        job_id = item.job_id
+        t0 = time.perf_counter()
+        queue_wait = time.monotonic() - item.enqueued_at
+        latency: Optional[float] = None
+        throttled = False
+        ok = False
+        error: Optional[BaseException] = None
+        outputs: List[str] = []
+        if journal:
+            journal.record(item.key, "inflight", attempt=item.attempt)
+        _event_job.id = job_id
+        try:
+            if item.error is not None:
+                raise item.error
+            job_args = item.args if item.args is not None else build_job_args(job_id, item.job)
+            item.args = None  # 重试时重新解析，避免沿用上次租用的 Key/线路
+            job_args.metrics_context = lambda: {
+                "job_id": job_id,
+                "attempt": item.attempt,
+                "priority": item.priority,
+                "expected_s": round(item.expected_s, 3),
+                "queue_wait_s": round(queue_wait, 3),
+                **controller.snapshot(),
+                "inflight": state["inflight"],
+                "mem_estimate_bytes": item.mem_bytes,
+                "inflight_bytes": state["inflight_bytes"],
+            }
+            with _collect_outputs() as outputs:
+                code = flights.run(request_fingerprint(job_args), job_id, job_args, run_job)
+            ok = code == 0
+            latency = time.perf_counter() - t0
+            if ok and item.cost_key:
+                stats.observe(item.cost_key, latency)
+            if not ok:
+                print(f"⚠️ [job {job_id}] 退出码 {code}")
+        except SystemExit as e:
+            # argparse 校验失败 / 缺文件等：只影响当前 job
+            error = e
+            reason = e.code if isinstance(e.code, str) else "参数解析失败（见上方 usage）"
+            print(f"❌ [job {job_id}] 参数或输入无效：{reason}", file=sys.stderr)
+            _emit_event("error", **_error_event_fields(e))
+        except Exception as e:
+            error = e
+            throttled = _is_throttle_error(e)
+            print(f"❌ [job {job_id}] {type(e).__name__}: {str(e)[:300]}", file=sys.stderr)
+            _emit_event("error", **_error_event_fields(e))
+        controller.on_result(latency_s=latency, throttled=throttled)
+        requeue = throttled and item.attempt < args.batch_retries
+        if requeue:
+            _emit_event("requeued", attempt=item.attempt + 1)
+        else:
+            _emit_event(
+                "done",
+                status="ok" if ok else (type(error).__name__ if error is not None else "no_image"),
+                latency_s=None if latency is None else round(latency, 3),
+                outputs=[os.path.abspath(p) for p in outputs],
+            )
+        _event_job.id = None
+        with cond:
+            state["inflight"] -= 1
+            state["inflight_bytes"] -= item.mem_bytes
+            if requeue:
+                item.attempt += 1
+                queue.push(item)
+                state["retried"] += 1
+                print(f"🔁 [job {job_id}] 被限流，降并发后重新排队（第 {item.attempt} 次重试）")
+                _METRICS.inc("dmxapi_image_retries_total", reason="throttle")
+                if journal:
+                    journal.record(item.key, "retry", attempt=item.attempt, error_class=type(error).__name__)
+            else:
+                if results is not None:
+                    results[job_id] = {
+                        "status": "ok" if ok else (type(error).__name__ if error is not None else "no_image"),
+                        "latency_s": latency,
+                        "outputs": list(outputs),
+                    }
+                if journal and ok:
+                    journal.record(item.key, "done", outputs=outputs, latency_s=round(latency or 0.0, 3))
+                elif journal:
+                    journal.record(
+                        item.key,
+                        "failed",
+                        error_class=type(error).__name__ if error is not None else "NoImage",
+                        status=getattr(error, "status", None),
+                        error=str(error)[:300] if error is not None else "",
+                    )
+                state["ok" if ok else "failed"] += 1
+                completion_times.append(time.monotonic() - item.enqueued_at)
+            cond.notify_all()
+
+    def fits() -> bool:
+        # 调用方已持有 cond；队首 job 放不下时整体等待（不跳过它去派发小 job，避免大 job 饿死）
+        if not budget or state["inflight"] == 0:
+            return True
+        _, head = queue.peek()
+        if state["inflight_bytes"] + head.mem_bytes <= budget:
+            return True
+        if not state.get("budget_noted"):
+            state["budget_noted"] = True
+            print(f"⏳ 内存预算已满（在途约 {state['inflight_bytes'] >> 20} MB / 上限 {budget >> 20} MB），等待在途 job 完成后再放行")
+        return False
+
+    if preload:
+        # 任务集合已知（如参数网格）：先全部入队再开始派发，调度器才能从最便宜的开始
+        reader()
+    else:
+        threading.Thread(target=reader, name="batch-reader", daemon=True).start()
+    with ThreadPoolExecutor(max_workers=controller.maximum) as pool:
+        while not state.get("interrupted"):
+            try:
+                with cond:
+                    while not (len(queue) and state["inflight"] < controller.current and fits()):
+                        if not len(queue) and not state["reading"] and state["inflight"] == 0:
+                            break
+                        cond.wait(timeout=1.0)
+                    if not len(queue):
+                        break
+                    seq, item = queue.peek()
+                    queue.take(seq)
+                    state["inflight"] += 1
+                    state["inflight_bytes"] += item.mem_bytes
+                    state["peak_inflight_bytes"] = max(state["peak_inflight_bytes"], state["inflight_bytes"])
+                pool.submit(worker, item)
+            except KeyboardInterrupt:
+                # 不再派发新 job；在途 job 跑完后正常记入 journal，重跑同一命令即可续跑
+                state["interrupted"] = True
+                print("⏹️ 已中断：不再派发新 job，等待在途 job 完成……", file=sys.stderr)
+
+    if journal:
+        journal.close()
+    elapsed = time.perf_counter() - started
+    mean_completion = sum(completion_times) / len(completion_times) if completion_times else 0.0
+    summary = {
+        "event": "batch_summary",
+        "ok": state["ok"],
+        "failed": state["failed"],
+        "retried": state["retried"],
+        "skipped": state["skipped"],
+        "interrupted": bool(state.get("interrupted")),
+        "elapsed_s": round(elapsed, 3),
+        "mean_completion_s": round(mean_completion, 3),
+        "scheduler": args.scheduler,
+        "peak_inflight_bytes": state["peak_inflight_bytes"],
+        **controller.snapshot(),
+        "concurrency_increases": controller.increases,
+        "concurrency_decreases": controller.decreases,
+    }
+    _record_metrics(args, summary)
+    _emit_event("batch_summary", **{k: v for k, v in summary.items() if k != "event"})
+    print(
+        f"📦 批量{'中断' if state.get('interrupted') else '完成'}：成功 {state['ok']}，失败 {state['failed']}，"
+        f"跳过 {state['skipped']}，限流重试 {state['retried']} 次，"
+        f"耗时 {elapsed:.1f}s，平均完成时间 {mean_completion:.1f}s；"
+        f"并发上限 {controller.current}（{controller.minimum}~{controller.maximum}，"
+        f"升 {controller.increases} 次 / 降 {controller.decreases} 次）"
+    )
+    if state.get("interrupted"):
+        return 130
+    return 0 if state["failed"] == 0 else 1
+
+
+def _parse_grid(specs: List[str]) -> Dict[str, List[str]]:
+    """解析 --grid KEY=V1,V2（或 KEY=@file，每行一个取值，适合含逗号的提示词）。"""
+    grid: Dict[str, List[str]] = {}
+    for spec in specs:
+        key, sep, values = spec.partition("=")
+        key = key.strip().lstrip("-").replace("-", "_")
+        if not sep or not key:
+            raise SystemExit(f"--grid 格式应为 KEY=V1,V2 或 KEY=@file：{spec}")
+        if values.startswith("@"):
+            with open(values[1:], "r", encoding="utf-8") as f:
+                items = [line.strip() for line in f if line.strip()]
+        else:
+            items = [v.strip() for v in values.split(",") if v.strip()]
+        if not items:
+            raise SystemExit(f"--grid {key} 没有取值")
+        grid.setdefault(key, []).extend(items)
+    return grid
+
+
+def _grid_jobs(grid: Dict[str, List[str]]) -> List[Tuple[str, Dict[str, Any]]]:
+    """参数网格的笛卡尔积，每个格子是一个 job。"""
+    keys = list(grid)
+    return [
+        (f"cell{n:03d}", dict(zip(keys, combo)))
+        for n, combo in enumerate(itertools.product(*(grid[k] for k in keys)), start=1)
+    ]
+
+
+def _write_sweep_report(path: str, keys: List[str], jobs: List[Tuple[str, Dict[str, Any]]], results: Dict[str, Dict[str, Any]]) -> str:
+    """结果表：每个格子的参数、状态、耗时与输出文件；.csv 结尾写 CSV，否则写 Markdown 表格。"""
+    header = ["cell", *keys, "status", "latency_s", "outputs"]
+    rows = []
+    for job_id, job in jobs:
+        result = results.get(job_id) or {"status": "not_run"}
+        latency = result.get("latency_s")
+        rows.append([
+            job_id,
+            *(str(job.get(k, "")) for k in keys),
+            str(result.get("status", "")),
+            "" if latency is None else f"{latency:.2f}",
+            " ".join(result.get("outputs") or []),
+        ])
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            csv.writer(f).writerows([header, *rows])
+        else:
+            f.write("| " + " | ".join(header) + " |\n")
+            f.write("|" + "---|" * len(header) + "\n")
+            for row in rows:
+                f.write("| " + " | ".join(c.replace("|", "\\|").replace("\n", " ") for c in row) + " |\n")
+    return path
+
+
+def _run_sweep(args: argparse.Namespace, **batch_kwargs: Any) -> int:
+    """网格/扫参模式：展开 --grid 的笛卡尔积，一次性入队后按预计耗时从低到高并发执行，最后输出结果表。"""
+    grid = _parse_grid(args.grid)
+    jobs = _grid_jobs(grid)
+    print(f"🧮 参数网格：{' × '.join(f'{k}({len(v)})' for k, v in grid.items())} = {len(jobs)} 个格子")
+    results: Dict[str, Dict[str, Any]] = {}
+    code = _run_batch(args, jobs=jobs, preload=True, results=results, **batch_kwargs)
+    report = args.sweep_report or os.path.join(args.out_dir, f"sweep_{_dt.datetime.now().strftime('%Y%m%d_%H%M%S')}.md")
+    _write_sweep_report(report, list(grid), jobs, results)
+    if not report.endswith(".csv"):
+        with open(report, "r", encoding="utf-8") as f:
+            print(f.read(), end="")
+    print(f"📊 结果表：{report}")
+    return code
+
+
+def _run_single(
+    args: argparse.Namespace,
+    run: Callable[[argparse.Namespace], int],
+    *,
+    estimate_cost: Optional[Callable[[argparse.Namespace], Tuple[str, float]]] = None,
+) -> int:
+    """命令行单次模式：与批量模式一样先输出 queued 事件，结束时输出 done 事件，异常时先输出 error 事件再抛出。"""
+    expected_s: Optional[float] = None
+    if estimate_cost is not None and _event_stream is not None:
+        cost_key, prior_s = estimate_cost(args)
+        expected_s = round(_JobStats(os.path.join(args.cache_dir, "job-latency.json")).expected(cost_key, prior_s), 3)
+    _emit_event("queued", priority=_job_priority({}), expected_s=expected_s)
+    started = time.perf_counter()
+    try:
+        with _collect_outputs() as outputs:
+            code = run(args)
+    except BaseException as e:
+        if not isinstance(e, KeyboardInterrupt):
+            _emit_event("error", **_error_event_fields(e))
+        raise
+    _emit_event(
+        "done",
+        status="ok" if code == 0 else f"exit_{code}",
+        latency_s=round(time.perf_counter() - started, 3),
+        outputs=[os.path.abspath(p) for p in outputs],
+    )
+    return code
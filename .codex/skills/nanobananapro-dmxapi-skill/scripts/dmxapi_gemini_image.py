@@ -11,7 +11,12 @@ DMXAPI Gemini/Nano Banana (nanobananapro) 图片调用小工具。
 注意：
   - 该脚本默认请求 DMXAPI 的 v1beta generateContent 端点：
       {base_url}/v1beta/models/{model}:generateContent
+    --stream 时改用 {base_url}/v1beta/models/{model}:streamGenerateContent?alt=sse
   - 认证头默认使用 x-goog-api-key；如遇鉴权问题可切换到 Authorization。
+  - --upload-inputs 会把输入图片上传到 {base_url}/upload/v1beta/files，并按内容哈希
+    记录在本地注册表中，之后的请求改发 file_data 引用，不再重复上传。
+  - --batch 读取 JSON Lines job 批量执行（- 为 stdin 常驻模式），并发按 429/503 与
+    p90 延迟自适应调整（AIMD）。
 """
 
 from __future__ import annotations
@@ -19,31 +24,71 @@ from __future__ import annotations
 import argparse
 import base64
 import datetime as _dt
+import hashlib
 import json
 import os
 import sys
+import time
 import urllib.error
+import urllib.parse
 import urllib.request
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+import uuid
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
+try:  # 可选依赖：仅在 --fit-inputs 需要压缩/缩放输入图片时使用
+    from PIL import Image as _PILImage
+except ImportError:  # pragma: no cover - 未安装 Pillow 时退化为只校验体积
+    _PILImage = None
 
-def _mask_secret(value: str, keep: int = 6) -> str:
-    if not value:
-        return ""
-    if len(value) <= keep:
-        return "*" * len(value)
-    return value[:keep] + "*" * (len(value) - keep)
+from dmxapi_common import (
+    _build_opener,
+    _default_cache_dir,
+    _emit_event,
+    _emit_image_saved,
+    _FIT_MAX_SIDES,
+    _http_status_error,
+    _IMAGE_MIME_BY_EXT,
+    _install_cassette,
+    _iter_batch_jobs,
+    _iter_sse_events,
+    _job_to_argv,
+    _json_dumps_bytes,
+    _json_loads_bytes,
+    _KeyPool,
+    _load_api_keys,
+    _locked_file,
+    _mask_secret,
+    _METRICS,
+    _note_output,
+    _parse_bytes,
+    _rate_limited,
+    _record_metrics,
+    _response_reader,
+    _run_batch,
+    _run_single,
+    _run_sweep,
+    _run_with_key_pool,
+    _run_with_routes,
+    _SHARED_NON_REQUEST_KEYS,
+    _start_event_stream,
+    _start_metrics_export,
+    _start_prewarm,
+)
+
+# Gemini inline_data 请求体上限约 20MB，超过需改用文件引用
+DEFAULT_MAX_REQUEST_BYTES = 20 * 1024 * 1024
+# 并发读取/编码输入图片的线程数上限
+MAX_ENCODE_WORKERS = 8
+# Files API 上传的文件默认保留 48 小时；注册表提前 1 小时视为过期，避免请求途中失效
+FILE_REF_DEFAULT_TTL_S = 48 * 3600
+FILE_REF_EXPIRY_MARGIN_S = 3600
+# 多轮历史中被丢弃的图片用这段文本占位，保证 user/model 轮次交替不被打乱
+HISTORY_IMAGE_PLACEHOLDER = "[较早轮次的图片已省略]"
 
 
 def _guess_mime_type(path: str) -> str:
-    ext = os.path.splitext(path)[1].lower()
-    return {
-        ".jpg": "image/jpeg",
-        ".jpeg": "image/jpeg",
-        ".png": "image/png",
-        ".gif": "image/gif",
-        ".webp": "image/webp",
-    }.get(ext, "image/jpeg")
+    return _IMAGE_MIME_BY_EXT.get(os.path.splitext(path)[1].lower(), "image/jpeg")
 
 
 def _mime_to_ext(mime_type: str) -> str:
@@ -53,11 +98,26 @@ def _mime_to_ext(mime_type: str) -> str:
     return {"jpeg": "jpg"}.get(ext, ext)
 
 
-def _build_endpoint(base_url: str, model: str) -> str:
+def _build_endpoint(base_url: str, model: str, stream: bool = False) -> str:
+    method = "streamGenerateContent?alt=sse" if stream else "generateContent"
     base = base_url.rstrip("/")
     if base.endswith("/v1beta"):
-        return f"{base}/models/{model}:generateContent"
-    return f"{base}/v1beta/models/{model}:generateContent"
+        return f"{base}/models/{model}:{method}"
+    return f"{base}/v1beta/models/{model}:{method}"
+
+
+def _to_stream_endpoint(endpoint: str) -> str:
+    # --endpoint 显式给出 :generateContent 时，流式模式自动切换到 :streamGenerateContent
+    if endpoint.endswith(":generateContent"):
+        return endpoint[: -len(":generateContent")] + ":streamGenerateContent?alt=sse"
+    return endpoint
+
+
+def _build_files_endpoint(base_url: str) -> str:
+    base = base_url.rstrip("/")
+    if base.endswith("/v1beta"):
+        base = base[: -len("/v1beta")]
+    return f"{base}/upload/v1beta/files"
 
 
 def _encode_image_part(path: str) -> Dict[str, Any]:
@@ -72,6 +132,170 @@ def _encode_image_part(path: str) -> Dict[str, Any]:
     }
 
 
+def _file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _b64_len(n: int) -> int:
+    return 4 * ((n + 2) // 3)
+
+
+class _LazyImagePart:
+    """--image 输入的占位符：只记录路径/大小/MIME，真正发送时才读取并 base64 编码。"""
+
+    __slots__ = ("path", "size", "mime_type", "source", "extra", "_sha256")
+
+    def __init__(
+        self,
+        path: str,
+        source: Optional["_LazyImagePart"] = None,
+        extra: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.mime_type = _guess_mime_type(path)
+        # 经 --fit-inputs 压缩后的占位符指回原始输入，缓存键始终基于源图
+        self.source = source or self
+        # 与图片同级的字段（如多轮历史中的 thoughtSignature），发送时原样带上
+        self.extra: Dict[str, Any] = dict(extra or {})
+        self._sha256: Optional[str] = None
+
+    @property
+    def sha256(self) -> str:
+        if self._sha256 is None:
+            self._sha256 = _file_sha256(self.path)
+        return self._sha256
+
+    def encoded_size(self) -> int:
+        return _b64_len(self.size)
+
+    def wire(self, data: str) -> Dict[str, Any]:
+        return {"inline_data": {"mime_type": self.mime_type, "data": data}, **self.extra}
+
+    def describe(self) -> Dict[str, Any]:
+        return self.wire(f"<lazy path={self.path} bytes={self.size} sha256={self.sha256}>")
+
+    def materialize(self) -> Dict[str, Any]:
+        return {**_encode_image_part(self.path), **self.extra}
+
+
+def _map_parts(payload: Dict[str, Any], fn: Any) -> Dict[str, Any]:
+    contents = []
+    for content in payload.get("contents", []) or []:
+        parts = [fn(p) if isinstance(p, _LazyImagePart) else p for p in content.get("parts", []) or []]
+        contents.append({**content, "parts": parts})
+    return {**payload, "contents": contents}
+
+
+def _iter_lazy_parts(payload: Dict[str, Any]) -> Iterable[_LazyImagePart]:
+    for content in payload.get("contents", []) or []:
+        for part in content.get("parts", []) or []:
+            if isinstance(part, _LazyImagePart):
+                yield part
+
+
+def _materialize_payload(payload: Dict[str, Any], executor: Optional[Executor] = None) -> Dict[str, Any]:
+    """把占位符替换为 inline_data；传入 executor 时并发读盘 + base64 编码（多图融合时可显著缩短准备时间）。"""
+    lazy = list({id(p): p for p in _iter_lazy_parts(payload)}.values())
+    if executor is None or len(lazy) < 2:
+        return _map_parts(payload, lambda p: p.materialize())
+    futures = {id(p): executor.submit(p.materialize) for p in lazy}
+    return _map_parts(payload, lambda p: futures[id(p)].result())
+
+
+def _describe_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return _map_parts(payload, lambda p: p.describe())
+
+
+def _estimate_request_bytes(payload: Dict[str, Any]) -> int:
+    # base64 为纯 ASCII，JSON 序列化不会转义，因此“空 data 的请求体 + 各图片 base64 长度”即为精确大小
+    skeleton = _map_parts(payload, lambda p: p.wire(""))
+    body_len = len(_json_dumps_bytes(skeleton))
+    return body_len + sum(p.encoded_size() for p in _iter_lazy_parts(payload))
+
+
+def _fit_image_file(path: str, *, sha256: str, max_side: Optional[int], fmt: str, quality: int, cache_dir: str) -> str:
+    """将输入图片重新编码（可选缩放）为 JPEG/WebP，结果按源图 sha256 + 参数缓存。"""
+    if _PILImage is None:
+        raise SystemExit("--fit-inputs 需要 Pillow：pip install Pillow")
+    os.makedirs(cache_dir, exist_ok=True)
+    with _PILImage.open(path) as im:
+        has_alpha = im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info)
+        # JPEG 不支持透明通道，带 alpha 的输入自动改用 WebP
+        out_fmt = "webp" if fmt == "jpeg" and has_alpha else fmt
+        ext = "jpg" if out_fmt == "jpeg" else out_fmt
+        if max_side and max(im.size) <= max_side:
+            max_side = None
+        cached = os.path.join(cache_dir, f"{sha256}_{max_side or 'orig'}_q{quality}.{ext}")
+        if os.path.isfile(cached):
+            _METRICS.inc("dmxapi_image_cache_hits_total", cache="fit")
+            return cached
+        if max_side:
+            im = im.copy()
+            im.thumbnail((max_side, max_side), _PILImage.LANCZOS)
+        if out_fmt == "jpeg" and im.mode != "RGB":
+            im = im.convert("RGB")
+        elif out_fmt == "webp" and im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if has_alpha else "RGB")
+        tmp = f"{cached}.{os.getpid()}.tmp"
+        im.save(tmp, format=out_fmt.upper(), quality=quality)
+    os.replace(tmp, cached)
+    return cached
+
+
+def _preflight_payload(
+    payload: Dict[str, Any],
+    *,
+    max_bytes: int,
+    fit: bool,
+    fit_format: str,
+    fit_quality: int,
+    cache_dir: str,
+) -> Dict[str, Any]:
+    """发送前校验请求体体积；超出预算时按需压缩/缩放输入图片，仍超出则直接报错。"""
+    size = _estimate_request_bytes(payload)
+    if not max_bytes or size <= max_bytes:
+        return payload
+    if not fit:
+        raise SystemExit(
+            f"请求体约 {size} 字节，超过上限 {max_bytes} 字节；"
+            "可追加 --fit-inputs 自动压缩输入图片，或调大 --max-request-bytes"
+        )
+
+    for max_side in _FIT_MAX_SIDES:
+        # 从最大的图片开始逐张替换，达到预算即停止，尽量少动画质
+        parts = sorted({id(p): p for p in _iter_lazy_parts(payload)}.values(), key=lambda p: p.size, reverse=True)
+        for part in parts:
+            # 带 thoughtSignature 的模型输出图必须原样回传，不参与压缩
+            if part.extra:
+                continue
+            src = part.source
+            new_path = _fit_image_file(
+                src.path,
+                sha256=src.sha256,
+                max_side=max_side,
+                fmt=fit_format,
+                quality=fit_quality,
+                cache_dir=cache_dir,
+            )
+            if os.path.getsize(new_path) >= part.size:
+                continue
+            new_part = _LazyImagePart(new_path, source=src)
+            payload = _map_parts(payload, lambda p, old=part: new_part if p is old else p)
+            size = _estimate_request_bytes(payload)
+            print(f"🗜️ 已压缩输入图片：{src.path} -> {new_path}（{src.size} -> {new_part.size} 字节）")
+            if size <= max_bytes:
+                return payload
+    raise SystemExit(f"压缩后请求体仍约 {size} 字节，超过上限 {max_bytes} 字节")
+
+
 def _iter_parts(result: Dict[str, Any]) -> Iterable[Dict[str, Any]]:
     for candidate in result.get("candidates", []) or []:
         content = candidate.get("content") or {}
@@ -124,7 +348,7 @@ def _save_image_bytes(
     path = os.path.join(out_dir, filename)
     with open(path, "wb") as f:
         f.write(raw_bytes)
-    return path
+    return _note_output(path)
 
 
 def _save_text_file(*, out_dir: str, filename: str, text: str) -> str:
@@ -132,38 +356,589 @@ def _save_text_file(*, out_dir: str, filename: str, text: str) -> str:
     path = os.path.join(out_dir, filename)
     with open(path, "w", encoding="utf-8") as f:
         f.write(text)
-    return path
+    return _note_output(path)
 
 
-def _http_post_json(url: str, headers: Dict[str, str], payload: Dict[str, Any], timeout_s: int) -> Dict[str, Any]:
-    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+def _http_post_json(
+    url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    timeout_s: int,
+    opener: Optional[urllib.request.OpenerDirector] = None,
+) -> Dict[str, Any]:
+    body = _json_dumps_bytes(payload)
+    return _http_post_bytes(url, headers, body, timeout_s, opener=opener)
+
+
+def _http_post_bytes(
+    url: str,
+    headers: Dict[str, str],
+    body: bytes,
+    timeout_s: int,
+    opener: Optional[urllib.request.OpenerDirector] = None,
+) -> Dict[str, Any]:
     req = urllib.request.Request(url=url, data=body, headers=headers, method="POST")
+    urlopen = opener.open if opener is not None else urllib.request.urlopen
+    sent = time.perf_counter()
+    _emit_event("sent", url=url, bytes=len(body))
+    _METRICS.inc("dmxapi_image_transfer_bytes_total", len(body), direction="upload")
     try:
-        with urllib.request.urlopen(req, timeout=timeout_s) as resp:
-            raw = resp.read()
+        with urlopen(req, timeout=timeout_s) as resp:
+            body_reader = _response_reader(resp)
+            _emit_event(
+                "first_byte",
+                status=resp.status,
+                ttfb_s=round(time.perf_counter() - sent, 3),
+                encoding=resp.headers.get("Content-Encoding"),
+            )
+            raw = body_reader.read()
             try:
-                return json.loads(raw.decode("utf-8"))
+                return _json_loads_bytes(raw)
             except Exception:
                 raise RuntimeError(f"响应不是合法 JSON，原始内容：\n{raw[:800].decode('utf-8', errors='replace')}")
     except urllib.error.HTTPError as e:
-        raw = e.read()
-        raise RuntimeError(
-            "HTTP 请求失败："
-            f"status={getattr(e, 'code', 'unknown')} url={url}\n"
-            f"响应片段：\n{raw[:1200].decode('utf-8', errors='replace')}"
-        ) from e
+        raise _http_status_error(e, url) from e
     except urllib.error.URLError as e:
         raise RuntimeError(f"网络错误：{e}") from e
 
 
-def main(argv: List[str]) -> int:
+def _parse_expiration(value: Any) -> Optional[float]:
+    # 例：2025-01-01T12:00:00.123456789Z；只取到秒，避免纳秒精度解析失败
+    if not isinstance(value, str) or len(value) < 19:
+        return None
+    try:
+        parsed = _dt.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+    return parsed.replace(tzinfo=_dt.timezone.utc).timestamp()
+
+
+def _file_registry_scope(files_endpoint: str, api_key: str) -> str:
+    # 上传的文件只对同一端点 + 同一 Key 可见，注册表按二者分区
+    key_fp = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+    return f"{files_endpoint}#{key_fp}"
+
+
+def _load_file_registry(path: str) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _update_file_registry(path: str, scope: str, entries: Dict[str, Dict[str, Any]]) -> None:
+    # 读取-合并-写回整体加文件锁，多个进程同时上传时不会互相覆盖条目；顺带清理过期记录
+    with _locked_file(path + ".lock"):
+        data = _load_file_registry(path)
+        data.setdefault(scope, {}).update(entries)
+        now = time.time()
+        for scoped in data.values():
+            for sha in [k for k, v in scoped.items() if v.get("expires_at", 0) <= now]:
+                del scoped[sha]
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+
+def _lookup_file_ref(registry: Dict[str, Dict[str, Dict[str, Any]]], scope: str, sha256: str) -> Optional[Dict[str, Any]]:
+    entry = registry.get(scope, {}).get(sha256)
+    if not isinstance(entry, dict) or not entry.get("uri"):
+        return None
+    if entry.get("expires_at", 0) - FILE_REF_EXPIRY_MARGIN_S <= time.time():
+        return None
+    return entry
+
+
+def _upload_file(
+    files_endpoint: str,
+    headers: Dict[str, str],
+    part: _LazyImagePart,
+    timeout_s: int,
+) -> Dict[str, Any]:
+    """按 Files API 的 multipart 协议上传一张图片，返回注册表条目。"""
+    boundary = f"dmxapi-gemini-{uuid.uuid4().hex}"
+    metadata = {"file": {"display_name": os.path.basename(part.source.path)}}
+    with open(part.path, "rb") as f:
+        raw = f.read()
+    body = b"".join(
+        [
+            f"--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n".encode("utf-8"),
+            json.dumps(metadata, ensure_ascii=False).encode("utf-8"),
+            f"\r\n--{boundary}\r\nContent-Type: {part.mime_type}\r\n\r\n".encode("utf-8"),
+            raw,
+            f"\r\n--{boundary}--\r\n".encode("utf-8"),
+        ]
+    )
+    req_headers = {
+        **{k: v for k, v in headers.items() if k.lower() != "content-type"},
+        "Content-Type": f"multipart/related; boundary={boundary}",
+        "X-Goog-Upload-Protocol": "multipart",
+    }
+    result = _http_post_bytes(f"{files_endpoint}?uploadType=multipart", req_headers, body, timeout_s)
+    file_info = result.get("file") if isinstance(result.get("file"), dict) else result
+    uri = file_info.get("uri") if isinstance(file_info, dict) else None
+    if not isinstance(uri, str) or not uri:
+        raise RuntimeError(f"上传成功但响应中没有 file.uri：{json.dumps(result, ensure_ascii=False)[:800]}")
+    now = time.time()
+    return {
+        "uri": uri,
+        "mime_type": file_info.get("mimeType") or part.mime_type,
+        "bytes": part.size,
+        "uploaded_at": now,
+        "expires_at": _parse_expiration(file_info.get("expirationTime")) or now + FILE_REF_DEFAULT_TTL_S,
+    }
+
+
+def _file_ref_part(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return {"file_data": {"mime_type": entry["mime_type"], "file_uri": entry["uri"]}}
+
+
+def _apply_file_refs(
+    payload: Dict[str, Any],
+    *,
+    registry_path: str,
+    scope: str,
+    upload: Optional[Callable[[_LazyImagePart], Dict[str, Any]]],
+    executor: Optional[Executor] = None,
+    select: Optional[Callable[[_LazyImagePart], bool]] = None,
+) -> Dict[str, Any]:
+    """把输入图片替换为 file_data 引用：注册表命中直接复用，未命中且允许上传时上传一次并登记。
+
+    select 用于只引用部分图片（例如多轮历史中较早的图片），默认处理全部图片。
+    """
+    registry = _load_file_registry(registry_path)
+    refs: Dict[int, Dict[str, Any]] = {}
+    misses: Dict[str, _LazyImagePart] = {}
+    for part in _iter_lazy_parts(payload):
+        if select is not None and not select(part):
+            continue
+        entry = _lookup_file_ref(registry, scope, part.sha256)
+        if entry is not None:
+            refs[id(part)] = entry
+            _METRICS.inc("dmxapi_image_cache_hits_total", cache="file_registry")
+        elif upload is not None:
+            misses.setdefault(part.sha256, part)
+
+    if misses:
+        if executor is not None and len(misses) > 1:
+            uploaded = dict(zip(misses, executor.map(upload, misses.values())))
+        else:
+            uploaded = {sha: upload(part) for sha, part in misses.items()}
+        _update_file_registry(registry_path, scope, uploaded)
+        for sha, entry in uploaded.items():
+            print(f"☁️ 已上传输入图片：{misses[sha].source.path} -> {entry['uri']}")
+        for part in _iter_lazy_parts(payload):
+            if (select is None or select(part)) and part.sha256 in uploaded:
+                refs[id(part)] = uploaded[part.sha256]
+
+    return _map_parts(payload, lambda p: {**_file_ref_part(refs[id(p)]), **p.extra} if id(p) in refs else p)
+
+
+def _is_image_part(part: Any) -> bool:
+    if isinstance(part, _LazyImagePart):
+        return True
+    return isinstance(part, dict) and any(k in part for k in ("inline_data", "inlineData", "file_data", "fileData"))
+
+
+def _session_entry_problem(content: Any) -> Optional[str]:
+    """校验会话历史中的一轮对话，返回问题描述；合法时返回 None。"""
+    if not isinstance(content, dict):
+        return "不是对象"
+    if not isinstance(content.get("role", "user"), str):
+        return "的 role 不是字符串"
+    parts = content.get("parts", [])
+    if parts is not None and not isinstance(parts, list):
+        return "的 parts 不是列表"
+    for j, part in enumerate(parts or []):
+        if not isinstance(part, dict):
+            return f"的 parts[{j}] 不是对象"
+        if "image_file" in part and not isinstance(part["image_file"], str):
+            return f"的 parts[{j}].image_file 不是字符串"
+    return None
+
+
+def _load_session(path: str) -> List[Dict[str, Any]]:
+    """读取多轮会话历史；图片以文件路径保存，加载为占位符，发送时才编码。"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return []
+    except ValueError as e:
+        raise SystemExit(f"会话文件不是合法 JSON：{path}（{e}）；请修复或删除该文件后重试")
+    if not isinstance(data, dict) or not isinstance(data.get("contents", []), list):
+        raise SystemExit(f"会话文件格式不正确：{path}（缺少 contents 列表）；请修复或删除该文件后重试")
+    contents: List[Dict[str, Any]] = []
+    for i, content in enumerate(data.get("contents", []) or []):
+        problem = _session_entry_problem(content)
+        if problem:
+            raise SystemExit(f"会话文件格式不正确：{path}（contents[{i}] {problem}）；请修复或删除该文件后重试")
+        parts: List[Any] = []
+        for part in content.get("parts", []) or []:
+            if "image_file" in part:
+                extra = {k: v for k, v in part.items() if k not in ("image_file", "mime_type")}
+                if not os.path.isfile(part["image_file"]):
+                    print(f"⚠️ 会话中的图片已不存在，按已省略处理：{part['image_file']}")
+                    continue
+                parts.append(_LazyImagePart(part["image_file"], extra=extra))
+            else:
+                parts.append(part)
+        contents.append({"role": content.get("role", "user"), "parts": parts or [{"text": HISTORY_IMAGE_PLACEHOLDER}]})
+    return contents
+
+
+def _session_part(part: Any) -> Any:
+    if isinstance(part, _LazyImagePart):
+        return {"image_file": os.path.abspath(part.source.path), "mime_type": part.mime_type, **part.extra}
+    return part
+
+
+def _save_session(path: str, contents: List[Dict[str, Any]]) -> None:
+    data = {
+        "version": 1,
+        "contents": [{"role": c["role"], "parts": [_session_part(p) for p in c["parts"]]} for c in contents],
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _drop_images(content: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    # 图片与其 thoughtSignature 在同一个 part 上，整 part 丢弃，签名不会错配到别的 part
+    kept = [p for p in content["parts"] if not _is_image_part(p)]
+    dropped = len(content["parts"]) - len(kept)
+    return {**content, "parts": kept or [{"text": HISTORY_IMAGE_PLACEHOLDER}]}, dropped
+
+
+def _compact_history(
+    contents: List[Dict[str, Any]],
+    *,
+    keep_image_turns: int,
+    old_images: str,
+) -> Tuple[List[Dict[str, Any]], List[_LazyImagePart], int]:
+    """多轮历史压缩：只保留最近 N 个含图轮次的图片，更早的图片改为文件引用或直接丢弃（保留文本）。
+
+    最后一个 model 轮次（其签名会被严格校验）与当前 user 轮次始终原样保留。
+    返回 (新 contents, 需改为文件引用的图片, 丢弃的图片数)。
+    """
+    protected = {len(contents) - 1}
+    model_turns = [i for i, c in enumerate(contents) if c.get("role") == "model"]
+    if model_turns:
+        protected.add(model_turns[-1])
+    image_turns = [i for i, c in enumerate(contents) if any(_is_image_part(p) for p in c["parts"])]
+    old_turns = image_turns[:-keep_image_turns] if keep_image_turns > 0 else image_turns
+
+    contents = list(contents)
+    to_reference: List[_LazyImagePart] = []
+    dropped = 0
+    for i in old_turns:
+        if i in protected:
+            continue
+        if old_images == "reference":
+            to_reference.extend(p for p in contents[i]["parts"] if isinstance(p, _LazyImagePart))
+        else:
+            contents[i], n = _drop_images(contents[i])
+            dropped += n
+    return contents, to_reference, dropped
+
+
+def _enforce_history_budget(payload: Dict[str, Any], *, max_bytes: int) -> Tuple[Dict[str, Any], int]:
+    """请求体仍超预算时，从最早的轮次开始继续丢弃历史图片，直到满足预算或只剩受保护轮次。"""
+    contents = list(payload["contents"])
+    protected = {len(contents) - 1}
+    model_turns = [i for i, c in enumerate(contents) if c.get("role") == "model"]
+    if model_turns:
+        protected.add(model_turns[-1])
+    dropped = 0
+    for i in range(len(contents)):
+        if _estimate_request_bytes({**payload, "contents": contents}) <= max_bytes:
+            break
+        if i in protected or not any(_is_image_part(p) for p in contents[i]["parts"]):
+            continue
+        contents[i], n = _drop_images(contents[i])
+        dropped += n
+    return {**payload, "contents": contents}, dropped
+
+
+def _http_post_sse(
+    url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    timeout_s: int,
+    opener: Optional[urllib.request.OpenerDirector] = None,
+) -> Iterable[Dict[str, Any]]:
+    body = _json_dumps_bytes(payload)
+    req = urllib.request.Request(url=url, data=body, headers={**headers, "Accept": "text/event-stream"}, method="POST")
+    urlopen = opener.open if opener is not None else urllib.request.urlopen
+    sent = time.perf_counter()
+    _emit_event("sent", url=url, bytes=len(body), stream=True)
+    _METRICS.inc("dmxapi_image_transfer_bytes_total", len(body), direction="upload")
+    try:
+        with urlopen(req, timeout=timeout_s) as resp:
+            body_reader = _response_reader(resp)
+            _emit_event(
+                "first_byte",
+                status=resp.status,
+                ttfb_s=round(time.perf_counter() - sent, 3),
+                encoding=resp.headers.get("Content-Encoding"),
+            )
+            for _event, data in _iter_sse_events(body_reader):
+                try:
+                    chunk = _json_loads_bytes(data)
+                except ValueError:
+                    raise RuntimeError(f"SSE 分片不是合法 JSON：\n{data[:800]}")
+                if isinstance(chunk, dict):
+                    if chunk.get("error"):
+                        raise RuntimeError(f"流式返回错误：{json.dumps(chunk, ensure_ascii=False)[:1200]}")
+                    yield chunk
+    except urllib.error.HTTPError as e:
+        raise _http_status_error(e, url) from e
+    except urllib.error.URLError as e:
+        raise RuntimeError(f"网络错误：{e}") from e
+
+
+class _ResponseWriter:
+    """逐个处理响应 part：图片即时落盘、文本即时打印，并收集多轮会话需要的模型 part。
+
+    流式模式下文本会被拆成多个分片；以 data:image/ 开头的文本先缓冲，
+    直到遇到非文本 part 或流结束再整体解析，避免把被截断的 data URL 当成普通文本。
+    """
+
+    def __init__(self, args: argparse.Namespace, *, streaming: bool = False) -> None:
+        self.args = args
+        self.streaming = streaming
+        self.saved_any = False
+        self.image_index = 0
+        # 多轮会话记录的模型轮次：图片落盘后以路径 + thoughtSignature 保存，文本等 part 原样保存
+        self.model_parts: List[Any] = []
+        self.last_result: Any = None
+        self.first_chunk_s: Optional[float] = None
+        self.first_image_s: Optional[float] = None
+        self._started = time.perf_counter()
+        self._pending_text: List[str] = []
+        self._printed_fragment = False
+
+    def handle(self, part: Dict[str, Any]) -> None:
+        text = part.get("text")
+        is_plain_text = isinstance(text, str) and set(part) <= {"text"}
+        if self._pending_text and not is_plain_text:
+            self._flush_text()
+        if is_plain_text and self.streaming:
+            if self._pending_text or text.lstrip().startswith("data:image/"):
+                self._pending_text.append(text)
+                return
+
+        inline_blob = _extract_inline_blob(part)
+        if inline_blob is not None:
+            mime_type, b64, signature = inline_blob
+            self._save_inline(mime_type, b64, signature)
+            return
+
+        if isinstance(text, str):
+            if self._save_data_url(text):
+                return
+            self._print_text(text)
+
+        file_data = part.get("fileData")
+        if isinstance(file_data, dict) and file_data.get("fileUri"):
+            print(f"🔗 fileUri: {file_data.get('fileUri')}")
+        self._append_model_part(part)
+
+    def finish(self) -> None:
+        if self._pending_text:
+            self._flush_text()
+        if self._printed_fragment:
+            print()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+    def metrics(self) -> Dict[str, Any]:
+        def rounded(v: Optional[float]) -> Optional[float]:
+            return None if v is None else round(v, 3)
+
+        return {
+            "latency_s": round(self.elapsed(), 3),
+            "time_to_first_chunk_s": rounded(self.first_chunk_s),
+            "time_to_first_image_s": rounded(self.first_image_s),
+            "images": self.image_index,
+        }
+
+    def _flush_text(self) -> None:
+        text = "".join(self._pending_text)
+        self._pending_text = []
+        if not self._save_data_url(text):
+            self._print_text(text)
+            self._append_model_part({"text": text})
+
+    def _print_text(self, text: str) -> None:
+        # 普通文本：打印到 stdout，避免吞掉关键信息；流式分片不换行拼接
+        _emit_event("text", text=text, delta=self.streaming)
+        if self.streaming:
+            if text:
+                print(text, end="", flush=True)
+                self._printed_fragment = True
+        else:
+            print(text)
+
+    def _append_model_part(self, part: Dict[str, Any]) -> None:
+        last = self.model_parts[-1] if self.model_parts else None
+        if self.streaming and isinstance(last, dict) and set(last) == {"text"} and set(part) == {"text"}:
+            self.model_parts[-1] = {"text": last["text"] + part["text"]}
+            return
+        self.model_parts.append(part)
+
+    def _mark_image_saved(self) -> None:
+        if self._printed_fragment:
+            print()
+            self._printed_fragment = False
+        if self.first_image_s is None:
+            self.first_image_s = self.elapsed()
+        self.saved_any = True
+        self.image_index += 1
+
+    def _save_inline(self, mime_type: str, b64: str, signature: Optional[str]) -> None:
+        args = self.args
+        raw = base64.b64decode(b64)
+        path = _save_image_bytes(
+            out_dir=args.out_dir,
+            prefix=args.prefix,
+            mime_type=mime_type,
+            raw_bytes=raw,
+            index=self.image_index,
+        )
+        self._mark_image_saved()
+        print(f"✅ 已保存图片：{path}")
+        _emit_image_saved(path, mime_type, raw)
+
+        if args.save_base64:
+            b64_path = _save_text_file(
+                out_dir=args.out_dir,
+                filename=f"{os.path.basename(path)}.b64.txt",
+                text=b64,
+            )
+            print(f"🧾 已保存 base64：{b64_path}")
+
+        if args.save_signature and signature:
+            sig_path = _save_text_file(
+                out_dir=args.out_dir,
+                filename=f"{os.path.basename(path)}.signature.txt",
+                text=signature,
+            )
+            print(f"🧾 已保存 thoughtSignature：{sig_path}")
+
+        self.model_parts.append(_LazyImagePart(path, extra={"thoughtSignature": signature} if signature else None))
+
+    def _save_data_url(self, text: str) -> bool:
+        data_url_blob = _extract_data_url_blob(text.strip())
+        if data_url_blob is None:
+            return False
+        mime_type, b64 = data_url_blob
+        raw = base64.b64decode(b64)
+        path = _save_image_bytes(
+            out_dir=self.args.out_dir,
+            prefix=self.args.prefix,
+            mime_type=mime_type,
+            raw_bytes=raw,
+            index=self.image_index,
+        )
+        self._mark_image_saved()
+        print(f"✅ 已保存图片（data URL）：{path}")
+        _emit_image_saved(path, mime_type, raw)
+        self.model_parts.append(_LazyImagePart(path))
+        return True
+
+
+def _build_auth_headers(api_key: str, auth_header: str) -> Dict[str, str]:
+    headers: Dict[str, str] = {"Content-Type": "application/json"}
+    if api_key:
+        if auth_header == "x-goog-api-key":
+            headers["x-goog-api-key"] = api_key
+        elif auth_header == "authorization":
+            headers["Authorization"] = api_key
+        elif auth_header == "authorization-bearer":
+            headers["Authorization"] = f"Bearer {api_key}"
+    return headers
+
+
+def generate_image_bytes(
+    *,
+    prompt: str,
+    api_key: str,
+    images: Iterable[Tuple[str, bytes]] = (),
+    history: Optional[List[Dict[str, Any]]] = None,
+    base_url: str = "https://www.dmxapi.cn",
+    model: str = "gemini-3-pro-image-preview",
+    auth_header: str = "x-goog-api-key",
+    aspect_ratio: str = "",
+    image_size: str = "",
+    response_modalities: Iterable[str] = ("IMAGE",),
+    timeout_s: int = 300,
+) -> Dict[str, Any]:
+    """内存版 generateContent（供流水线等调用方导入）：输入/输出图片均为 (mime_type, bytes)，不读写磁盘。
+
+    返回 {"images": [(mime_type, bytes), ...], "text": str, "contents": 含本轮在内的多轮历史}；
+    把 contents 作为下一次的 history 传回即可继续多轮编辑，模型返回的图片以原始 base64 留在历史中，不会被重复解码/编码。
+    """
+    parts: List[Dict[str, Any]] = [{"text": prompt}]
+    for mime_type, raw in images:
+        parts.append({"inline_data": {"mime_type": mime_type, "data": base64.b64encode(raw).decode("ascii")}})
+    contents = list(history or []) + [{"role": "user", "parts": parts}]
+    payload: Dict[str, Any] = {"model": model, "contents": contents}
+    generation_config: Dict[str, Any] = {}
+    modalities = [m.strip().upper() for m in response_modalities if m.strip()]
+    if modalities:
+        generation_config["responseModalities"] = modalities
+    image_config = {k: v for k, v in (("aspectRatio", aspect_ratio), ("imageSize", image_size)) if v}
+    if image_config:
+        generation_config["imageConfig"] = image_config
+    if generation_config:
+        payload["generationConfig"] = generation_config
+
+    result = _http_post_json(_build_endpoint(base_url, model), _build_auth_headers(api_key, auth_header), payload, timeout_s)
+    out_images: List[Tuple[str, bytes]] = []
+    texts: List[str] = []
+    model_parts = list(_iter_parts(result))
+    for part in model_parts:
+        blob = _extract_inline_blob(part)
+        if blob is not None:
+            out_images.append((blob[0], base64.b64decode(blob[1])))
+            continue
+        text = part.get("text")
+        if isinstance(text, str):
+            data_url = _extract_data_url_blob(text.strip())
+            if data_url is not None:
+                out_images.append((data_url[0], base64.b64decode(data_url[1])))
+            elif not part.get("thought"):
+                texts.append(text)
+    return {
+        "images": out_images,
+        "text": "".join(texts).strip(),
+        "contents": contents + [{"role": "model", "parts": model_parts}],
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="调用 DMXAPI Gemini generateContent 并保存返回图片。")
-    parser.add_argument("--api-key", default=os.environ.get("DMXAPI_API_KEY", ""), help="DMXAPI API Key（也可用环境变量 DMXAPI_API_KEY）")
+    parser.add_argument("--api-key", default=os.environ.get("DMXAPI_API_KEY", ""), help="DMXAPI API Key，多个用逗号分隔（也可用环境变量 DMXAPI_API_KEY）")
+    parser.add_argument("--fallback-base-url", action="append", default=[], help="备用 base URL（可重复）；主线路熔断或变慢时自动切换")
+    parser.add_argument("--fallback-model", action="append", default=[], help="备用模型（可重复），主模型所有线路都熔断时使用")
+    parser.add_argument("--breaker-failures", type=int, default=3, help="线路连续失败多少次后熔断")
+    parser.add_argument("--breaker-cooldown-s", type=float, default=60, help="熔断后的冷却秒数，之后放行一个探测请求")
+    parser.add_argument("--route-state", default="", help="线路熔断/延迟状态文件（默认 {cache_dir}/routes.json，多进程共享）")
+    parser.add_argument("--api-keys-file", default=os.environ.get("DMXAPI_API_KEYS_FILE", ""), help="API Key 池文件：每行 `KEY [rpm=N] [concurrent=N]`，与 --api-key（可逗号分隔多个）合并")
+    parser.add_argument("--key-strategy", choices=["least-loaded", "round-robin"], default="least-loaded", help="多个 Key 时的分配策略")
+    parser.add_argument("--key-bench-s", type=float, default=600, help="Key 鉴权失败（401/403）后暂停使用的秒数；429 按 Retry-After 暂停")
     parser.add_argument("--base-url", default=os.environ.get("DMXAPI_BASE_URL", "https://www.dmxapi.cn"), help="DMXAPI 基础地址")
     parser.add_argument("--endpoint", default="", help="完整端点（优先级高于 base-url+model 组合）")
     parser.add_argument("--model", default="gemini-3-pro-image-preview", help="模型名（用于拼接端点）")
     parser.add_argument("--auth-header", choices=["x-goog-api-key", "authorization", "authorization-bearer"], default="x-goog-api-key")
-    parser.add_argument("--prompt", required=True, help="提示词")
+    parser.add_argument("--prompt", default="", help="提示词（非批量模式必填）")
     parser.add_argument("--image", action="append", default=[], help="输入图片路径（可重复传多张，用于编辑/融合）")
     parser.add_argument("--response-modalities", default="IMAGE", help="如 IMAGE 或 TEXT,IMAGE（留空用 --no-response-modalities）")
     parser.add_argument("--no-response-modalities", action="store_true", help="不在 generationConfig 中发送 responseModalities")
@@ -175,30 +950,97 @@ def main(argv: List[str]) -> int:
     parser.add_argument("--save-base64", action="store_true", help="同时保存返回的 base64 数据到 .b64.txt")
     parser.add_argument("--save-signature", action="store_true", help="同时保存 thoughtSignature 到 .signature.txt（若返回）")
     parser.add_argument("--dry-run", action="store_true", help="仅打印将发送的请求，不实际调用接口")
-    args = parser.parse_args(argv)
+    parser.add_argument("--stream", action="store_true", help="改用 :streamGenerateContent?alt=sse，文本即时打印、图片随到随存")
+    parser.add_argument("--metrics-file", default="", help="追加每次请求的耗时记录（JSON Lines），为空则不记录")
+    parser.add_argument(
+        "--prom-textfile",
+        default="",
+        help="以 Prometheus 文本格式写出聚合指标（请求数、延迟直方图、流量、重试、缓存命中），供 node_exporter textfile collector 采集",
+    )
+    parser.add_argument("--prom-port", type=int, default=None, help="在 127.0.0.1:PORT/metrics 暴露聚合指标（适合 --batch - 常驻模式）")
+    parser.add_argument("--cassette", default="", help="录制/回放上游交互的目录（离线性能回归用，回放时不发真实请求）")
+    parser.add_argument("--cassette-mode", default="replay", choices=["record", "replay"], help="--cassette 的模式")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="回放加速倍数：1 按录制耗时，10 为十倍速，0 为不等待")
+    parser.add_argument(
+        "--compressed",
+        action="store_true",
+        help="请求 gzip/deflate 压缩响应（Accept-Encoding），边收边解压；base64 图片响应传输量约减少 1/4",
+    )
+    parser.add_argument(
+        "--output",
+        default="text",
+        choices=["text", "ndjson"],
+        help="ndjson：stdout 每行一个 JSON 事件（queued/sent/first_byte/image_saved/text/error/done），人读信息改走 stderr",
+    )
+    parser.add_argument("--rate-limit-rpm", type=float, default=float(os.environ.get("DMXAPI_RATE_LIMIT_RPM") or 0), help="每个 host+模型每分钟最多请求数，跨进程共享（0 表示不限）")
+    parser.add_argument("--rate-limit-burst", type=int, default=1, help="令牌桶容量（允许的瞬时突发请求数）")
+    parser.add_argument("--max-concurrent", type=int, default=int(os.environ.get("DMXAPI_MAX_CONCURRENT") or 0), help="每个 host+模型同时在途请求上限，跨进程共享（0 表示不限）")
+    parser.add_argument("--rate-limit-dir", default="", help="限流状态目录（默认 {cache_dir}/ratelimit；多个进程需指向同一目录）")
+    parser.add_argument("--max-request-bytes", type=int, default=DEFAULT_MAX_REQUEST_BYTES, help="请求体字节上限，发送前校验（0 表示不限制）")
+    parser.add_argument("--fit-inputs", action="store_true", help="超出上限时用 Pillow 重新编码/缩放输入图片（需安装 Pillow）")
+    parser.add_argument("--fit-format", choices=["jpeg", "webp"], default="jpeg", help="--fit-inputs 的目标格式（带透明通道的图自动用 webp）")
+    parser.add_argument("--fit-quality", type=int, default=90, help="--fit-inputs 的编码质量")
+    parser.add_argument("--cache-dir", default=_default_cache_dir(), help="压缩结果、文件引用注册表等本地缓存目录")
+    parser.add_argument("--upload-inputs", action="store_true", help="文件引用模式：输入图片按内容哈希只上传一次，请求中改发 file_data")
+    parser.add_argument("--files-endpoint", default="", help="文件上传端点（默认 {base_url}/upload/v1beta/files）")
+    parser.add_argument("--file-registry", default="", help="文件引用注册表路径（默认 {cache_dir}/gemini-files.json）")
+    parser.add_argument("--session", default="", help="多轮编辑会话文件（JSON）：自动带上历史轮次，成功后追加本轮与模型返回")
+    parser.add_argument("--history-keep-images", type=int, default=4, help="多轮历史中保留图片的最近轮次数（0 表示只保留受保护轮次）")
+    parser.add_argument("--history-old-images", choices=["drop", "reference"], default="drop", help="更早轮次的图片：drop 丢弃（保留文本）/ reference 改为文件引用")
+    parser.add_argument("--history-max-bytes", type=int, default=0, help="多轮历史的请求体预算（0 表示沿用 --max-request-bytes）")
+    parser.add_argument("--batch", default="", help="批量模式：JSON Lines job 文件，每行的键对应命令行参数（如 prompt/image/aspect_ratio）；- 表示从 stdin 常驻读取")
+    parser.add_argument("--concurrency", type=int, default=4, help="批量模式初始并发")
+    parser.add_argument("--min-concurrency", type=int, default=1, help="批量模式自适应并发下限")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="批量模式自适应并发上限")
+    parser.add_argument("--concurrency-mode", choices=["aimd", "fixed"], default="aimd", help="aimd：按 429/503 与 p90 延迟自动调整并发；fixed：固定为 --concurrency")
+    parser.add_argument("--dedupe", choices=["link", "copy", "off"], default="link", help="批量模式中同时在途的相同请求只发一次，其余 job 以硬链接（link）或副本（copy）获得输出")
+    parser.add_argument("--scheduler", choices=["sjf", "fifo"], default="sjf", help="批量模式派发顺序：sjf 按 priority 类别 + 预计耗时最短优先；fifo 按到达顺序")
+    parser.add_argument("--aging-rate", type=float, default=0.5, help="sjf 老化速率：每等待 1 秒抵扣多少秒预计耗时")
+    parser.add_argument("--max-wait-s", type=float, default=300, help="sjf 防饿死上限：排队超过该秒数的 job 最先派发")
+    parser.add_argument("--max-inflight-bytes", type=_parse_bytes, default=0, help="批量模式在途 job 预估内存峰值之和的上限，如 2G、512M（0 表示不限）")
+    parser.add_argument("--grid", action="append", default=[], help="扫参模式：KEY=V1,V2（可重复，KEY=@file 每行一个取值），展开笛卡尔积并发执行")
+    parser.add_argument("--sweep-report", default="", help="扫参结果表路径（.md 或 .csv，默认 {out_dir}/sweep_<时间>.md）")
+    parser.add_argument("--journal", default="", help="批量模式的 job 状态日志（JSON Lines，只追加）；中断后用同一文件重跑会跳过已完成的 job")
+    parser.add_argument("--batch-retries", type=int, default=2, help="批量模式中被 429/503 限流的 job 重新排队的次数上限")
+    return parser
 
-    endpoint = args.endpoint or _build_endpoint(args.base_url, args.model)
 
-    headers: Dict[str, str] = {"Content-Type": "application/json"}
-    if args.api_key:
-        if args.auth_header == "x-goog-api-key":
-            headers["x-goog-api-key"] = args.api_key
-        elif args.auth_header == "authorization":
-            headers["Authorization"] = args.api_key
-        elif args.auth_header == "authorization-bearer":
-            headers["Authorization"] = f"Bearer {args.api_key}"
-
-    parts: List[Dict[str, Any]] = [{"text": args.prompt}]
+def run_job(args: argparse.Namespace) -> int:
+    """执行单次 generateContent 调用（命令行单次模式与批量模式共用）。"""
+    if args.endpoint:
+        endpoint = _to_stream_endpoint(args.endpoint) if args.stream else args.endpoint
+    else:
+        endpoint = _build_endpoint(args.base_url, args.model, stream=args.stream)
+
+    headers = _build_auth_headers(args.api_key, args.auth_header)
+    if args.compressed:
+        headers["Accept-Encoding"] = "gzip, deflate"
+
+    # 图片先以占位符进入 payload，dry-run/校验/估算体积都不读取图片内容
+    parts: List[Any] = [{"text": args.prompt}]
     for img_path in args.image:
-        if not os.path.exists(img_path):
+        if not os.path.isfile(img_path):
             raise SystemExit(f"找不到图片文件：{img_path}")
-        parts.append(_encode_image_part(img_path))
+        parts.append(_LazyImagePart(img_path))
 
     payload: Dict[str, Any] = {
         "model": args.model,
         "contents": [{"parts": parts}],
     }
 
+    history: List[Dict[str, Any]] = []
+    to_reference: List[_LazyImagePart] = []
+    if args.session:
+        history = _load_session(args.session)
+        contents, to_reference, dropped = _compact_history(
+            history + [{"role": "user", "parts": parts}],
+            keep_image_turns=args.history_keep_images,
+            old_images=args.history_old_images,
+        )
+        payload["contents"] = contents
+        if dropped:
+            print(f"🧹 历史压缩：已省略 {dropped} 张较早轮次的图片")
+
     generation_config: Dict[str, Any] = {}
     if not args.no_response_modalities:
         modalities = [m.strip().upper() for m in args.response_modalities.split(",") if m.strip()]
@@ -214,6 +1056,44 @@ def main(argv: List[str]) -> int:
     if generation_config:
         payload["generationConfig"] = generation_config
 
+    if args.upload_inputs or to_reference:
+        if not args.api_key and not args.dry_run:
+            raise SystemExit("缺少 API Key：请传 --api-key 或设置环境变量 DMXAPI_API_KEY")
+        files_endpoint = args.files_endpoint or _build_files_endpoint(args.base_url)
+        # dry-run 只复用注册表中已有的引用，不实际上传
+        upload: Optional[Callable[[_LazyImagePart], Dict[str, Any]]] = None
+        if not args.dry_run:
+
+            def upload(part: _LazyImagePart) -> Dict[str, Any]:
+                with _rate_limited(args, urllib.parse.urlsplit(files_endpoint).netloc, "files"):
+                    return _upload_file(files_endpoint, headers, part, args.timeout_s)
+
+        reference_ids = {id(p) for p in to_reference}
+        with ThreadPoolExecutor(max_workers=MAX_ENCODE_WORKERS) as pool:
+            payload = _apply_file_refs(
+                payload,
+                registry_path=args.file_registry or os.path.join(args.cache_dir, "gemini-files.json"),
+                scope=_file_registry_scope(files_endpoint, args.api_key),
+                upload=upload,
+                executor=pool,
+                select=None if args.upload_inputs else lambda p: id(p) in reference_ids,
+            )
+
+    history_budget = args.history_max_bytes or args.max_request_bytes
+    if args.session and history_budget:
+        payload, dropped = _enforce_history_budget(payload, max_bytes=history_budget)
+        if dropped:
+            print(f"🧹 历史超出预算：又省略了 {dropped} 张较早轮次的图片")
+
+    payload = _preflight_payload(
+        payload,
+        max_bytes=args.max_request_bytes,
+        fit=args.fit_inputs,
+        fit_format=args.fit_format,
+        fit_quality=args.fit_quality,
+        cache_dir=os.path.join(args.cache_dir, "fit"),
+    )
+
     if args.dry_run:
         safe_headers = dict(headers)
         if "x-goog-api-key" in safe_headers:
@@ -225,83 +1105,143 @@ def main(argv: List[str]) -> int:
         print("\n== headers ==")
         print(json.dumps(safe_headers, indent=2, ensure_ascii=False))
         print("\n== payload ==")
-        print(json.dumps(payload, indent=2, ensure_ascii=False)[:4000])
+        print(json.dumps(_describe_payload(payload), indent=2, ensure_ascii=False)[:4000])
+        print("\n== request size ==")
+        print(f"{_estimate_request_bytes(payload)} bytes")
         return 0
 
     if not args.api_key:
         raise SystemExit("缺少 API Key：请传 --api-key 或设置环境变量 DMXAPI_API_KEY")
 
-    result = _http_post_json(endpoint, headers, payload, args.timeout_s)
-
-    saved_any = False
-    image_index = 0
-    for part in _iter_parts(result):
-        inline_blob = _extract_inline_blob(part)
-        if inline_blob is not None:
-            mime_type, b64, signature = inline_blob
-            raw = base64.b64decode(b64)
-            path = _save_image_bytes(
-                out_dir=args.out_dir,
-                prefix=args.prefix,
-                mime_type=mime_type,
-                raw_bytes=raw,
-                index=image_index,
-            )
-            print(f"✅ 已保存图片：{path}")
-            saved_any = True
-
-            if args.save_base64:
-                b64_path = _save_text_file(
-                    out_dir=args.out_dir,
-                    filename=f"{os.path.basename(path)}.b64.txt",
-                    text=b64,
-                )
-                print(f"🧾 已保存 base64：{b64_path}")
-
-            if args.save_signature and signature:
-                sig_path = _save_text_file(
-                    out_dir=args.out_dir,
-                    filename=f"{os.path.basename(path)}.signature.txt",
-                    text=signature,
-                )
-                print(f"🧾 已保存 thoughtSignature：{sig_path}")
-
-            image_index += 1
-            continue
-
-        text = part.get("text")
-        if isinstance(text, str):
-            data_url_blob = _extract_data_url_blob(text.strip())
-            if data_url_blob is not None:
-                mime_type, b64 = data_url_blob
-                raw = base64.b64decode(b64)
-                path = _save_image_bytes(
-                    out_dir=args.out_dir,
-                    prefix=args.prefix,
-                    mime_type=mime_type,
-                    raw_bytes=raw,
-                    index=image_index,
-                )
-                print(f"✅ 已保存图片（data URL）：{path}")
-                saved_any = True
-                image_index += 1
-                continue
-
-            # 普通文本：打印到 stdout，避免吞掉关键信息
-            print(text)
+    lazy_count = len({id(p) for p in _iter_lazy_parts(payload)})
+    writer = _ResponseWriter(args, streaming=args.stream)
+    try:
+        # 限流槽位覆盖整个请求（流式时直到流结束），多进程共享同一状态目录；
+        # 先拿到槽位再预热连接，否则排队期间连接空闲，可能已被服务端关闭
+        with _rate_limited(args, urllib.parse.urlsplit(endpoint).netloc, args.model):
+            # 建连与读盘/编码并行：时间线上的首字节发送不再等待全部图片串行编码完
+            with ThreadPoolExecutor(max_workers=min(MAX_ENCODE_WORKERS, lazy_count) + 1) as pool:
+                prewarmed = _start_prewarm(endpoint, args.timeout_s, pool)
+                wire_payload = _materialize_payload(payload, pool)
+            opener = _build_opener(prewarmed)
+            if args.stream:
+                # 流式：每个 SSE 分片里的 part 立即处理，文本即时打印、图片即时落盘
+                for chunk in _http_post_sse(endpoint, headers, wire_payload, args.timeout_s, opener=opener):
+                    if writer.first_chunk_s is None:
+                        writer.first_chunk_s = writer.elapsed()
+                    writer.last_result = chunk
+                    for part in _iter_parts(chunk):
+                        writer.handle(part)
+            else:
+                result = _http_post_json(endpoint, headers, wire_payload, args.timeout_s, opener=opener)
+                writer.last_result = result
+                for part in _iter_parts(result):
+                    writer.handle(part)
+        writer.finish()
+    except Exception as e:
+        _record_metrics(args, {**writer.metrics(), "status": "error", "error": str(e)[:300]})
+        raise
+    _record_metrics(args, {**writer.metrics(), "status": "ok" if writer.saved_any else "no_image"})
 
-        file_data = part.get("fileData")
-        if isinstance(file_data, dict) and file_data.get("fileUri"):
-            print(f"🔗 fileUri: {file_data.get('fileUri')}")
+    if args.session and writer.model_parts:
+        _save_session(args.session, history + [{"role": "user", "parts": parts}, {"role": "model", "parts": writer.model_parts}])
+        print(f"💬 已更新会话：{args.session}（共 {len(history) // 2 + 1} 轮）")
 
-    if not saved_any:
+    if not writer.saved_any:
+        _emit_event("error", **{"class": "NoImage", "status": None, "message": "未在响应中解析到图片数据"})
         print("⚠️ 未在响应中解析到图片数据。")
-        print(json.dumps(result, ensure_ascii=False)[:2000])
+        print(json.dumps(writer.last_result, ensure_ascii=False)[:2000])
         return 2
 
     return 0
 
 
+# 不影响生成结果的参数，计算请求指纹时忽略：公共部分之外再加上流式、文件引用与多轮历史相关的选项
+_NON_REQUEST_KEYS = _SHARED_NON_REQUEST_KEYS | frozenset({
+    "stream",
+    "upload_inputs", "files_endpoint", "file_registry",
+    "history_keep_images", "history_old_images", "history_max_bytes",
+})
+
+
+def _request_fingerprint(args: argparse.Namespace) -> Optional[str]:
+    """规范化后的请求哈希：输入图片按内容 sha256 计，与路径无关；多轮会话/dry-run 不参与合并。"""
+    if args.session or args.dry_run:
+        return None
+    fields = {k: v for k, v in vars(args).items() if k not in _NON_REQUEST_KEYS and not callable(v)}
+    fields["prompt"] = args.prompt.strip()
+    fields["image"] = [_file_sha256(p) if os.path.isfile(p) else p for p in args.image]
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+# 调度用的先验耗时（秒）：无历史数据时按模型档位 × 输出尺寸估算，每张输入图另加固定开销
+_PRIOR_MODEL_S = {"flash": 8.0, "pro": 25.0}
+_PRIOR_SIZE_FACTOR = {"1K": 1.0, "2K": 1.6, "4K": 2.8}
+
+
+def _estimate_job_cost(args: argparse.Namespace) -> Tuple[str, float]:
+    """返回 (成本类别键, 先验耗时)；同类别有历史耗时时调度器改用历史 EWMA。"""
+    size = (args.image_size or "1K").upper()
+    inputs = len(args.image)
+    tier = "flash" if "flash" in args.model else "pro"
+    prior = _PRIOR_MODEL_S[tier] * _PRIOR_SIZE_FACTOR.get(size, 1.0) + 1.5 * inputs
+    return f"{args.model}|{size}|{min(inputs, 6)}", prior
+
+
+# 估算单个 job 内存峰值用的输出图片大小（字节，按无损 PNG 的上限取整）
+_OUTPUT_BYTES_BY_SIZE = {"1K": 2 << 20, "2K": 8 << 20, "4K": 32 << 20}
+
+
+def _estimate_job_memory(args: argparse.Namespace) -> int:
+    """粗估 job 的内存峰值：输入原图 + base64 + JSON 请求体（约 5 倍输入），响应 JSON + base64 + 解码后的图片（约 4 倍输出）。"""
+    inputs = sum(os.path.getsize(p) for p in args.image if os.path.isfile(p))
+    output = _OUTPUT_BYTES_BY_SIZE.get((args.image_size or "1K").upper(), 2 << 20)
+    return inputs * 5 + output * 4
+
+
+def main(argv: List[str]) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.output == "ndjson":
+        _start_event_stream()
+    _start_metrics_export(args, api="gemini")
+    _install_cassette(args)
+    pool = _KeyPool(_load_api_keys(args), strategy=args.key_strategy, auth_bench_s=args.key_bench_s)
+    if args.batch and args.grid:
+        parser.error("--batch 与 --grid 不能同时使用")
+    if not args.batch and not args.grid:
+        if not args.prompt:
+            parser.error("the following arguments are required: --prompt")
+        return _run_single(
+            args,
+            lambda a: _run_with_routes(a, lambda b: _run_with_key_pool(pool, b, run_job)),
+            estimate_cost=_estimate_job_cost,
+        )
+
+    def build_job_args(job_id: str, job: Dict[str, Any]) -> argparse.Namespace:
+        # 命令行参数作为所有 job 的默认值，job 行里的键覆盖之（--image 为追加）
+        job_args = parser.parse_args(argv + _job_to_argv(job))
+        job_args.batch = ""
+        job_args.grid = []
+        if "prefix" not in job:
+            # 并发 job 同一秒落盘时避免文件名相互覆盖
+            job_args.prefix = f"{job_args.prefix}_{job_id}"
+        if not job_args.prompt:
+            raise SystemExit("job 缺少 prompt")
+        return job_args
+
+    batch_kwargs: Dict[str, Any] = dict(
+        build_job_args=build_job_args,
+        request_fingerprint=_request_fingerprint,
+        estimate_cost=_estimate_job_cost,
+        estimate_memory=_estimate_job_memory,
+        run_job=lambda job_args: _run_with_routes(job_args, lambda a: _run_with_key_pool(pool, a, run_job)),
+    )
+    if args.grid:
+        return _run_sweep(args, **batch_kwargs)
+    return _run_batch(args, jobs=_iter_batch_jobs(args.batch), **batch_kwargs)
+
+
 if __name__ == "__main__":
     try:
         raise SystemExit(main(sys.argv[1:]))
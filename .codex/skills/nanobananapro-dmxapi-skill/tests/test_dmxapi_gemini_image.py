@@ -0,0 +1,335 @@
+"""dmxapi_gemini_image.py 的离线单元测试（不访问网络）。
+
+运行：python -m pytest .codex/skills/nanobananapro-dmxapi-skill/tests
+"""
+
+from __future__ import annotations
+
+import base64
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+
+import dmxapi_gemini_image as gemini  # noqa: E402
+
+_PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 32
+
+
+class _TempDirTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+
+    def _image(self, name: str, size: int = 3000) -> str:
+        path = self.tmp / name
+        path.write_bytes(b"\x89PNG\r\n\x1a\n" + os.urandom(size - 8))
+        return str(path)
+
+    def _args(self, *extra: str):
+        return gemini.build_parser().parse_args(
+            ["--prompt", "a cat", "--out-dir", str(self.tmp / "out"), "--cache-dir", str(self.tmp / "cache"), *extra]
+        )
+
+
+def _image_response() -> dict:
+    part = {"inlineData": {"mimeType": "image/png", "data": base64.b64encode(_PNG).decode("ascii")}}
+    return {"candidates": [{"content": {"role": "model", "parts": [part]}}]}
+
+
+class RunJobTest(_TempDirTest):
+    def _run(self, *extra: str) -> int:
+        argv = [
+            "--api-key", "sk-test",
+            "--base-url", "http://127.0.0.1:9",
+            "--prompt", "a cat",
+            "--out-dir", str(self.tmp / "out"),
+            "--cache-dir", str(self.tmp / "cache"),
+            *extra,
+        ]
+        with contextlib.redirect_stdout(io.StringIO()):
+            return gemini.run_job(gemini.build_parser().parse_args(argv))
+
+    def test_prewarm_starts_after_rate_limit_slot(self) -> None:
+        events = []
+
+        @contextlib.contextmanager
+        def rate_limited(args, *parts):
+            events.append("acquire")
+            yield
+            events.append("release")
+
+        def start_prewarm(url, timeout_s, executor):
+            events.append("prewarm")
+            return None
+
+        def post_json(*args, **kwargs):
+            events.append("request")
+            return _image_response()
+
+        with mock.patch.object(gemini, "_rate_limited", rate_limited), \
+                mock.patch.object(gemini, "_start_prewarm", start_prewarm), \
+                mock.patch.object(gemini, "_http_post_json", post_json):
+            self.assertEqual(self._run(), 0)
+        # 排队等待期间不能持有预热好的空闲连接
+        self.assertEqual(events, ["acquire", "prewarm", "request", "release"])
+
+
+class LoadSessionTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / "session.json"
+
+    def test_missing_file_starts_empty_history(self) -> None:
+        self.assertEqual(gemini._load_session(str(self.path)), [])
+
+    def test_round_trip(self) -> None:
+        contents = [{"role": "user", "parts": [{"text": "画一只猫"}]}, {"role": "model", "parts": [{"text": "好的"}]}]
+        gemini._save_session(str(self.path), contents)
+        self.assertEqual(gemini._load_session(str(self.path)), contents)
+
+    def test_truncated_file_fails_with_clear_message(self) -> None:
+        self.path.write_text('{"version": 1, "contents": [', encoding="utf-8")
+        with self.assertRaises(SystemExit) as cm:
+            gemini._load_session(str(self.path))
+        self.assertIn("会话文件不是合法 JSON", str(cm.exception.code))
+
+    def test_unexpected_shape_fails_with_clear_message(self) -> None:
+        self.path.write_text("[]", encoding="utf-8")
+        with self.assertRaises(SystemExit) as cm:
+            gemini._load_session(str(self.path))
+        self.assertIn("会话文件格式不正确", str(cm.exception.code))
+
+    def test_malformed_entries_fail_with_clear_message(self) -> None:
+        entries = [
+            ["user", "hi"],
+            {"role": "user", "parts": "hi"},
+            {"role": "user", "parts": ["hi"]},
+            {"role": "user", "parts": [{"image_file": ["a.png"]}]},
+            {"role": 1, "parts": []},
+        ]
+        for entry in entries:
+            with self.subTest(entry=entry):
+                self.path.write_text(json.dumps({"version": 1, "contents": [entry]}), encoding="utf-8")
+                with self.assertRaises(SystemExit) as cm:
+                    gemini._load_session(str(self.path))
+                self.assertIn("会话文件格式不正确", str(cm.exception.code))
+                self.assertIn("contents[0]", str(cm.exception.code))
+
+
+class LazyPayloadTest(_TempDirTest):
+    def _payload(self, *paths: str) -> dict:
+        parts = [{"text": "融合"}] + [gemini._LazyImagePart(p) for p in paths]
+        return {"contents": [{"role": "user", "parts": parts}]}
+
+    def test_dry_run_never_encodes_images(self) -> None:
+        payload = self._payload(self._image("a.png"))
+        with mock.patch.object(gemini, "_encode_image_part", side_effect=AssertionError("encoded")):
+            described = gemini._describe_payload(payload)
+            size = gemini._estimate_request_bytes(payload)
+        data = described["contents"][0]["parts"][1]["inline_data"]["data"]
+        self.assertTrue(data.startswith("<lazy path="))
+        self.assertIn("bytes=3000", data)
+        self.assertGreater(size, 4000)
+
+    def test_estimate_matches_serialized_request(self) -> None:
+        payload = self._payload(self._image("a.png", 3001), self._image("b.jpg", 4096))
+        wire = gemini._materialize_payload(payload)
+        self.assertEqual(gemini._estimate_request_bytes(payload), len(gemini._json_dumps_bytes(wire)))
+
+    def test_concurrent_materialize_matches_sequential(self) -> None:
+        paths = [self._image(f"{i}.png") for i in range(4)]
+        payload = self._payload(*paths, paths[0])
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            self.assertEqual(gemini._materialize_payload(payload, pool), gemini._materialize_payload(payload))
+
+
+class PreflightTest(_TempDirTest):
+    def _payload(self, path: str) -> dict:
+        return {"contents": [{"role": "user", "parts": [{"text": "x"}, gemini._LazyImagePart(path)]}]}
+
+    def test_over_budget_without_fit_fails_before_sending(self) -> None:
+        payload = self._payload(self._image("big.png", 50_000))
+        with self.assertRaises(SystemExit) as cm:
+            gemini._preflight_payload(
+                payload, max_bytes=10_000, fit=False, fit_format="jpeg", fit_quality=90, cache_dir=str(self.tmp)
+            )
+        self.assertIn("--fit-inputs", str(cm.exception.code))
+
+    @unittest.skipIf(gemini._PILImage is None, "需要 Pillow")
+    def test_fit_inputs_downscales_until_within_budget(self) -> None:
+        path = str(self.tmp / "noise.png")
+        gemini._PILImage.frombytes("RGB", (1024, 1024), os.urandom(1024 * 1024 * 3)).save(path)
+        budget = 200_000
+        cache_dir = str(self.tmp / "fit")
+        with contextlib.redirect_stdout(io.StringIO()):
+            fitted = gemini._preflight_payload(
+                self._payload(path), max_bytes=budget, fit=True, fit_format="jpeg", fit_quality=85, cache_dir=cache_dir
+            )
+        self.assertLessEqual(gemini._estimate_request_bytes(fitted), budget)
+        new_part = list(gemini._iter_lazy_parts(fitted))[0]
+        self.assertTrue(new_part.path.startswith(cache_dir))
+        self.assertEqual(new_part.source.path, path)
+
+
+class FileRefsTest(_TempDirTest):
+    def test_uploads_once_and_reuses_registry_entry(self) -> None:
+        path = self._image("ref.png")
+        registry = str(self.tmp / "files.json")
+        uploads = []
+
+        def upload(part):
+            uploads.append(part.path)
+            return {"uri": f"files/{len(uploads)}", "mime_type": part.mime_type, "expires_at": time.time() + 48 * 3600}
+
+        for _ in range(2):
+            payload = {"contents": [{"role": "user", "parts": [gemini._LazyImagePart(path), gemini._LazyImagePart(path)]}]}
+            with contextlib.redirect_stdout(io.StringIO()):
+                out = gemini._apply_file_refs(payload, registry_path=registry, scope="s", upload=upload)
+            self.assertEqual(
+                out["contents"][0]["parts"], [{"file_data": {"mime_type": "image/png", "file_uri": "files/1"}}] * 2
+            )
+        self.assertEqual(uploads, [path])
+
+    def test_entry_close_to_expiry_is_ignored(self) -> None:
+        registry = {"s": {"abc": {"uri": "files/1", "expires_at": time.time() + gemini.FILE_REF_EXPIRY_MARGIN_S - 5}}}
+        self.assertIsNone(gemini._lookup_file_ref(registry, "s", "abc"))
+        registry["s"]["abc"]["expires_at"] += 60
+        self.assertEqual(gemini._lookup_file_ref(registry, "s", "abc")["uri"], "files/1")
+
+    @unittest.skipUnless(hasattr(os, "fork"), "需要 fork")
+    def test_concurrent_updates_keep_every_entry(self) -> None:
+        registry = str(self.tmp / "files.json")
+        load = gemini._load_file_registry
+
+        def slow_load(path):
+            # 放大读取与写回之间的窗口，未加锁时并发写入会互相覆盖
+            data = load(path)
+            time.sleep(0.2)
+            return data
+
+        entry = {"uri": "files/x", "expires_at": time.time() + 3600}
+        ctx = multiprocessing.get_context("fork")
+        with mock.patch.object(gemini, "_load_file_registry", slow_load):
+            procs = [ctx.Process(target=gemini._update_file_registry, args=(registry, "s", {f"sha{i}": entry})) for i in range(4)]
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join(10)
+        self.assertEqual([proc.exitcode for proc in procs], [0] * 4)
+        self.assertEqual(sorted(gemini._load_file_registry(registry)["s"]), ["sha0", "sha1", "sha2", "sha3"])
+
+
+class HistoryCompactionTest(_TempDirTest):
+    def _history(self) -> list:
+        contents = []
+        for turn in range(3):
+            contents.append({"role": "user", "parts": [{"text": f"改第 {turn} 次"}]})
+            image = gemini._LazyImagePart(self._image(f"out{turn}.png"), extra={"thoughtSignature": f"sig{turn}"})
+            contents.append({"role": "model", "parts": [image]})
+        contents.append({"role": "user", "parts": [{"text": "再改一次"}]})
+        return contents
+
+    def test_keeps_recent_image_turns_and_last_model_turn(self) -> None:
+        contents, to_reference, dropped = gemini._compact_history(self._history(), keep_image_turns=1, old_images="drop")
+        self.assertEqual((to_reference, dropped), ([], 2))
+        self.assertEqual(contents[1]["parts"], [{"text": gemini.HISTORY_IMAGE_PLACEHOLDER}])
+        self.assertEqual(contents[3]["parts"], [{"text": gemini.HISTORY_IMAGE_PLACEHOLDER}])
+        self.assertEqual(contents[5]["parts"][0].extra, {"thoughtSignature": "sig2"})
+        self.assertEqual([c["role"] for c in contents], ["user", "model"] * 3 + ["user"])
+
+    def test_reference_mode_returns_old_images(self) -> None:
+        _, to_reference, dropped = gemini._compact_history(self._history(), keep_image_turns=1, old_images="reference")
+        self.assertEqual((len(to_reference), dropped), (2, 0))
+
+    def test_budget_drops_oldest_images_first(self) -> None:
+        payload = {"contents": self._history()}
+        full = gemini._estimate_request_bytes(payload)
+        trimmed, dropped = gemini._enforce_history_budget(payload, max_bytes=full - 100)
+        self.assertEqual(dropped, 1)
+        self.assertEqual(trimmed["contents"][1]["parts"], [{"text": gemini.HISTORY_IMAGE_PLACEHOLDER}])
+        self.assertIsInstance(trimmed["contents"][3]["parts"][0], gemini._LazyImagePart)
+
+
+class ResponseWriterTest(_TempDirTest):
+    def test_stream_reassembles_split_data_url(self) -> None:
+        data_url = "data:image/png;base64," + base64.b64encode(_PNG).decode("ascii")
+        writer = gemini._ResponseWriter(self._args(), streaming=True)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            for chunk in ("好的，", data_url[:20], data_url[20:]):
+                writer.handle({"text": chunk})
+            writer.finish()
+        self.assertTrue(writer.saved_any)
+        self.assertIn("好的，", out.getvalue())
+        saved = list((self.tmp / "out").iterdir())
+        self.assertEqual([p.read_bytes() for p in saved], [_PNG])
+        self.assertEqual(writer.model_parts[0], {"text": "好的，"})
+
+    def test_sse_chunks_are_handled_as_they_arrive(self) -> None:
+        chunks = [
+            {"candidates": [{"content": {"parts": [{"text": "第一段"}]}}]},
+            _image_response(),
+        ]
+        body = b"".join(b"data: " + json.dumps(c).encode("utf-8") + b"\n\n" for c in chunks)
+        seen = []
+
+        class Resp(io.BytesIO):
+            headers: dict = {}
+            status = 200
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+        def fake_urlopen(req, timeout=None):
+            return Resp(body)
+
+        with mock.patch.object(gemini.urllib.request, "urlopen", fake_urlopen):
+            for chunk in gemini._http_post_sse("http://x/v1beta/models/m:streamGenerateContent?alt=sse", {}, {}, 5):
+                seen.append(list(gemini._iter_parts(chunk)))
+        self.assertEqual(len(seen), 2)
+        self.assertEqual(seen[0], [{"text": "第一段"}])
+
+
+class BatchEstimatesTest(_TempDirTest):
+    def test_fingerprint_ignores_output_location_and_image_path(self) -> None:
+        a = self._image("a.png")
+        b = self.tmp / "copy.png"
+        b.write_bytes(Path(a).read_bytes())
+        fp1 = gemini._request_fingerprint(self._args("--image", a, "--prefix", "x"))
+        fp2 = gemini._request_fingerprint(self._args("--image", str(b), "--out-dir", str(self.tmp / "other")))
+        fp3 = gemini._request_fingerprint(self._args("--image", a, "--aspect-ratio", "16:9"))
+        self.assertEqual(fp1, fp2)
+        self.assertNotEqual(fp1, fp3)
+        self.assertIsNone(gemini._request_fingerprint(self._args("--session", str(self.tmp / "s.json"))))
+
+    def test_cost_grows_with_model_and_size(self) -> None:
+        small = self._args("--model", "gemini-2.5-flash-image", "--image-size", "1K")
+        large = self._args("--model", "gemini-3-pro-image-preview", "--image-size", "4K")
+        self.assertLess(gemini._estimate_job_cost(small)[1], gemini._estimate_job_cost(large)[1])
+        self.assertNotEqual(gemini._estimate_job_cost(small)[0], gemini._estimate_job_cost(large)[0])
+
+    def test_memory_grows_with_size_and_inputs(self) -> None:
+        small = self._args("--image-size", "1K")
+        large = self._args("--image-size", "4K")
+        with_input = self._args("--image-size", "4K", "--image", self._image("a.png", 100_000))
+        self.assertLess(gemini._estimate_job_memory(small), gemini._estimate_job_memory(large))
+        self.assertLess(gemini._estimate_job_memory(large), gemini._estimate_job_memory(with_input))
+
+
+if __name__ == "__main__":
+    unittest.main()
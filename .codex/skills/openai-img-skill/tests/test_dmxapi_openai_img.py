@@ -0,0 +1,257 @@
+"""dmxapi_openai_img.py 的离线单元测试（不访问网络）。
+
+运行：python -m pytest .codex/skills/openai-img-skill/tests
+"""
+
+from __future__ import annotations
+
+import base64
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import uuid
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+
+import dmxapi_openai_img as openai_img  # noqa: E402
+
+_PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 32
+
+
+class RunEditTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.image = self.tmp / "in.png"
+        self.image.write_bytes(_PNG)
+
+    def _run(self, *extra: str, global_args: tuple = ()) -> int:
+        argv = [
+            *global_args,
+            "--api-key", "sk-test",
+            "--base-url", "http://127.0.0.1:9",
+            "--out-dir", str(self.tmp / "out"),
+            "--cache-dir", str(self.tmp / "cache"),
+            "edit",
+            "--prompt", "a cat",
+            "--image", str(self.image),
+            *extra,
+        ]
+        with contextlib.redirect_stdout(io.StringIO()):
+            return openai_img.run_job(openai_img.build_parser().parse_args(argv))
+
+    def test_prewarm_starts_after_rate_limit_slot(self) -> None:
+        events = []
+
+        @contextlib.contextmanager
+        def rate_limited(args, *parts):
+            events.append("acquire")
+            yield
+            events.append("release")
+
+        def start_prewarm(url, timeout_s, executor):
+            events.append("prewarm")
+            return None
+
+        def post_multipart(*args, **kwargs):
+            events.append("request")
+            return {"data": [{"b64_json": base64.b64encode(_PNG).decode("ascii")}]}
+
+        with mock.patch.object(openai_img, "_rate_limited", rate_limited), \
+                mock.patch.object(openai_img, "_start_prewarm", start_prewarm), \
+                mock.patch.object(openai_img, "_http_post_multipart", post_multipart):
+            self.assertEqual(self._run(), 0)
+        # 排队等待期间不能持有预热好的空闲连接
+        self.assertEqual(events, ["acquire", "prewarm", "request", "release"])
+
+    def test_oversized_upload_is_rejected_by_default_budget(self) -> None:
+        # 只按文件大小预检，稀疏文件即可模拟超大输入
+        with self.image.open("r+b") as f:
+            f.truncate(openai_img.DEFAULT_MAX_REQUEST_BYTES + 1)
+        with mock.patch.object(openai_img, "_http_post_multipart") as post:
+            with self.assertRaises(SystemExit) as cm:
+                self._run()
+        post.assert_not_called()
+        self.assertIn("--max-request-bytes", str(cm.exception.code))
+
+    def test_zero_budget_disables_preflight(self) -> None:
+        with self.image.open("r+b") as f:
+            f.truncate(openai_img.DEFAULT_MAX_REQUEST_BYTES + 1)
+        with mock.patch.object(openai_img, "_print_dry_run") as dry_run:
+            self.assertEqual(self._run("--max-request-bytes", "0", global_args=("--dry-run",)), 0)
+        self.assertGreater(dry_run.call_args.args[2]["request_bytes"], openai_img.DEFAULT_MAX_REQUEST_BYTES)
+
+    @unittest.skipIf(openai_img._PILImage is None, "需要 Pillow")
+    def test_fitted_request_bytes_match_sent_body(self) -> None:
+        openai_img._PILImage.frombytes("RGB", (512, 512), os.urandom(512 * 512 * 3)).save(self.image)
+        reported = {}
+        sent = {}
+        timed_request = openai_img._timed_request
+
+        def record_timed(args, send, **record):
+            reported.update(record)
+            return timed_request(args, send, **record)
+
+        def post_multipart(url, headers, fields, files, timeout_s, opener=None):
+            boundary = f"{openai_img._MULTIPART_BOUNDARY_PREFIX}{uuid.uuid4().hex}"
+            sent["bytes"] = len(openai_img._encode_multipart(fields=fields, files=files, boundary=boundary))
+            sent["filenames"] = [f[1] for f in files]
+            return {"data": [{"b64_json": base64.b64encode(_PNG).decode("ascii")}]}
+
+        budget = self.image.stat().st_size // 2
+        with mock.patch.object(openai_img, "_timed_request", record_timed), \
+                mock.patch.object(openai_img, "_http_post_multipart", post_multipart):
+            self.assertEqual(self._run("--max-request-bytes", str(budget), "--fit-inputs"), 0)
+        # 压缩后的图片以原文件名主干上传，预检字节数按上传文件名计算
+        self.assertEqual(sent["filenames"], ["in.jpg"])
+        self.assertEqual(reported["request_bytes"], sent["bytes"])
+        self.assertLessEqual(sent["bytes"], budget)
+
+
+class MultipartTest(unittest.TestCase):
+    def test_estimate_matches_encoded_body(self) -> None:
+        fields = [("model", "gpt-image-1.5"), ("prompt", "把背景换成海边，保留人物"), ("size", "1024x1024")]
+        files = [("image", "人物.png", "image/png", _PNG * 3), ("image", "b.webp", "image/webp", b"RIFF" + b"x" * 999)]
+        boundary = f"{openai_img._MULTIPART_BOUNDARY_PREFIX}{uuid.uuid4().hex}"
+        body = openai_img._encode_multipart(fields=fields, files=files, boundary=boundary)
+        sized = [(f, n, m, len(raw)) for f, n, m, raw in files]
+        self.assertEqual(openai_img._estimate_multipart_bytes(fields=fields, files=sized), len(body))
+        self.assertTrue(body.endswith(f"--{boundary}--\r\n".encode("ascii")))
+
+    def test_mime_sniffing(self) -> None:
+        self.assertEqual(openai_img._guess_image_mime_by_bytes(_PNG), "image/png")
+        self.assertEqual(openai_img._guess_image_mime_by_bytes(b"\xff\xd8\xff" + b"\0" * 9), "image/jpeg")
+        self.assertEqual(openai_img._guess_image_mime_by_bytes(b"RIFF\0\0\0\0WEBPVP8 "), "image/webp")
+        self.assertEqual(openai_img._guess_image_mime_by_bytes(b"short", "image/webp"), "image/webp")
+
+
+class GenerateStreamTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+
+    def test_partials_are_saved_as_they_arrive(self) -> None:
+        b64 = base64.b64encode(_PNG).decode("ascii")
+        events = [
+            {"type": "image_generation.partial_image", "partial_image_index": 0, "b64_json": b64},
+            {"type": "image_generation.partial_image", "partial_image_index": 1, "b64_json": b64},
+            {"type": "image_generation.completed", "b64_json": b64},
+        ]
+        metrics = self.tmp / "m.jsonl"
+        args = openai_img.build_parser().parse_args(
+            ["--out-dir", str(self.tmp / "out"), "--metrics-file", str(metrics), "generate", "--prompt", "x", "--stream", "--partial-images", "2"]
+        )
+        with mock.patch.object(openai_img, "_http_post_sse", return_value=iter(events)), \
+                contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(openai_img._run_generate_stream("http://x", {}, {}, args), 0)
+        names = sorted(p.name for p in (self.tmp / "out").iterdir())
+        self.assertEqual(len(names), 3)
+        self.assertEqual(sum("_partial_" in n for n in names), 2)
+        row = json.loads(metrics.read_text(encoding="utf-8"))
+        self.assertEqual((row["status"], row["partial_images"], row["images"]), ("ok", 2, 1))
+        self.assertIsNotNone(row["time_to_first_preview_s"])
+
+    def test_stream_without_final_image_fails(self) -> None:
+        b64 = base64.b64encode(_PNG).decode("ascii")
+        events = [{"type": "image_generation.partial_image", "partial_image_index": 0, "b64_json": b64}]
+        metrics = self.tmp / "m.jsonl"
+        args = openai_img.build_parser().parse_args(
+            ["--out-dir", str(self.tmp / "out"), "--metrics-file", str(metrics), "generate", "--prompt", "x", "--stream"]
+        )
+        with mock.patch.object(openai_img, "_http_post_sse", return_value=iter(events)), \
+                contextlib.redirect_stdout(io.StringIO()):
+            # 非 0 退出码让批量模式、journal 与合并请求不把该 job 记为完成
+            self.assertEqual(openai_img._run_generate_stream("http://x", {}, {}, args), 2)
+        row = json.loads(metrics.read_text(encoding="utf-8"))
+        self.assertEqual((row["status"], row["partial_images"], row["images"]), ("no_image", 1, 0))
+
+
+class InMemoryChainTest(unittest.TestCase):
+    def test_edit_image_bytes_sends_and_returns_bytes(self) -> None:
+        sent = {}
+
+        def post_multipart(url, headers, fields, files, timeout_s, opener=None):
+            sent.update(url=url, fields=dict(fields), files=files)
+            return {"data": [{"b64_json": base64.b64encode(_PNG).decode("ascii")}]}
+
+        with mock.patch.object(openai_img, "_http_post_multipart", post_multipart):
+            out = openai_img.edit_image_bytes(prompt="x", images=[("image/jpeg", b"\xff\xd8\xffjpeg")], api_key="k")
+        self.assertEqual(out, [("image/png", _PNG)])
+        self.assertEqual(sent["url"], "https://www.dmxapi.cn/v1/images/edits")
+        self.assertEqual(sent["files"], [("image", "image_1.jpg", "image/jpeg", b"\xff\xd8\xffjpeg")])
+
+    def test_edit_image_bytes_requires_an_image(self) -> None:
+        with self.assertRaises(ValueError):
+            openai_img.edit_image_bytes(prompt="x", images=[], api_key="k")
+
+
+class BatchEstimatesTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.image = self.tmp / "in.png"
+        self.image.write_bytes(_PNG)
+
+    def _args(self, *extra: str, cmd: str = "edit"):
+        argv = ["--out-dir", str(self.tmp / "out"), cmd, "--prompt", "a cat", *extra]
+        return openai_img.build_parser().parse_args(argv)
+
+    def test_fingerprint_uses_image_content(self) -> None:
+        copy = self.tmp / "copy.png"
+        copy.write_bytes(_PNG)
+        fp1 = openai_img._request_fingerprint(self._args("--image", str(self.image)))
+        fp2 = openai_img._request_fingerprint(self._args("--image", str(copy)))
+        fp3 = openai_img._request_fingerprint(self._args("--image", str(self.image), "--size", "1024x1536"))
+        self.assertEqual(fp1, fp2)
+        self.assertNotEqual(fp1, fp3)
+
+    def test_cost_grows_with_size_and_quality(self) -> None:
+        low = self._args("--size", "1024x1024", "--quality", "low", cmd="generate")
+        high = self._args("--size", "1536x1024", "--quality", "high", cmd="generate")
+        self.assertLess(openai_img._estimate_job_cost(low)[1], openai_img._estimate_job_cost(high)[1])
+
+    def test_memory_grows_with_size_and_count(self) -> None:
+        one = self._args("--size", "1024x1024", cmd="generate")
+        four = self._args("--size", "1536x1024", "--n", "4", cmd="generate")
+        self.assertLess(openai_img._estimate_job_memory(one), openai_img._estimate_job_memory(four))
+
+
+class StandaloneTest(unittest.TestCase):
+    SCRIPTS = Path(__file__).resolve().parents[1] / "scripts"
+
+    def test_skill_runs_without_sibling_skills(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            scripts = Path(tmp) / "openai-img-skill" / "scripts"
+            shutil.copytree(self.SCRIPTS, scripts, ignore=shutil.ignore_patterns("__pycache__"))
+            proc = subprocess.run(
+                [sys.executable, str(scripts / "dmxapi_openai_img.py"), "--dry-run", "generate", "--prompt", "x"],
+                capture_output=True,
+                text=True,
+                cwd=tmp,
+                env={**os.environ, "PYTHONPATH": ""},
+                timeout=60,
+            )
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertIn("/v1/images/generations", proc.stdout)
+
+    def test_common_module_matches_nanobananapro_copy(self) -> None:
+        sibling = self.SCRIPTS.parents[1] / "nanobananapro-dmxapi-skill" / "scripts" / "dmxapi_common.py"
+        if not sibling.is_file():
+            self.skipTest("未随附 nanobananapro skill")
+        # 两个 skill 各带一份公共模块以便单独分发，内容必须保持一致
+        self.assertEqual((self.SCRIPTS / "dmxapi_common.py").read_bytes(), sibling.read_bytes())
+
+
+if __name__ == "__main__":
+    unittest.main()
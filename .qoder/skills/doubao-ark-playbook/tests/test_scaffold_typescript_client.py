@@ -0,0 +1,118 @@
+"""
+Offline unit tests for scaffold_typescript_client.py.
+
+Run: python -m pytest .codex/skills/doubao-ark-playbook/tests
+"""
+
+from __future__ import annotations
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+
+import scaffold_typescript_client as scaffold  # noqa: E402
+
+
+class _TreeTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = Path(tmp.name)
+        self.src = root / "src"
+        self.dst = root / "dst"
+        (self.src / "lib").mkdir(parents=True)
+        (self.src / "index.ts").write_text("export * from './lib/client';\n", encoding="utf-8")
+        (self.src / "lib" / "client.ts").write_text("export const client = 1;\n", encoding="utf-8")
+        self.dst.mkdir()
+
+    def _quiet(self, fn, *args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            result = fn(*args, **kwargs)
+        self.output = out.getvalue()
+        return result
+
+
+class SyncTreeTest(_TreeTest):
+    def test_rerun_leaves_unchanged_files_untouched(self) -> None:
+        self._quiet(scaffold.sync_tree, self.src, self.dst, force=False)
+        self.assertIn("added=2 changed=0 unchanged=0", self.output)
+        self.assertTrue((self.dst / scaffold.MANIFEST_NAME).is_file())
+        target = self.dst / "lib" / "client.ts"
+        os.utime(target, ns=(1_000_000_000, 1_000_000_000))
+        # Refresh the manifest with the new mtime so the rerun takes the fast path.
+        self._quiet(scaffold.sync_tree, self.src, self.dst, force=False)
+
+        methods = self._quiet(scaffold.sync_tree, self.src, self.dst, force=False)
+        self.assertEqual(sum(methods.values()), 0)
+        self.assertIn("added=0 changed=0 unchanged=2", self.output)
+        self.assertEqual(target.stat().st_mtime_ns, 1_000_000_000)
+
+    def test_changed_template_is_updated(self) -> None:
+        self._quiet(scaffold.sync_tree, self.src, self.dst, force=False)
+        (self.src / "index.ts").write_text("export const v = 2;\n", encoding="utf-8")
+        self._quiet(scaffold.sync_tree, self.src, self.dst, force=False)
+        self.assertIn("added=0 changed=1 unchanged=1", self.output)
+        self.assertEqual((self.dst / "index.ts").read_text(encoding="utf-8"), "export const v = 2;\n")
+
+    def test_local_edit_is_a_conflict_unless_forced(self) -> None:
+        self._quiet(scaffold.sync_tree, self.src, self.dst, force=False)
+        (self.dst / "index.ts").write_text("// local tweak\n", encoding="utf-8")
+        (self.src / "index.ts").write_text("export const v = 2;\n", encoding="utf-8")
+        with self.assertRaises(SystemExit):
+            self._quiet(scaffold.sync_tree, self.src, self.dst, force=False)
+        self.assertEqual((self.dst / "index.ts").read_text(encoding="utf-8"), "// local tweak\n")
+
+        self._quiet(scaffold.sync_tree, self.src, self.dst, force=True)
+        self.assertEqual((self.dst / "index.ts").read_text(encoding="utf-8"), "export const v = 2;\n")
+
+    def test_unmanaged_existing_file_is_a_conflict(self) -> None:
+        (self.dst / "index.ts").write_text("// hand written\n", encoding="utf-8")
+        with self.assertRaises(SystemExit):
+            self._quiet(scaffold.sync_tree, self.src, self.dst, force=False)
+        self.assertFalse((self.dst / "lib" / "client.ts").exists())
+
+    def test_hardlink_shares_the_template_inode(self) -> None:
+        methods = self._quiet(scaffold.sync_tree, self.src, self.dst, force=False, hardlink=True)
+        self.assertEqual(methods["hardlink"], 2)
+        self.assertTrue((self.dst / "index.ts").samefile(self.src / "index.ts"))
+
+
+class CopyTreeTest(_TreeTest):
+    def test_existing_files_need_force(self) -> None:
+        self._quiet(scaffold.copy_tree, self.src, self.dst, force=False)
+        self.assertEqual((self.dst / "lib" / "client.ts").read_text(encoding="utf-8"), "export const client = 1;\n")
+        with self.assertRaises(SystemExit):
+            self._quiet(scaffold.copy_tree, self.src, self.dst, force=False)
+        methods = self._quiet(scaffold.copy_tree, self.src, self.dst, force=True)
+        self.assertEqual(sum(methods.values()), 2)
+
+    def test_place_file_leaves_no_temp_file(self) -> None:
+        dst = self.dst / "nested" / "index.ts"
+        method = scaffold._place_file(self.src / "index.ts", dst, hardlink=False)
+        self.assertIn(method, {"reflink", "copy_file_range", "copy"})
+        self.assertEqual(dst.read_bytes(), (self.src / "index.ts").read_bytes())
+        self.assertEqual(sorted(p.name for p in dst.parent.iterdir()), ["index.ts"])
+
+
+class MainTest(unittest.TestCase):
+    def test_populates_several_targets_in_one_run(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            outs = [str(Path(tmp) / name) for name in ("a", "b", "c")]
+            argv = ["scaffold_typescript_client.py", "--out", *outs, "--sync", "--jobs", "2"]
+            with mock.patch.object(sys, "argv", argv), contextlib.redirect_stdout(io.StringIO()) as out:
+                self.assertEqual(scaffold.main(), 0)
+            self.assertIn("[DONE] 3 targets, 0 failed", out.getvalue())
+            templates = scaffold._list_files(Path(scaffold.__file__).resolve().parents[1] / "assets" / "typescript")
+            for out_dir in outs:
+                self.assertEqual(scaffold._list_files(Path(out_dir) / "doubao-ark"), sorted([*templates, Path(scaffold.MANIFEST_NAME)]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+DMXAPI 跨模型图片流水线：Gemini 生成 → OpenAI 编辑 → Gemini 多轮修改 …
+
+用途：
+  - 按顺序执行多个 stage，上一 stage 的输出图片以 bytes 形式在内存中直接交给下一 stage，
+    中间结果不落盘、不重复读盘/解码
+  - 只保存最后一个 stage 的图片，以及显式标记 "save": true 的 stage
+  - Gemini 多轮（"multi_turn": true）沿用上一次 Gemini 会话的 contents，
+    模型返回的图片以原始 base64 留在历史中，不再重新编码
+
+stage 字段（JSON 对象）：
+  - provider：gemini | openai（必填）
+  - prompt：提示词（必填）
+  - op：openai 专用，edit（有输入图时默认）| generate
+  - input：previous（默认，使用上一 stage 的全部输出）| none
+  - images：额外输入图片路径列表（追加在上一 stage 输出之后）
+  - multi_turn：gemini 专用，接着上一次 Gemini 会话继续
+  - save：是否保存该 stage 的输出（最后一个 stage 总会保存）
+  - 其余字段透传：model / base_url / aspect_ratio / image_size / size / quality /
+    background / input_fidelity / output_format / timeout_s
+
+注意：
+  - OpenAI 脚本按目录约定从 ../../openai-img-skill/scripts/dmxapi_openai_img.py 加载，
+    也可用 --openai-script 指定。
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import dmxapi_gemini_image as gemini
+
+_STAGE_KEYS = frozenset(
+    {
+        "provider",
+        "prompt",
+        "op",
+        "input",
+        "images",
+        "multi_turn",
+        "save",
+        "model",
+        "base_url",
+        "aspect_ratio",
+        "image_size",
+        "size",
+        "quality",
+        "background",
+        "input_fidelity",
+        "output_format",
+        "timeout_s",
+    }
+)
+
+_GEMINI_DEFAULT_MODEL = "gemini-3-pro-image-preview"
+_OPENAI_DEFAULT_MODEL = "gpt-image-1.5"
+
+
+def _default_openai_script() -> str:
+    here = Path(__file__).resolve().parent
+    return str(here.parent.parent / "openai-img-skill" / "scripts" / "dmxapi_openai_img.py")
+
+
+def _load_openai_module(path: str) -> Any:
+    if not os.path.isfile(path):
+        raise SystemExit(f"找不到 OpenAI 脚本：{path}（可用 --openai-script 指定）")
+    spec = importlib.util.spec_from_file_location("dmxapi_openai_img", path)
+    if spec is None or spec.loader is None:
+        raise SystemExit(f"无法加载 OpenAI 脚本：{path}")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _load_stages(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    stages: List[Dict[str, Any]] = []
+    if args.spec:
+        with open(args.spec, "r", encoding="utf-8") as f:
+            spec = json.load(f)
+        stages.extend(spec.get("stages", []) if isinstance(spec, dict) else spec)
+    for raw in args.stage:
+        try:
+            stages.append(json.loads(raw))
+        except json.JSONDecodeError as e:
+            raise SystemExit(f"--stage 不是合法 JSON：{e}")
+    if not stages:
+        raise SystemExit("没有 stage：请传 --spec 或至少一个 --stage")
+
+    for i, stage in enumerate(stages, start=1):
+        if not isinstance(stage, dict):
+            raise SystemExit(f"stage {i} 必须是 JSON 对象")
+        unknown = sorted(set(stage) - _STAGE_KEYS)
+        if unknown:
+            raise SystemExit(f"stage {i} 含未知字段：{', '.join(unknown)}")
+        if stage.get("provider") not in ("gemini", "openai"):
+            raise SystemExit(f"stage {i} 的 provider 必须是 gemini 或 openai")
+        if not str(stage.get("prompt") or "").strip():
+            raise SystemExit(f"stage {i} 缺少 prompt")
+        if stage.get("op", "edit") not in ("edit", "generate"):
+            raise SystemExit(f"stage {i} 的 op 必须是 edit 或 generate")
+        if stage.get("input", "previous") not in ("previous", "none"):
+            raise SystemExit(f"stage {i} 的 input 必须是 previous 或 none")
+        if stage.get("multi_turn") and stage["provider"] != "gemini":
+            raise SystemExit(f"stage {i}：multi_turn 仅适用于 gemini")
+    return stages
+
+
+def _read_image(path: str) -> Tuple[str, bytes]:
+    return gemini._guess_mime_type(path), Path(path).read_bytes()
+
+
+def _describe_stage(stage: Dict[str, Any], prev_count: int, gemini_history: bool) -> str:
+    provider = stage["provider"]
+    if provider == "openai":
+        op = stage.get("op") or ("edit" if prev_count or stage.get("images") else "generate")
+        desc = f"openai {op}"
+    else:
+        desc = "gemini multi-turn" if stage.get("multi_turn") and gemini_history else "gemini generate"
+    inputs = (prev_count if stage.get("input", "previous") == "previous" else 0) + len(stage.get("images") or [])
+    return f"{desc}（输入 {inputs} 张）"
+
+
+def run_pipeline(args: argparse.Namespace, stages: List[Dict[str, Any]], openai_mod: Any) -> List[str]:
+    """顺序执行 stage，返回保存的文件路径。"""
+    current: List[Tuple[str, bytes]] = []
+    # 上一次 Gemini 会话的 contents；current_in_history 表示 current 已作为模型输出留在其中
+    history: Optional[List[Dict[str, Any]]] = None
+    current_in_history = False
+    saved: List[str] = []
+
+    for no, stage in enumerate(stages, start=1):
+        provider = stage["provider"]
+        base_url = stage.get("base_url") or args.base_url
+        timeout_s = int(stage.get("timeout_s") or args.timeout_s)
+        inputs = list(current) if stage.get("input", "previous") == "previous" else []
+        inputs.extend(_read_image(p) for p in stage.get("images") or [])
+        print(f"▶️ stage {no}/{len(stages)}：{_describe_stage(stage, len(current), history is not None)}")
+
+        started = time.monotonic()
+        if provider == "gemini":
+            multi_turn = bool(stage.get("multi_turn")) and history is not None
+            if multi_turn and current_in_history and stage.get("input", "previous") == "previous":
+                # 上一轮图片已在历史中（原始 base64），无需重复附加
+                inputs = inputs[len(current):]
+            result = gemini.generate_image_bytes(
+                prompt=stage["prompt"],
+                api_key=args.api_key,
+                images=inputs,
+                history=history if multi_turn else None,
+                base_url=base_url,
+                model=stage.get("model") or _GEMINI_DEFAULT_MODEL,
+                auth_header=args.gemini_auth_header,
+                aspect_ratio=stage.get("aspect_ratio") or "",
+                image_size=stage.get("image_size") or "",
+                timeout_s=timeout_s,
+            )
+            outputs = result["images"]
+            history = result["contents"]
+            current_in_history = True
+            if result["text"]:
+                print(f"📝 {result['text']}")
+        else:
+            op = stage.get("op") or ("edit" if inputs else "generate")
+            common = {
+                "prompt": stage["prompt"],
+                "api_key": args.api_key,
+                "base_url": base_url,
+                "model": stage.get("model") or _OPENAI_DEFAULT_MODEL,
+                "auth_header": args.openai_auth_header,
+                "size": stage.get("size") or "",
+                "quality": stage.get("quality") or "",
+                "background": stage.get("background") or "",
+                "output_format": stage.get("output_format") or "",
+                "timeout_s": timeout_s,
+            }
+            if op == "edit":
+                if not inputs:
+                    raise SystemExit(f"stage {no}：openai edit 没有输入图片")
+                outputs = openai_mod.edit_image_bytes(images=inputs, input_fidelity=stage.get("input_fidelity") or "", **common)
+            else:
+                outputs = openai_mod.generate_image_bytes(**common)
+            current_in_history = False
+
+        if not outputs:
+            raise SystemExit(f"stage {no} 未返回图片，流水线中止")
+        size = sum(len(raw) for _, raw in outputs)
+        print(f"✅ stage {no} 完成：{len(outputs)} 张 / {size} 字节，耗时 {time.monotonic() - started:.1f}s")
+
+        if stage.get("save") or no == len(stages):
+            for i, (mime_type, raw) in enumerate(outputs, start=1):
+                path = gemini._save_image_bytes(
+                    out_dir=args.out_dir, prefix=f"{args.prefix}_s{no}", mime_type=mime_type, raw_bytes=raw, index=i
+                )
+                saved.append(path)
+                print(f"💾 已保存：{path}")
+        current = outputs
+    return saved
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="DMXAPI 跨模型图片流水线（stage 之间在内存中传递图片）")
+    parser.add_argument("--spec", default="", help='流水线 JSON 文件：{"stages": [...]} 或直接是 stage 数组')
+    parser.add_argument("--stage", action="append", default=[], help="单个 stage 的 JSON（可重复，追加在 --spec 之后）")
+    parser.add_argument("--api-key", default=os.environ.get("DMXAPI_API_KEY", ""), help="DMXAPI API Key（也可用环境变量 DMXAPI_API_KEY）")
+    parser.add_argument("--base-url", default=os.environ.get("DMXAPI_BASE_URL", "https://www.dmxapi.cn"), help="DMXAPI 基础地址（stage 可用 base_url 覆盖）")
+    parser.add_argument(
+        "--gemini-auth-header",
+        default="x-goog-api-key",
+        choices=["x-goog-api-key", "authorization", "authorization-bearer"],
+        help="Gemini stage 的认证头",
+    )
+    parser.add_argument(
+        "--openai-auth-header",
+        default="authorization",
+        choices=["authorization", "authorization-bearer"],
+        help="OpenAI stage 的认证头",
+    )
+    parser.add_argument("--openai-script", default=_default_openai_script(), help="dmxapi_openai_img.py 路径")
+    parser.add_argument("--timeout-s", type=int, default=300, help="单个 stage 请求超时（秒）")
+    parser.add_argument("--out-dir", default="output", help="输出目录")
+    parser.add_argument("--prefix", default="pipeline", help="输出文件名前缀（实际为 {prefix}_s{stage序号}）")
+    parser.add_argument("--dry-run", action="store_true", help="只打印 stage 计划，不发请求")
+    return parser
+
+
+def main(argv: List[str]) -> int:
+    args = build_parser().parse_args(argv)
+    stages = _load_stages(args)
+
+    if args.dry_run:
+        for no, stage in enumerate(stages, start=1):
+            mark = "💾" if stage.get("save") or no == len(stages) else "  "
+            print(f"{mark} stage {no}：{_describe_stage(stage, int(no > 1), no > 1)} - {stage['prompt']}")
+        return 0
+
+    if not args.api_key:
+        raise SystemExit("缺少 API Key：请传 --api-key 或设置环境变量 DMXAPI_API_KEY")
+    openai_mod = _load_openai_module(args.openai_script) if any(s["provider"] == "openai" for s in stages) else None
+    saved = run_pipeline(args, stages, openai_mod)
+    print(f"🏁 流水线完成：保存 {len(saved)} 个文件")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
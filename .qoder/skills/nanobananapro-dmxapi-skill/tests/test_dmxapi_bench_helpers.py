@@ -0,0 +1,102 @@
+"""dmxapi_bench_helpers.py 回归判定逻辑的单元测试。
+
+运行：python -m pytest .codex/skills/nanobananapro-dmxapi-skill/tests
+"""
+
+from __future__ import annotations
+
+import base64
+import json
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+
+import dmxapi_bench_helpers as bench  # noqa: E402
+
+
+class CompareTest(unittest.TestCase):
+    BASE = {"ops_per_s": 100.0, "peak_bytes": 1_000_000}
+
+    def test_within_threshold(self) -> None:
+        self.assertIsNone(bench._compare({"ops_per_s": 80.0, "peak_bytes": 1_200_000}, self.BASE, 0.25))
+
+    def test_throughput_drop(self) -> None:
+        self.assertIn("ops/s", bench._compare({"ops_per_s": 70.0, "peak_bytes": 1_000_000}, self.BASE, 0.25))
+
+    def test_small_peak_growth_is_absorbed_by_slack(self) -> None:
+        base = {"ops_per_s": 100.0, "peak_bytes": 1000}
+        self.assertIsNone(bench._compare({"ops_per_s": 100.0, "peak_bytes": 1000 + bench._PEAK_SLACK_BYTES}, base, 0.25))
+        self.assertIsNotNone(bench._compare({"ops_per_s": 100.0, "peak_bytes": 2000 + bench._PEAK_SLACK_BYTES}, base, 0.25))
+
+    def test_machine_wide_slowdown_is_not_a_regression(self) -> None:
+        base = {**self.BASE, "vs_reference": 0.5}
+        # 参考循环同样变慢：相对吞吐不变
+        self.assertIsNone(bench._compare({**base, "ops_per_s": 50.0, "vs_reference": 0.49}, base, 0.25))
+        self.assertIn("相对参考循环", bench._compare({**base, "ops_per_s": 50.0, "vs_reference": 0.25}, base, 0.25))
+
+    def test_wire_bytes_growth(self) -> None:
+        base = {**self.BASE, "wire_bytes": 1000}
+        self.assertIsNone(bench._compare({**base, "wire_bytes": 1200}, base, 0.25))
+        self.assertIn("线上字节", bench._compare({**base, "wire_bytes": 1300}, base, 0.25))
+
+
+class StubServerTest(unittest.TestCase):
+    def test_gzip_response_is_smaller_and_parses_the_same(self) -> None:
+        stub = bench._StubServer()
+        self.addCleanup(stub.close)
+        body = {"candidates": [{"content": {"parts": [{"inlineData": {"data": base64.b64encode(os.urandom(300_000)).decode("ascii")}}]}}]}
+        stub.serve(json.dumps(body).encode("utf-8"))
+        plain = bench.gemini._http_post_bytes(stub.url, {}, b"{}", 10)
+        plain_bytes = stub.wire_bytes()
+        inflated = bench.gemini._http_post_bytes(stub.url, {"Accept-Encoding": "gzip, deflate"}, b"{}", 10)
+        self.assertEqual(plain, body)
+        self.assertEqual(inflated, body)
+        # 随机内容的 base64 经 gzip 约省去 1/4
+        self.assertLess(stub.wire_bytes(), plain_bytes * 0.8)
+
+
+class CasesTest(unittest.TestCase):
+    def test_every_case_runs(self) -> None:
+        stub = bench._StubServer()
+        self.addCleanup(stub.close)
+        openai_mod = bench._load_openai_module(bench._default_openai_script())
+        with tempfile.TemporaryDirectory() as workdir:
+            cases = bench._build_cases(openai_mod, bench._synthetic_png(4096), workdir, stub)
+            for case in cases:
+                with self.subTest(case=case.name):
+                    case.fn()
+        names = {case.name for case in cases}
+        self.assertIn("codec.stdlib.dumps_gemini_fusion", names)
+        if bench._orjson is not None:
+            self.assertIn("codec.orjson.loads_openai_edit", names)
+
+    def test_codec_switch_is_scoped_to_the_call(self) -> None:
+        saved = bench.common._orjson
+        self.assertIsNone(bench._with_codec(None, lambda: bench.common._orjson)())
+        self.assertIs(bench.common._orjson, saved)
+        obj = {"prompt": "融合", "data": "A" * 1000}
+        stdlib = bench._with_codec(None, lambda: bench.common._json_dumps_bytes(obj))()
+        self.assertEqual(bench.common._json_dumps_bytes(obj), stdlib)
+
+
+class MeasureTest(unittest.TestCase):
+    def test_rounds_are_long_enough_to_gate(self) -> None:
+        calls = 0
+
+        def fn() -> None:
+            nonlocal calls
+            calls += 1
+
+        ops, relative, peak = bench._measure(fn, repeat=3)
+        self.assertGreater(ops, 0)
+        self.assertGreater(relative, 0)
+        # 三轮计时，每轮都按 _MIN_ROUND_S 放大调用次数
+        self.assertGreaterEqual(calls / ops, 3 * bench._MIN_ROUND_S * 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,496 @@
+"""dmxapi_common.py 公共基础设施的离线单元测试（不访问网络）。
+
+运行：python -m pytest .codex/skills/nanobananapro-dmxapi-skill/tests
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import contextlib
+import email.message
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+import urllib.response
+import zlib
+from pathlib import Path
+from typing import List
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+
+import dmxapi_common as common  # noqa: E402
+
+
+def _network_error() -> RuntimeError:
+    try:
+        raise urllib.error.URLError("connection refused")
+    except urllib.error.URLError as e:
+        try:
+            raise RuntimeError(f"网络错误：{e}") from e
+        except RuntimeError as wrapped:
+            return wrapped
+
+
+class _TempDirTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+
+class HttpStatusErrorTest(unittest.TestCase):
+    BODY = '{"error": {"message": "请求体过大"}}'.encode("utf-8")
+
+    def _error(self, body: bytes, encoding: str = "", status: int = 413) -> common._HttpStatusError:
+        headers = email.message.Message()
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        headers["Retry-After"] = "7"
+        e = urllib.error.HTTPError("http://x/v1", status, "error", headers, io.BytesIO(body))
+        return common._http_status_error(e, "http://x/v1")
+
+    def test_plain_body(self) -> None:
+        err = self._error(self.BODY)
+        self.assertIn("请求体过大", str(err))
+        self.assertEqual((err.status, err.retry_after), (413, 7.0))
+
+    def test_gzip_body_is_inflated(self) -> None:
+        self.assertIn("请求体过大", str(self._error(gzip.compress(self.BODY), "gzip")))
+
+    def test_zlib_and_raw_deflate_bodies_are_inflated(self) -> None:
+        raw_deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        bodies = [zlib.compress(self.BODY), raw_deflate.compress(self.BODY) + raw_deflate.flush()]
+        for body in bodies:
+            self.assertIn("请求体过大", str(self._error(body, "deflate")))
+
+    def test_undecodable_body_is_kept(self) -> None:
+        self.assertIn("not gzip", str(self._error(b"not gzip", "gzip", status=502)))
+
+
+class RunWithRoutesTest(_TempDirTest):
+    def _args(self, **overrides) -> argparse.Namespace:
+        values = dict(
+            base_url="http://primary",
+            fallback_base_url=[],
+            model="badmodel",
+            fallback_model=["goodmodel"],
+            endpoint="",
+            route_state=os.path.join(self.tmp, "routes.json"),
+            cache_dir=self.tmp,
+            breaker_failures=3,
+            breaker_cooldown_s=60.0,
+            timeout_s=300,
+            metrics_file="",
+        )
+        values.update(overrides)
+        return argparse.Namespace(**values)
+
+    def test_failed_route_is_not_retried_while_untried_route_is_healthy(self) -> None:
+        calls = []
+
+        def run_job(args: argparse.Namespace) -> int:
+            calls.append(args.model)
+            if args.model == "badmodel":
+                raise _network_error()
+            return 0
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(common._run_with_routes(self._args(), run_job), 0)
+        self.assertEqual(calls, ["badmodel", "goodmodel"])
+
+    def test_raises_once_every_route_was_tried(self) -> None:
+        calls = []
+
+        def run_job(args: argparse.Namespace) -> int:
+            calls.append((args.base_url, args.model))
+            raise _network_error()
+
+        args = self._args(fallback_base_url=["http://backup"])
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(RuntimeError):
+                common._run_with_routes(args, run_job)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(len(set(calls)), 4)
+
+
+class SingleFlightTest(_TempDirTest):
+    def test_follower_emits_image_saved_only_for_images(self) -> None:
+        follower_waiting = threading.Event()
+
+        def quiet_print(*args, **kwargs) -> None:
+            if str(args[0]).startswith("🔗"):
+                follower_waiting.set()
+
+        def leader_job(args: argparse.Namespace) -> int:
+            # 等第二个 job 挂到同一请求上之后再落盘，保证它走复用路径
+            follower_waiting.wait(5)
+            os.makedirs(args.out_dir, exist_ok=True)
+            for name in ("a_1.png", "a_1.png.b64.txt", "a_1.png.signature.txt"):
+                path = os.path.join(args.out_dir, name)
+                with open(path, "wb") as f:
+                    f.write(b"x")
+                common._note_output(path)
+            return 0
+
+        flight = common._SingleFlight("copy")
+        out_dir = os.path.join(self.tmp, "out")
+        events = io.StringIO()
+        codes = {}
+
+        def run(job_id: str, prefix: str) -> None:
+            args = argparse.Namespace(prefix=prefix, out_dir=out_dir, metrics_file="")
+            codes[job_id] = flight.run("fp", job_id, args, leader_job)
+
+        with mock.patch.object(common, "_event_stream", events), mock.patch.object(common, "print", quiet_print, create=True):
+            leader = threading.Thread(target=run, args=("1", "a"))
+            leader.start()
+            follower = threading.Thread(target=run, args=("2", "b"))
+            follower.start()
+            leader.join(10)
+            follower.join(10)
+
+        self.assertEqual(codes, {"1": 0, "2": 0})
+        self.assertEqual(
+            sorted(os.listdir(out_dir)),
+            ["a_1.png", "a_1.png.b64.txt", "a_1.png.signature.txt", "b_1.png", "b_1.png.b64.txt", "b_1.png.signature.txt"],
+        )
+        rows = [json.loads(line) for line in events.getvalue().splitlines()]
+        self.assertEqual([(r["event"], os.path.basename(r["path"]), r["mime"]) for r in rows], [("image_saved", "b_1.png", "image/png")])
+
+
+class InflateReaderTest(unittest.TestCase):
+    def test_gzip_stream_is_read_line_by_line(self) -> None:
+        lines = [f"data: {{\"n\": {i}}}\n\n".encode("utf-8") for i in range(2000)]
+        reader = io.BufferedReader(common._InflateReader(io.BytesIO(gzip.compress(b"".join(lines))), "gzip"))
+        events = list(common._iter_sse_events(reader))
+        self.assertEqual(len(events), 2000)
+        self.assertEqual(events[-1], ("message", '{"n": 1999}'))
+
+    def test_raw_deflate_readall(self) -> None:
+        deflater = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        body = os.urandom(200_000)
+        reader = common._InflateReader(io.BytesIO(deflater.compress(body) + deflater.flush()), "deflate")
+        self.assertEqual(reader.readall(), body)
+
+
+class SseEventsTest(unittest.TestCase):
+    def test_multiline_data_comments_and_named_events(self) -> None:
+        stream = io.BytesIO(b": keep-alive\r\nevent: partial\r\ndata: a\r\ndata: b\r\n\r\ndata: tail")
+        self.assertEqual(list(common._iter_sse_events(stream)), [("partial", "a\nb"), ("message", "tail")])
+
+
+class RateLimiterTest(_TempDirTest):
+    def test_token_bucket_spaces_requests_after_burst(self) -> None:
+        limiter = common._RateLimiter(self.tmp, rpm=120, burst=2)
+        started = time.monotonic()
+        for _ in range(3):
+            with limiter.slot("host_model"):
+                pass
+        # 前两个请求用掉突发额度，第三个要等约 0.5s（120 rpm）补回一个令牌
+        self.assertGreaterEqual(time.monotonic() - started, 0.4)
+
+    def test_max_concurrent_blocks_until_release(self) -> None:
+        limiter = common._RateLimiter(self.tmp, rpm=0, max_concurrent=1)
+        ticket = limiter.acquire("scope")
+        acquired = threading.Event()
+
+        def second() -> None:
+            limiter.release("scope", limiter.acquire("scope"))
+            acquired.set()
+
+        threading.Thread(target=second, daemon=True).start()
+        self.assertFalse(acquired.wait(0.5))
+        limiter.release("scope", ticket)
+        self.assertTrue(acquired.wait(5))
+
+    def test_429_blocks_scope_for_retry_after(self) -> None:
+        limiter = common._RateLimiter(self.tmp, rpm=60, burst=5)
+        with self.assertRaises(common._HttpStatusError):
+            with limiter.slot("scope"):
+                raise common._HttpStatusError("429", status=429, retry_after=30)
+        state = common._RateLimiter._read(limiter._paths("scope")[0])
+        self.assertEqual(state["tokens"], 0.0)
+        self.assertGreater(state["blocked_until"], time.time() + 25)
+        self.assertEqual(state["inflight"], {})
+
+
+class KeyPoolTest(unittest.TestCase):
+    def _pool(self, *keys: str, strategy: str = "least-loaded") -> common._KeyPool:
+        return common._KeyPool([common._PooledKey(k, rpm=0, max_concurrent=0) for k in keys], strategy=strategy)
+
+    def test_least_loaded_spreads_concurrent_leases(self) -> None:
+        pool = self._pool("k1", "k2")
+        with pool.lease() as a, pool.lease() as b:
+            self.assertEqual({a.key, b.key}, {"k1", "k2"})
+
+    def test_auth_error_benches_key_and_retries_with_next(self) -> None:
+        pool = self._pool("bad", "good", strategy="round-robin")
+        used = []
+
+        def run_job(args: argparse.Namespace) -> int:
+            used.append(args.api_key)
+            if args.api_key == "bad":
+                raise common._HttpStatusError("401", status=401)
+            return 0
+
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(common._run_with_key_pool(pool, argparse.Namespace(), run_job), 0)
+            self.assertEqual(common._run_with_key_pool(pool, argparse.Namespace(), run_job), 0)
+        self.assertEqual(used, ["bad", "good", "good"])
+        self.assertEqual(pool.available(), 1)
+
+
+class RouteBreakersTest(_TempDirTest):
+    ROUTES = [("http://a", "m1"), ("http://b", "m1")]
+
+    def test_open_half_open_closed_cycle(self) -> None:
+        breakers = common._RouteBreakers(os.path.join(self.tmp, "routes.json"), self.ROUTES, failures=2, cooldown_s=0.2)
+        primary = self.ROUTES[0]
+        breakers.record(self.ROUTES[1], ok=True, latency_s=5.0)
+        self.assertIsNone(breakers.record(primary, ok=False, latency_s=1.0))
+        self.assertEqual(breakers.record(primary, ok=False, latency_s=1.0), "open")
+        route, info, _ = breakers.pick()
+        self.assertEqual((route, info["breaker"]), (self.ROUTES[1], "closed"))
+        time.sleep(0.25)
+        # 冷却结束：主线路放行一个探测请求，探测期间其他调用方看到的仍是熔断
+        route, info, _ = breakers.pick()
+        self.assertEqual((route, info["breaker"]), (primary, "half_open"))
+        self.assertEqual(breakers.pick()[0], self.ROUTES[1])
+        self.assertEqual(breakers.record(primary, ok=True, latency_s=0.5), "closed")
+
+    def test_all_open_reports_wait(self) -> None:
+        breakers = common._RouteBreakers(os.path.join(self.tmp, "routes.json"), self.ROUTES, failures=1, cooldown_s=30)
+        for route in self.ROUTES:
+            breakers.record(route, ok=False, latency_s=None)
+        route, _, wait_s = breakers.pick()
+        self.assertIsNone(route)
+        self.assertGreater(wait_s, 25)
+
+    def test_prefers_lower_latency_within_model(self) -> None:
+        breakers = common._RouteBreakers(os.path.join(self.tmp, "routes.json"), self.ROUTES)
+        breakers.record(self.ROUTES[0], ok=True, latency_s=9.0)
+        breakers.record(self.ROUTES[1], ok=True, latency_s=2.0)
+        self.assertEqual(breakers.pick()[0], self.ROUTES[1])
+
+
+class AimdControllerTest(unittest.TestCase):
+    def test_additive_increase(self) -> None:
+        aimd = common._AimdController(2, maximum=8)
+        # 每完成约一个窗口（当前并发数）的请求并发 +1
+        for _ in range(6):
+            aimd.on_result(latency_s=1.0, throttled=False)
+        self.assertEqual(aimd.current, 4)
+
+    def test_throttle_halves_once_per_p90_period(self) -> None:
+        aimd = common._AimdController(8, maximum=8)
+        aimd.on_result(latency_s=None, throttled=True)
+        aimd.on_result(latency_s=None, throttled=True)
+        self.assertEqual((aimd.current, aimd.decreases), (4, 1))
+
+    def test_fixed_mode_never_changes(self) -> None:
+        aimd = common._AimdController(3, adaptive=False)
+        aimd.on_result(latency_s=None, throttled=True)
+        self.assertEqual(aimd.current, 3)
+
+
+class JobSchedulerTest(unittest.TestCase):
+    def _job(self, job_id: str, expected_s: float, priority: str = "normal", waited_s: float = 0.0) -> common._QueuedJob:
+        item = common._QueuedJob(job_id, {"prompt": job_id, "priority": priority})
+        item.expected_s = expected_s
+        item.enqueued_at -= waited_s
+        return item
+
+    def _drain(self, queue: common._JobScheduler) -> List[str]:
+        order = []
+        while len(queue):
+            seq, item = queue.peek()
+            order.append(queue.take(seq).job_id)
+        return order
+
+    def test_priority_then_shortest_job_first(self) -> None:
+        queue = common._JobScheduler(aging=0.0)
+        for item in (self._job("4k", 120), self._job("1k", 10), self._job("bulk", 1, "bulk"), self._job("ui", 60, "interactive")):
+            queue.push(item)
+        self.assertEqual(self._drain(queue), ["ui", "1k", "4k", "bulk"])
+
+    def test_aging_lets_long_waiting_job_overtake(self) -> None:
+        queue = common._JobScheduler(aging=1.0)
+        queue.push(self._job("old-4k", 120, waited_s=200))
+        queue.push(self._job("new-1k", 10))
+        self.assertEqual(self._drain(queue), ["old-4k", "new-1k"])
+
+    def test_max_wait_overrides_priority(self) -> None:
+        queue = common._JobScheduler(aging=0.0, max_wait_s=60)
+        queue.push(self._job("starved", 300, "bulk", waited_s=61))
+        queue.push(self._job("ui", 1, "interactive"))
+        self.assertEqual(self._drain(queue), ["starved", "ui"])
+
+    def test_fifo(self) -> None:
+        queue = common._JobScheduler(policy="fifo")
+        for item in (self._job("a", 100), self._job("b", 1, "interactive")):
+            queue.push(item)
+        self.assertEqual(self._drain(queue), ["a", "b"])
+
+    def test_priority_parsing(self) -> None:
+        self.assertEqual([common._job_priority({"priority": v}) for v in ("HIGH", 7, 42, "x")], [1, 7, 9, 2])
+        self.assertEqual(common._job_priority({}), 2)
+
+
+class ParseHelpersTest(_TempDirTest):
+    def test_parse_bytes(self) -> None:
+        self.assertEqual([common._parse_bytes(v) for v in ("512M", "2G", "1.5k", "1048576", "64MB")], [512 << 20, 2 << 30, 1536, 1 << 20, 64 << 20])
+
+    def test_grid_expansion(self) -> None:
+        prompts = os.path.join(self.tmp, "prompts.txt")
+        with open(prompts, "w", encoding="utf-8") as f:
+            f.write("a cat, sitting\n\na dog\n")
+        grid = common._parse_grid(["aspect-ratio=1:1,16:9", f"prompt=@{prompts}"])
+        self.assertEqual(grid, {"aspect_ratio": ["1:1", "16:9"], "prompt": ["a cat, sitting", "a dog"]})
+        jobs = common._grid_jobs(grid)
+        self.assertEqual(len(jobs), 4)
+        self.assertEqual(jobs[0], ("cell001", {"aspect_ratio": "1:1", "prompt": "a cat, sitting"}))
+
+    def test_grid_rejects_malformed_spec(self) -> None:
+        with self.assertRaises(SystemExit):
+            common._parse_grid(["aspect_ratio"])
+
+    def test_job_to_argv(self) -> None:
+        argv = common._job_to_argv({"prompt": "x", "image": ["a.png", "b.png"], "stream": True, "id": "j1"})
+        self.assertEqual(argv, ["--prompt", "x", "--image", "a.png", "--image", "b.png", "--stream"])
+
+
+class JobJournalTest(_TempDirTest):
+    def _args(self, journal: str) -> argparse.Namespace:
+        return argparse.Namespace(
+            concurrency=2, min_concurrency=1, max_concurrency=2, concurrency_mode="aimd", dedupe="off",
+            cache_dir=self.tmp, scheduler="sjf", aging_rate=0.5, max_wait_s=300.0, journal=journal,
+            max_inflight_bytes=0, batch_retries=0, metrics_file="",
+        )
+
+    def _run(self, journal: str, jobs, fail: set) -> List[str]:
+        ran = []
+
+        def run_job(job_args: argparse.Namespace) -> int:
+            ran.append(job_args.job_id)
+            if job_args.job_id in fail:
+                raise RuntimeError("boom")
+            return 0
+
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            common._run_batch(
+                self._args(journal),
+                build_job_args=lambda job_id, job: argparse.Namespace(job_id=job_id, prefix=job_id, out_dir=self.tmp),
+                run_job=run_job,
+                request_fingerprint=lambda a: None,
+                estimate_cost=lambda a: ("k", 1.0),
+                estimate_memory=lambda a: 0,
+                jobs=iter(jobs),
+            )
+        return sorted(ran)
+
+    def test_rerun_skips_done_jobs(self) -> None:
+        journal = os.path.join(self.tmp, "run.jsonl")
+        jobs = [("a", {"prompt": "a"}), ("b", {"prompt": "b"}), ("c", {"prompt": "c"})]
+        self.assertEqual(self._run(journal, jobs, fail={"b"}), ["a", "b", "c"])
+        self.assertEqual(self._run(journal, jobs, fail=set()), ["b"])
+        # 改过内容的 job 按新 job 重跑
+        self.assertEqual(self._run(journal, [("a", {"prompt": "a2"})], fail=set()), ["a"])
+
+    def test_load_done_uses_last_state_and_ignores_torn_line(self) -> None:
+        journal = os.path.join(self.tmp, "run.jsonl")
+        rows = [{"key": "a:1", "state": "done"}, {"key": "b:1", "state": "done"}, {"key": "b:1", "state": "inflight"}]
+        with open(journal, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(r) + "\n" for r in rows) + '{"key": "c:1", "sta')
+        self.assertEqual(set(common._JobJournal._load_done(journal)), {"a:1"})
+
+
+class RunSingleTest(_TempDirTest):
+    def _events(self, run, **kwargs) -> List[dict]:
+        events = io.StringIO()
+        with mock.patch.object(common, "_event_stream", events):
+            try:
+                common._run_single(argparse.Namespace(cache_dir=self.tmp), run, **kwargs)
+            except RuntimeError:
+                pass
+        return [json.loads(line) for line in events.getvalue().splitlines()]
+
+    def test_queued_then_done_like_batch_mode(self) -> None:
+        rows = self._events(lambda a: 0, estimate_cost=lambda a: ("k", 12.0))
+        self.assertEqual([r["event"] for r in rows], ["queued", "done"])
+        self.assertEqual((rows[0]["priority"], rows[0]["expected_s"]), (2, 12.0))
+        self.assertEqual(rows[1]["status"], "ok")
+
+    def test_queued_then_error(self) -> None:
+        def fail(args: argparse.Namespace) -> int:
+            raise RuntimeError("boom")
+
+        self.assertEqual([r["event"] for r in self._events(fail)], ["queued", "error"])
+
+
+class PromMetricsTest(unittest.TestCase):
+    def test_render_histogram_and_counters(self) -> None:
+        metrics = common._PromMetrics("gemini")
+        args = argparse.Namespace(model="m", image_size="2K")
+        metrics.observe_record(args, {"status": "ok", "latency_s": 3.0})
+        metrics.observe_record(args, {"status": "ok", "latency_s": 400.0})
+        metrics.observe_record(args, {"status": "error"})
+        metrics.observe_record(args, {"status": "coalesced"})
+        metrics.observe_record(args, {"event": "batch_summary", "status": "ok"})
+        text = metrics.render()
+        labels = 'api="gemini",model="m",size="2K"'
+        self.assertIn(f'dmxapi_image_requests_total{{{labels},status="ok"}} 2', text)
+        self.assertIn(f'dmxapi_image_requests_total{{{labels},status="error"}} 1', text)
+        self.assertIn(f'dmxapi_image_request_latency_seconds_bucket{{{labels},le="2.5"}} 0', text)
+        self.assertIn(f'dmxapi_image_request_latency_seconds_bucket{{{labels},le="5"}} 1', text)
+        self.assertIn(f'dmxapi_image_request_latency_seconds_bucket{{{labels},le="+Inf"}} 2', text)
+        self.assertIn(f'dmxapi_image_request_latency_seconds_sum{{{labels}}} 403.000', text)
+        self.assertIn('dmxapi_image_cache_hits_total{api="gemini",cache="coalesced"} 1', text)
+        self.assertEqual(text.count("# TYPE dmxapi_image_requests_total counter"), 1)
+
+
+class CassetteTest(_TempDirTest):
+    def test_record_then_replay_dedupes_image_blobs(self) -> None:
+        image_b64 = base64.b64encode(os.urandom(8192)).decode("ascii")
+        body = json.dumps({"data": [{"b64_json": image_b64}]}).encode("utf-8")
+        url = "http://127.0.0.1:9/v1/images/generations"
+        headers = email.message.Message()
+        headers["Content-Type"] = "application/json"
+
+        recorder = common._Cassette(self.tmp, "record")
+        for _ in range(2):
+            req = urllib.request.Request(url, data=b'{"prompt":"x"}', method="POST")
+            resp = urllib.response.addinfourl(io.BytesIO(body), headers, url, 200)
+            self.assertEqual(recorder.record(req, resp).read(), body)
+        blobs = [name for _, _, names in os.walk(os.path.join(self.tmp, "blobs")) for name in names]
+        self.assertEqual(len(blobs), 1)
+
+        player = common._Cassette(self.tmp, "replay", speed=0)
+        # 回放只按路径匹配，换了 base URL 也能命中
+        req = urllib.request.Request("http://other/v1/images/generations", data=b'{"prompt":"x"}', method="POST")
+        resp = player.replay(req)
+        self.assertEqual((resp.status, resp.read()), (200, body))
+        with self.assertRaises(urllib.error.URLError):
+            player.replay(urllib.request.Request("http://other/v1/images/edits", data=b"", method="POST"))
+
+
+class JsonCodecTest(unittest.TestCase):
+    def test_round_trip_keeps_non_ascii_compact(self) -> None:
+        obj = {"prompt": "画一只猫", "n": 1, "parts": [{"text": "a"}]}
+        raw = common._json_dumps_bytes(obj)
+        self.assertIn("画一只猫".encode("utf-8"), raw)
+        self.assertNotIn(b", ", raw)
+        self.assertEqual(common._json_loads_bytes(raw), obj)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,9 @@ DMXAPI OpenAI-img 调用工具（最小依赖，标准库实现）。
 - 图片编辑：/v1/images/edits（multipart）
 - dry-run 请求体预览
 - b64_json 保存、url 打印/可选下载
+- 文生图流式返回（SSE partial_images）：预览图边到边存
+- --metrics-file 追加每次请求的耗时记录（JSON Lines）
+- --batch 批量/常驻模式：按 429/503 与延迟自适应调整并发（AIMD）
 """
 
 from __future__ import annotations
@@ -14,23 +17,65 @@ from __future__ import annotations
 import argparse
 import base64
 import datetime as _dt
+import hashlib
 import json
 import os
 import sys
+import time
 import urllib.error
 import urllib.parse
 import urllib.request
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Tuple
-
-
-def _mask_secret(value: str, keep: int = 6) -> str:
-    if not value:
-        return ""
-    if len(value) <= keep:
-        return "*" * len(value)
-    return value[:keep] + "*" * (len(value) - keep)
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:  # 可选依赖：仅在 --fit-inputs 需要压缩/缩放输入图片时使用
+    from PIL import Image as _PILImage
+except ImportError:  # pragma: no cover - 未安装 Pillow 时退化为只校验体积
+    _PILImage = None
+
+# 限流、熔断、批量调度、事件流、指标、录制回放等公共基础设施见同目录的 dmxapi_common.py
+from dmxapi_common import (
+    _build_opener,
+    _default_cache_dir,
+    _emit_event,
+    _emit_image_saved,
+    _FIT_MAX_SIDES,
+    _http_status_error,
+    _IMAGE_MIME_BY_EXT,
+    _install_cassette,
+    _iter_batch_jobs,
+    _iter_sse_events,
+    _job_to_argv,
+    _json_dumps_bytes,
+    _json_loads_bytes,
+    _KeyPool,
+    _load_api_keys,
+    _mask_secret,
+    _METRICS,
+    _note_output,
+    _parse_bytes,
+    _parse_grid,
+    _rate_limited,
+    _record_metrics,
+    _response_reader,
+    _run_batch,
+    _run_single,
+    _run_sweep,
+    _run_with_key_pool,
+    _run_with_routes,
+    _SHARED_NON_REQUEST_KEYS,
+    _start_event_stream,
+    _start_metrics_export,
+    _start_prewarm,
+)
+
+_MULTIPART_BOUNDARY_PREFIX = "----dmxapi-openai-img-"
+# /images/edits 单张输入图片上限 50MB；multipart 直接传原始字节（不经 base64），以此作为整个请求体的默认预算
+DEFAULT_MAX_REQUEST_BYTES = 50 * 1024 * 1024
+# 并发读取输入图片的线程数上限
+MAX_READ_WORKERS = 8
 
 
 def _build_endpoint(base_url: str, path_suffix: str) -> str:
@@ -54,14 +99,7 @@ def _mime_to_ext(mime_type: str) -> str:
 
 
 def _guess_mime_type(path: str) -> str:
-    ext = Path(path).suffix.lower()
-    return {
-        ".jpg": "image/jpeg",
-        ".jpeg": "image/jpeg",
-        ".png": "image/png",
-        ".webp": "image/webp",
-        ".gif": "image/gif",
-    }.get(ext, "application/octet-stream")
+    return _IMAGE_MIME_BY_EXT.get(Path(path).suffix.lower(), "application/octet-stream")
 
 
 def _guess_image_mime_by_bytes(raw: bytes, fallback: str = "image/png") -> str:
@@ -78,7 +116,7 @@ def _guess_image_mime_by_bytes(raw: bytes, fallback: str = "image/png") -> str:
 
 
 def _http_post_json(url: str, headers: Dict[str, str], payload: Dict[str, object], timeout_s: int) -> Dict[str, object]:
-    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    body = _json_dumps_bytes(payload)
     req = urllib.request.Request(url=url, data=body, headers=headers, method="POST")
     return _http_read_json(req, timeout_s)
 
@@ -119,14 +157,35 @@ def _encode_multipart(
     return b"".join(chunks)
 
 
+def _estimate_multipart_bytes(*, fields: Iterable[Tuple[str, str]], files: Iterable[Tuple[str, str, str, int]]) -> int:
+    """与 _encode_multipart 输出逐字节一致的体积估算，files 只需给出各文件字节数。"""
+    boundary_len = len(_MULTIPART_BOUNDARY_PREFIX) + 32
+    total = 0
+    for name, value in fields:
+        total += 2 + boundary_len + 2
+        total += len(f'Content-Disposition: form-data; name="{name}"\r\n\r\n'.encode("utf-8"))
+        total += len(value.encode("utf-8")) + 2
+    for field_name, filename, mime_type, size in files:
+        total += 2 + boundary_len + 2
+        total += len(
+            (
+                f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+                f"Content-Type: {mime_type}\r\n\r\n"
+            ).encode("utf-8")
+        )
+        total += size + 2
+    return total + 2 + boundary_len + 4
+
+
 def _http_post_multipart(
     url: str,
     headers: Dict[str, str],
     fields: Iterable[Tuple[str, str]],
     files: Iterable[Tuple[str, str, str, bytes]],
     timeout_s: int,
+    opener: Optional[urllib.request.OpenerDirector] = None,
 ) -> Dict[str, object]:
-    boundary = f"----dmxapi-openai-img-{uuid.uuid4().hex}"
+    boundary = f"{_MULTIPART_BOUNDARY_PREFIX}{uuid.uuid4().hex}"
     body = _encode_multipart(fields=fields, files=files, boundary=boundary)
     req_headers = {
         **headers,
@@ -134,21 +193,68 @@ def _http_post_multipart(
         "Content-Length": str(len(body)),
     }
     req = urllib.request.Request(url=url, data=body, headers=req_headers, method="POST")
-    return _http_read_json(req, timeout_s)
+    return _http_read_json(req, timeout_s, opener=opener)
+
+
+def _http_read_json(
+    req: urllib.request.Request,
+    timeout_s: int,
+    opener: Optional[urllib.request.OpenerDirector] = None,
+) -> Dict[str, object]:
+    urlopen = opener.open if opener is not None else urllib.request.urlopen
+    sent = time.perf_counter()
+    _emit_event("sent", url=req.full_url, bytes=len(req.data or b""))
+    _METRICS.inc("dmxapi_image_transfer_bytes_total", len(req.data or b""), direction="upload")
+    try:
+        with urlopen(req, timeout=timeout_s) as resp:
+            body_reader = _response_reader(resp)
+            _emit_event(
+                "first_byte",
+                status=resp.status,
+                ttfb_s=round(time.perf_counter() - sent, 3),
+                encoding=resp.headers.get("Content-Encoding"),
+            )
+            raw = body_reader.read()
+            return _json_loads_bytes(raw)
+    except urllib.error.HTTPError as e:
+        raise _http_status_error(e, req.full_url) from e
+    except urllib.error.URLError as e:
+        raise RuntimeError(f"网络错误：{e}") from e
 
 
-def _http_read_json(req: urllib.request.Request, timeout_s: int) -> Dict[str, object]:
+def _http_post_sse(
+    url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, object],
+    timeout_s: int,
+) -> Iterator[Dict[str, object]]:
+    body = _json_dumps_bytes(payload)
+    req_headers = {**headers, "Accept": "text/event-stream"}
+    req = urllib.request.Request(url=url, data=body, headers=req_headers, method="POST")
+    sent = time.perf_counter()
+    _emit_event("sent", url=url, bytes=len(body), stream=True)
+    _METRICS.inc("dmxapi_image_transfer_bytes_total", len(body), direction="upload")
     try:
         with urllib.request.urlopen(req, timeout=timeout_s) as resp:
-            raw = resp.read()
-            return json.loads(raw.decode("utf-8"))
+            body_reader = _response_reader(resp)
+            _emit_event(
+                "first_byte",
+                status=resp.status,
+                ttfb_s=round(time.perf_counter() - sent, 3),
+                encoding=resp.headers.get("Content-Encoding"),
+            )
+            for event, data in _iter_sse_events(body_reader):
+                if data.strip() == "[DONE]":
+                    return
+                try:
+                    obj = _json_loads_bytes(data)
+                except ValueError:
+                    raise RuntimeError(f"SSE 事件不是合法 JSON：event={event}\n{data[:800]}")
+                if isinstance(obj, dict):
+                    obj.setdefault("type", event)
+                    yield obj
     except urllib.error.HTTPError as e:
-        raw = e.read()
-        raise RuntimeError(
-            "HTTP 请求失败："
-            f"status={getattr(e, 'code', 'unknown')} url={req.full_url}\n"
-            f"响应片段：\n{raw[:1200].decode('utf-8', errors='replace')}"
-        ) from e
+        raise _http_status_error(e, req.full_url) from e
     except urllib.error.URLError as e:
         raise RuntimeError(f"网络错误：{e}") from e
 
@@ -170,7 +276,111 @@ def _save_image_bytes(*, out_dir: str, prefix: str, index: int, mime_type: str,
     path = os.path.join(out_dir, f"{prefix}_{ts}_{index}.{ext}")
     with open(path, "wb") as f:
         f.write(raw)
-    return path
+    return _note_output(path)
+
+
+def _file_sha256(path: Path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _fit_image_file(path: Path, *, sha256: str, max_side: Optional[int], fmt: str, quality: int, cache_dir: Path) -> Path:
+    """将输入图片重新编码（可选缩放）为 JPEG/WebP，结果按源图 sha256 + 参数缓存。"""
+    if _PILImage is None:
+        raise SystemExit("--fit-inputs 需要 Pillow：pip install Pillow")
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with _PILImage.open(path) as im:
+        has_alpha = im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info)
+        # JPEG 不支持透明通道，带 alpha 的输入自动改用 WebP（编辑接口常依赖透明区域）
+        out_fmt = "webp" if fmt == "jpeg" and has_alpha else fmt
+        ext = "jpg" if out_fmt == "jpeg" else out_fmt
+        if max_side and max(im.size) <= max_side:
+            max_side = None
+        cached = cache_dir / f"{sha256}_{max_side or 'orig'}_q{quality}.{ext}"
+        if cached.is_file():
+            _METRICS.inc("dmxapi_image_cache_hits_total", cache="fit")
+            return cached
+        if max_side:
+            im = im.copy()
+            im.thumbnail((max_side, max_side), _PILImage.LANCZOS)
+        if out_fmt == "jpeg" and im.mode != "RGB":
+            im = im.convert("RGB")
+        elif out_fmt == "webp" and im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if has_alpha else "RGB")
+        tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+        im.save(tmp, format=out_fmt.upper(), quality=quality)
+    os.replace(tmp, cached)
+    return cached
+
+
+def _upload_filenames(paths: List[Path], current: List[Path]) -> List[str]:
+    """multipart 中的文件名：压缩后的图片沿用原文件名主干，仅扩展名随格式变化。"""
+    return [src.name if p == src else f"{src.stem}{p.suffix}" for src, p in zip(paths, current)]
+
+
+def _preflight_edit_inputs(
+    paths: List[Path],
+    fields: List[Tuple[str, str]],
+    *,
+    max_bytes: int,
+    fit: bool,
+    fit_format: str,
+    fit_quality: int,
+    cache_dir: Path,
+) -> Tuple[List[Path], List[str], int]:
+    """发送前计算 multipart 请求体大小；超出预算时按需压缩/缩放输入图片，仍超出则直接报错。
+
+    返回 (实际上传的文件, 上传文件名, 请求体字节数)，字节数按最终文件名计算，与发送的请求体一致。
+    """
+
+    def estimate(current: List[Path]) -> int:
+        return _estimate_multipart_bytes(
+            fields=fields,
+            files=[
+                ("image", name, _guess_mime_type(str(p)), p.stat().st_size)
+                for name, p in zip(_upload_filenames(paths, current), current)
+            ],
+        )
+
+    size = estimate(paths)
+    if not max_bytes or size <= max_bytes:
+        return paths, _upload_filenames(paths, paths), size
+    if not fit:
+        raise SystemExit(
+            f"请求体约 {size} 字节，超过上限 {max_bytes} 字节；"
+            "可追加 --fit-inputs 自动压缩输入图片，或调大 --max-request-bytes"
+        )
+
+    current = list(paths)
+    hashes: Dict[Path, str] = {}
+    for max_side in _FIT_MAX_SIDES:
+        # 从最大的图片开始逐张替换，达到预算即停止，尽量少动画质
+        for i in sorted(range(len(current)), key=lambda k: current[k].stat().st_size, reverse=True):
+            src = paths[i]
+            if src not in hashes:
+                hashes[src] = _file_sha256(src)
+            new_path = _fit_image_file(
+                src,
+                sha256=hashes[src],
+                max_side=max_side,
+                fmt=fit_format,
+                quality=fit_quality,
+                cache_dir=cache_dir,
+            )
+            if new_path.stat().st_size >= current[i].stat().st_size:
+                continue
+            current[i] = new_path
+            size = estimate(current)
+            print(f"🗜️ 已压缩输入图片：{src} -> {new_path}（{src.stat().st_size} -> {new_path.stat().st_size} 字节）")
+            if size <= max_bytes:
+                return current, _upload_filenames(paths, current), size
+    raise SystemExit(f"压缩后请求体仍约 {size} 字节，超过上限 {max_bytes} 字节")
 
 
 def _build_auth_headers(api_key: str, auth_header: str) -> Dict[str, str]:
@@ -197,6 +407,29 @@ def _print_dry_run(endpoint: str, headers: Dict[str, str], body: object) -> None
         print(str(body))
 
 
+def _timed_request(
+    args: argparse.Namespace, send: Callable[[], Dict[str, object]], **record: object
+) -> Dict[str, object]:
+    """执行一次阻塞请求并记录耗时（成功/失败都会写 metrics）。"""
+    started = time.perf_counter()
+    try:
+        result = send()
+    except Exception as e:
+        _record_metrics(args, {**record, "status": "error", "latency_s": round(time.perf_counter() - started, 3), "error": str(e)[:300]})
+        raise
+    latency = round(time.perf_counter() - started, 3)
+    _record_metrics(args, {**record, "status": "ok", "latency_s": latency, "images": len(list(_iter_data_items(result)))})
+    return result
+
+
+def _output_mime_fallback(args: argparse.Namespace) -> str:
+    return {
+        "png": "image/png",
+        "jpeg": "image/jpeg",
+        "webp": "image/webp",
+    }.get(getattr(args, "output_format", None) or "", "image/png")
+
+
 def _iter_data_items(resp: Dict[str, object]) -> Iterable[Dict[str, object]]:
     rows = resp.get("data")
     if not isinstance(rows, list):
@@ -233,25 +466,100 @@ def run_generate(args: argparse.Namespace, common_headers: Dict[str, str]) -> in
     if args.style:
         payload["style"] = args.style
 
+    if args.stream or args.partial_images is not None:
+        payload["stream"] = True
+        if args.partial_images is not None:
+            payload["partial_images"] = args.partial_images
+
     headers = {**common_headers, "Content-Type": "application/json"}
     if args.dry_run:
         _print_dry_run(endpoint, headers, payload)
         return 0
 
-    result = _http_post_json(endpoint, headers, payload, args.timeout_s)
+    # 限流槽位覆盖整个请求（流式时直到流结束），多进程共享同一状态目录
+    with _rate_limited(args, urllib.parse.urlsplit(endpoint).netloc, args.model):
+        if payload.get("stream"):
+            return _run_generate_stream(endpoint, headers, payload, args)
+        result = _timed_request(args, lambda: _http_post_json(endpoint, headers, payload, args.timeout_s))
     return _handle_result(result, args)
 
 
+def _run_generate_stream(endpoint: str, headers: Dict[str, str], payload: Dict[str, object], args: argparse.Namespace) -> int:
+    """流式文生图：每收到一张 partial 预览就落盘，最后保存完整图；首张预览耗时单独计入 metrics。"""
+    started = time.perf_counter()
+    first_preview_s: Optional[float] = None
+    partials = 0
+    saved = 0
+    fallback = _output_mime_fallback(args)
+    try:
+        for event in _http_post_sse(endpoint, headers, payload, args.timeout_s):
+            etype = str(event.get("type") or "")
+            if etype == "error" or event.get("error"):
+                raise RuntimeError(f"流式返回错误：{json.dumps(event, ensure_ascii=False)[:1200]}")
+            b64 = event.get("b64_json")
+            if not isinstance(b64, str) or not b64:
+                continue
+            raw = base64.b64decode(b64)
+            mime_type = _guess_image_mime_by_bytes(raw, fallback)
+            if etype.endswith("partial_image"):
+                if first_preview_s is None:
+                    first_preview_s = time.perf_counter() - started
+                index = event.get("partial_image_index", partials)
+                path = _save_image_bytes(
+                    out_dir=args.out_dir, prefix=f"{args.prefix}_partial", index=int(index), mime_type=mime_type, raw=raw
+                )
+                print(f"👀 已保存预览[{index}]：{path}")
+                _emit_image_saved(path, mime_type, raw, partial=True)
+                partials += 1
+            elif etype.endswith("completed"):
+                saved += 1
+                path = _save_image_bytes(out_dir=args.out_dir, prefix=args.prefix, index=saved, mime_type=mime_type, raw=raw)
+                print(f"✅ 已保存图片：{path}")
+                _emit_image_saved(path, mime_type, raw)
+    except Exception as e:
+        _record_metrics(
+            args,
+            {
+                "stream": True,
+                "status": "error",
+                "latency_s": round(time.perf_counter() - started, 3),
+                "time_to_first_preview_s": None if first_preview_s is None else round(first_preview_s, 3),
+                "partial_images": partials,
+                "error": str(e)[:300],
+            },
+        )
+        raise
+
+    latency = time.perf_counter() - started
+    _record_metrics(
+        args,
+        {
+            "stream": True,
+            "status": "ok" if saved else "no_image",
+            "latency_s": round(latency, 3),
+            "time_to_first_preview_s": None if first_preview_s is None else round(first_preview_s, 3),
+            "partial_images": partials,
+            "images": saved,
+        },
+    )
+    if first_preview_s is not None:
+        print(f"⏱️ 首张预览 {first_preview_s:.2f}s，总耗时 {latency:.2f}s")
+    if saved == 0:
+        _emit_event("error", **{"class": "NoImage", "status": None, "message": "流式返回结束但未收到完整图片"})
+        print("⚠️ 流式返回结束但未收到完整图片。")
+        return 2
+    return 0
+
+
 def run_edit(args: argparse.Namespace, common_headers: Dict[str, str]) -> int:
     endpoint = _build_endpoint(args.base_url, "/images/edits")
 
-    files: List[Tuple[str, str, str, bytes]] = []
+    paths: List[Path] = []
     for path in args.image:
         p = Path(path)
         if not p.exists() or not p.is_file():
             raise SystemExit(f"找不到图片文件：{path}")
-        raw = p.read_bytes()
-        files.append(("image", p.name, _guess_mime_type(path), raw))
+        paths.append(p)
 
     fields: List[Tuple[str, str]] = [("model", args.model), ("prompt", args.prompt)]
     if args.size:
@@ -267,18 +575,50 @@ def run_edit(args: argparse.Namespace, common_headers: Dict[str, str]) -> int:
     if args.quality:
         fields.append(("quality", args.quality))
 
+    # 预检只依赖文件大小，不读取图片内容
+    paths, filenames, body_size = _preflight_edit_inputs(
+        paths,
+        fields,
+        max_bytes=args.max_request_bytes,
+        fit=args.fit_inputs,
+        fit_format=args.fit_format,
+        fit_quality=args.fit_quality,
+        cache_dir=Path(args.cache_dir) / "fit",
+    )
+
     if args.dry_run:
         dry_body = {
             "fields": dict(fields),
             "files": [
-                {"field": f[0], "filename": f[1], "mime_type": f[2], "bytes": len(f[3])}
-                for f in files
+                {
+                    "field": "image",
+                    "filename": name,
+                    "path": str(p),
+                    "mime_type": _guess_mime_type(str(p)),
+                    "bytes": p.stat().st_size,
+                }
+                for name, p in zip(filenames, paths)
             ],
+            "request_bytes": body_size,
         }
         _print_dry_run(endpoint, common_headers, dry_body)
         return 0
 
-    result = _http_post_multipart(endpoint, common_headers, fields, files, args.timeout_s)
+    # 先拿到限流槽位再预热连接，否则排队期间连接空闲，可能已被服务端关闭
+    with _rate_limited(args, urllib.parse.urlsplit(endpoint).netloc, args.model):
+        # 建连与读盘并行，多图编辑时首字节发送不再等待全部文件串行读完
+        with ThreadPoolExecutor(max_workers=min(MAX_READ_WORKERS, len(paths)) + 1) as pool:
+            prewarmed = _start_prewarm(endpoint, args.timeout_s, pool)
+            contents = list(pool.map(Path.read_bytes, paths))
+        files: List[Tuple[str, str, str, bytes]] = [
+            ("image", name, _guess_mime_type(str(p)), raw) for name, p, raw in zip(filenames, paths, contents)
+        ]
+        opener = _build_opener(prewarmed)
+        result = _timed_request(
+            args,
+            lambda: _http_post_multipart(endpoint, common_headers, fields, files, args.timeout_s, opener=opener),
+            request_bytes=body_size,
+        )
     return _handle_result(result, args)
 
 
@@ -288,16 +628,10 @@ def _handle_result(result: Dict[str, object], args: argparse.Namespace) -> int:
         b64 = item.get("b64_json")
         if isinstance(b64, str) and b64:
             raw = base64.b64decode(b64)
-            fallback = "image/png"
-            if getattr(args, "output_format", None):
-                fallback = {
-                    "png": "image/png",
-                    "jpeg": "image/jpeg",
-                    "webp": "image/webp",
-                }.get(args.output_format, "image/png")
-            mime_type = _guess_image_mime_by_bytes(raw, fallback)
+            mime_type = _guess_image_mime_by_bytes(raw, _output_mime_fallback(args))
             path = _save_image_bytes(out_dir=args.out_dir, prefix=args.prefix, index=idx, mime_type=mime_type, raw=raw)
             print(f"✅ 已保存图片：{path}")
+            _emit_image_saved(path, mime_type, raw)
             saved += 1
             continue
 
@@ -307,20 +641,97 @@ def _handle_result(result: Dict[str, object], args: argparse.Namespace) -> int:
                 raw, mime_type = _download_url(url, args.timeout_s)
                 path = _save_image_bytes(out_dir=args.out_dir, prefix=args.prefix, index=idx, mime_type=mime_type, raw=raw)
                 print(f"✅ 已下载 URL 图片：{path}")
+                _emit_image_saved(path, mime_type, raw, url=url)
                 saved += 1
             else:
                 print(f"🔗 图片 URL[{idx}]：{url}")
+                _emit_event("image_url", index=idx, url=url)
             continue
 
+    if saved == 0 and not any(isinstance(item.get("url"), str) for item in _iter_data_items(result)):
+        _emit_event("error", **{"class": "NoImage", "status": None, "message": "未发现可保存图片"})
     if saved == 0:
         print("⚠️ 未发现可保存图片，原始返回如下：")
         print(json.dumps(result, ensure_ascii=False, indent=2)[:6000])
     return 0
 
 
+def _result_image_bytes(result: Dict[str, object], *, fallback_mime: str, timeout_s: int) -> List[Tuple[str, bytes]]:
+    images: List[Tuple[str, bytes]] = []
+    for item in _iter_data_items(result):
+        b64 = item.get("b64_json")
+        url = item.get("url")
+        if isinstance(b64, str) and b64:
+            raw = base64.b64decode(b64)
+            images.append((_guess_image_mime_by_bytes(raw, fallback_mime), raw))
+        elif isinstance(url, str) and url:
+            raw, mime_type = _download_url(url, timeout_s)
+            images.append((mime_type, raw))
+    return images
+
+
+def generate_image_bytes(
+    *,
+    prompt: str,
+    api_key: str,
+    base_url: str = "https://www.dmxapi.cn",
+    model: str = "gpt-image-1.5",
+    auth_header: str = "authorization",
+    n: int = 1,
+    size: str = "",
+    quality: str = "",
+    background: str = "",
+    output_format: str = "",
+    timeout_s: int = 300,
+) -> List[Tuple[str, bytes]]:
+    """内存版文生图（供流水线等调用方导入）：返回 [(mime_type, bytes), ...]，不落盘。"""
+    payload: Dict[str, object] = {"model": model, "prompt": prompt, "n": n}
+    payload.update({k: v for k, v in (("size", size), ("quality", quality), ("background", background), ("output_format", output_format)) if v})
+    headers = {**_build_auth_headers(api_key, auth_header), "Content-Type": "application/json"}
+    result = _http_post_json(_build_endpoint(base_url, "/images/generations"), headers, payload, timeout_s)
+    return _result_image_bytes(result, fallback_mime=f"image/{output_format or 'png'}", timeout_s=timeout_s)
+
+
+def edit_image_bytes(
+    *,
+    prompt: str,
+    images: Iterable[Tuple[str, bytes]],
+    api_key: str,
+    base_url: str = "https://www.dmxapi.cn",
+    model: str = "gpt-image-1.5",
+    auth_header: str = "authorization",
+    size: str = "",
+    quality: str = "",
+    background: str = "",
+    input_fidelity: str = "",
+    output_format: str = "",
+    timeout_s: int = 300,
+) -> List[Tuple[str, bytes]]:
+    """内存版图片编辑：输入/输出图片均为 (mime_type, bytes)，直接拼进 multipart，不经过磁盘。"""
+    fields: List[Tuple[str, str]] = [("model", model), ("prompt", prompt)]
+    fields.extend(
+        (k, v)
+        for k, v in (("size", size), ("background", background), ("input_fidelity", input_fidelity), ("output_format", output_format), ("quality", quality))
+        if v
+    )
+    files = [("image", f"image_{i}.{_mime_to_ext(mime_type)}", mime_type, raw) for i, (mime_type, raw) in enumerate(images, start=1)]
+    if not files:
+        raise ValueError("edit_image_bytes 至少需要一张输入图片")
+    result = _http_post_multipart(_build_endpoint(base_url, "/images/edits"), _build_auth_headers(api_key, auth_header), fields, files, timeout_s)
+    return _result_image_bytes(result, fallback_mime=f"image/{output_format or 'png'}", timeout_s=timeout_s)
+
+
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="DMXAPI OpenAI-img 调用工具")
-    parser.add_argument("--api-key", default=os.environ.get("DMXAPI_API_KEY", ""), help="DMXAPI API Key")
+    parser.add_argument("--api-key", default=os.environ.get("DMXAPI_API_KEY", ""), help="DMXAPI API Key，多个用逗号分隔")
+    parser.add_argument("--fallback-base-url", action="append", default=[], help="备用 base URL（可重复）；主线路熔断或变慢时自动切换")
+    parser.add_argument("--fallback-model", action="append", default=[], help="备用模型（可重复），主模型所有线路都熔断时使用")
+    parser.add_argument("--breaker-failures", type=int, default=3, help="线路连续失败多少次后熔断")
+    parser.add_argument("--breaker-cooldown-s", type=float, default=60, help="熔断后的冷却秒数，之后放行一个探测请求")
+    parser.add_argument("--route-state", default="", help="线路熔断/延迟状态文件（默认 {cache_dir}/routes.json，多进程共享）")
+    parser.add_argument("--api-keys-file", default=os.environ.get("DMXAPI_API_KEYS_FILE", ""), help="API Key 池文件：每行 `KEY [rpm=N] [concurrent=N]`，与 --api-key（可逗号分隔多个）合并")
+    parser.add_argument("--key-strategy", choices=["least-loaded", "round-robin"], default="least-loaded", help="多个 Key 时的分配策略")
+    parser.add_argument("--key-bench-s", type=float, default=600, help="Key 鉴权失败（401/403）后暂停使用的秒数；429 按 Retry-After 暂停")
     parser.add_argument("--base-url", default="https://www.dmxapi.cn", help="DMXAPI 基础地址")
     parser.add_argument("--auth-header", choices=["authorization", "authorization-bearer"], default="authorization")
     parser.add_argument("--timeout-s", type=int, default=300, help="请求超时（秒）")
@@ -328,12 +739,52 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument("--prefix", default="openai_img", help="输出文件名前缀")
     parser.add_argument("--download-url", action="store_true", help="若返回 URL，则尝试下载图片")
     parser.add_argument("--dry-run", action="store_true", help="仅打印请求，不实际调用")
-
-    sub = parser.add_subparsers(dest="cmd", required=True)
+    parser.add_argument("--cache-dir", default=_default_cache_dir(), help="压缩结果等本地缓存目录")
+    parser.add_argument("--metrics-file", default="", help="追加每次请求的耗时记录（JSON Lines），为空则不记录")
+    parser.add_argument(
+        "--prom-textfile",
+        default="",
+        help="以 Prometheus 文本格式写出聚合指标（请求数、延迟直方图、流量、重试、缓存命中），供 node_exporter textfile collector 采集",
+    )
+    parser.add_argument("--prom-port", type=int, default=None, help="在 127.0.0.1:PORT/metrics 暴露聚合指标（适合 --batch - 常驻模式）")
+    parser.add_argument("--cassette", default="", help="录制/回放上游交互的目录（离线性能回归用，回放时不发真实请求）")
+    parser.add_argument("--cassette-mode", default="replay", choices=["record", "replay"], help="--cassette 的模式")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="回放加速倍数：1 按录制耗时，10 为十倍速，0 为不等待")
+    parser.add_argument(
+        "--compressed",
+        action="store_true",
+        help="请求 gzip/deflate 压缩响应（Accept-Encoding），边收边解压；base64 图片响应传输量约减少 1/4",
+    )
+    parser.add_argument(
+        "--output",
+        default="text",
+        choices=["text", "ndjson"],
+        help="ndjson：stdout 每行一个 JSON 事件（queued/sent/first_byte/image_saved/text/error/done），人读信息改走 stderr",
+    )
+    parser.add_argument("--rate-limit-rpm", type=float, default=float(os.environ.get("DMXAPI_RATE_LIMIT_RPM") or 0), help="每个 host+模型每分钟最多请求数，跨进程共享（0 表示不限）")
+    parser.add_argument("--rate-limit-burst", type=int, default=1, help="令牌桶容量（允许的瞬时突发请求数）")
+    parser.add_argument("--max-concurrent", type=int, default=int(os.environ.get("DMXAPI_MAX_CONCURRENT") or 0), help="每个 host+模型同时在途请求上限，跨进程共享（0 表示不限）")
+    parser.add_argument("--rate-limit-dir", default="", help="限流状态目录（默认 {cache_dir}/ratelimit；多个进程需指向同一目录）")
+    parser.add_argument("--batch", default="", help="批量模式：JSON Lines job 文件，每行含 cmd（generate/edit，默认 generate）及对应参数；- 表示从 stdin 常驻读取")
+    parser.add_argument("--concurrency", type=int, default=4, help="批量模式初始并发")
+    parser.add_argument("--min-concurrency", type=int, default=1, help="批量模式自适应并发下限")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="批量模式自适应并发上限")
+    parser.add_argument("--concurrency-mode", choices=["aimd", "fixed"], default="aimd", help="aimd：按 429/503 与 p90 延迟自动调整并发；fixed：固定为 --concurrency")
+    parser.add_argument("--dedupe", choices=["link", "copy", "off"], default="link", help="批量模式中同时在途的相同请求只发一次，其余 job 以硬链接（link）或副本（copy）获得输出")
+    parser.add_argument("--scheduler", choices=["sjf", "fifo"], default="sjf", help="批量模式派发顺序：sjf 按 priority 类别 + 预计耗时最短优先；fifo 按到达顺序")
+    parser.add_argument("--aging-rate", type=float, default=0.5, help="sjf 老化速率：每等待 1 秒抵扣多少秒预计耗时")
+    parser.add_argument("--max-wait-s", type=float, default=300, help="sjf 防饿死上限：排队超过该秒数的 job 最先派发")
+    parser.add_argument("--max-inflight-bytes", type=_parse_bytes, default=0, help="批量模式在途 job 预估内存峰值之和的上限，如 2G、512M（0 表示不限）")
+    parser.add_argument("--grid", action="append", default=[], help="扫参模式：KEY=V1,V2（可重复，KEY=@file 每行一个取值），展开笛卡尔积并发执行")
+    parser.add_argument("--sweep-report", default="", help="扫参结果表路径（.md 或 .csv，默认 {out_dir}/sweep_<时间>.md）")
+    parser.add_argument("--journal", default="", help="批量模式的 job 状态日志（JSON Lines，只追加）；中断后用同一文件重跑会跳过已完成的 job")
+    parser.add_argument("--batch-retries", type=int, default=2, help="批量模式中被 429/503 限流的 job 重新排队的次数上限")
+
+    sub = parser.add_subparsers(dest="cmd")
 
     g = sub.add_parser("generate", help="文生图")
     g.add_argument("--model", default="gpt-image-1.5")
-    g.add_argument("--prompt", required=True)
+    g.add_argument("--prompt", default="", help="提示词（必填；扫参时也可由 --grid prompt=... 提供）")
     g.add_argument("--n", type=int, default=1)
     g.add_argument("--size", default="")
     g.add_argument("--background", choices=["auto", "transparent", "opaque"], default="")
@@ -343,29 +794,44 @@ def build_parser() -> argparse.ArgumentParser:
     g.add_argument("--quality", choices=["auto", "high", "medium", "low", "hd", "standard"], default="")
     g.add_argument("--response-format", choices=["b64_json", "url"], default="")
     g.add_argument("--style", choices=["vivid", "natural"], default="")
+    g.add_argument("--stream", action="store_true", help="以 SSE 流式返回，边生成边保存预览图")
+    g.add_argument("--partial-images", type=int, choices=[0, 1, 2, 3], default=None, help="流式返回的预览图数量（隐含 --stream）")
 
     e = sub.add_parser("edit", help="图片编辑")
     e.add_argument("--model", default="gpt-image-1.5")
-    e.add_argument("--prompt", required=True)
-    e.add_argument("--image", action="append", required=True, help="输入图片路径，可重复传参")
+    e.add_argument("--prompt", default="", help="提示词（必填；扫参时也可由 --grid prompt=... 提供）")
+    e.add_argument("--image", action="append", default=[], help="输入图片路径，可重复传参（至少一张）")
     e.add_argument("--size", default="")
     e.add_argument("--background", choices=["auto", "transparent", "opaque"], default="")
     e.add_argument("--input-fidelity", choices=["high", "low"], default="")
     e.add_argument("--output-format", choices=["png", "jpeg", "webp"], default="")
     e.add_argument("--output-compression", type=int, default=None)
     e.add_argument("--quality", choices=["auto", "high", "medium", "low", "hd", "standard"], default="")
+    e.add_argument(
+        "--max-request-bytes",
+        type=int,
+        default=DEFAULT_MAX_REQUEST_BYTES,
+        help="multipart 请求体字节上限，发送前校验（默认 50MB，0 表示不限制）",
+    )
+    e.add_argument("--fit-inputs", action="store_true", help="超出上限时用 Pillow 重新编码/缩放输入图片（需安装 Pillow）")
+    e.add_argument("--fit-format", choices=["jpeg", "webp"], default="jpeg", help="--fit-inputs 的目标格式（带透明通道的图自动用 webp）")
+    e.add_argument("--fit-quality", type=int, default=90, help="--fit-inputs 的编码质量")
 
     return parser
 
 
-def main(argv: Optional[List[str]] = None) -> int:
-    parser = build_parser()
-    args = parser.parse_args(argv)
-
+def run_job(args: argparse.Namespace) -> int:
+    """执行单个 generate/edit 子命令（命令行单次模式与批量模式共用）。"""
+    if not args.prompt:
+        raise SystemExit("缺少 --prompt")
+    if args.cmd == "edit" and not args.image:
+        raise SystemExit("edit 至少需要一张 --image")
     if not args.api_key and not args.dry_run:
         raise SystemExit("缺少 API Key：请传 --api-key 或设置环境变量 DMXAPI_API_KEY")
 
     headers = _build_auth_headers(args.api_key, args.auth_header) if args.api_key else {}
+    if args.compressed:
+        headers["Accept-Encoding"] = "gzip, deflate"
 
     if args.cmd == "generate":
         return run_generate(args, headers)
@@ -375,5 +841,106 @@ def main(argv: Optional[List[str]] = None) -> int:
     raise SystemExit(f"unsupported cmd: {args.cmd}")
 
 
+def _request_fingerprint(args: argparse.Namespace) -> Optional[str]:
+    """规范化后的请求哈希：输入图片按内容 sha256 计，与路径无关；dry-run 不参与合并。"""
+    if args.dry_run:
+        return None
+    fields = {k: v for k, v in vars(args).items() if k not in _SHARED_NON_REQUEST_KEYS and not callable(v)}
+    fields["prompt"] = args.prompt.strip()
+    if args.cmd == "edit":
+        fields["image"] = [_file_sha256(Path(p)) if os.path.isfile(p) else p for p in args.image]
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+# 调度用的先验耗时（秒）：无历史数据时按像素数 × 质量 × 张数估算，每张输入图另加固定开销
+_PRIOR_BASE_S = 20.0
+_PRIOR_QUALITY_FACTOR = {"low": 0.5, "medium": 1.0, "standard": 1.0, "auto": 1.2, "high": 2.0, "hd": 2.0}
+
+
+def _estimate_job_cost(args: argparse.Namespace) -> Tuple[str, float]:
+    """返回 (成本类别键, 先验耗时)；同类别有历史耗时时调度器改用历史 EWMA。"""
+    size = args.size or "auto"
+    try:
+        w, h = (int(x) for x in size.lower().split("x"))
+        pixels = w * h / (1024 * 1024)
+    except ValueError:
+        pixels = 1.5
+    quality = args.quality or "auto"
+    n = getattr(args, "n", 1) or 1
+    inputs = len(getattr(args, "image", None) or [])
+    prior = _PRIOR_BASE_S * pixels * _PRIOR_QUALITY_FACTOR.get(quality, 1.0) * n + 1.0 * inputs
+    return f"{args.cmd}|{args.model}|{size}|{quality}|{n}|{min(inputs, 6)}", prior
+
+
+def _estimate_job_memory(args: argparse.Namespace) -> int:
+    """粗估 job 的内存峰值：multipart 读入的原图 + 请求体（约 2 倍输入），每张输出图的响应 JSON + base64 + 解码结果（约 4 倍输出）。"""
+    inputs = sum(os.path.getsize(p) for p in (getattr(args, "image", None) or []) if os.path.isfile(p))
+    try:
+        w, h = (int(x) for x in (args.size or "").lower().split("x"))
+    except ValueError:
+        w, h = 1536, 1536
+    # 按每像素 3 字节估算单张输出（PNG 的保守上限）；流式预览图逐张落盘，额外算一张
+    output = w * h * 3 * ((getattr(args, "n", 1) or 1) + (1 if getattr(args, "partial_images", None) else 0))
+    return inputs * 2 + output * 4
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = parser.parse_args(argv)
+    if args.output == "ndjson":
+        _start_event_stream()
+    _start_metrics_export(args, api="openai")
+    _install_cassette(args)
+    pool = _KeyPool(_load_api_keys(args), strategy=args.key_strategy, auth_bench_s=args.key_bench_s)
+    if args.batch and args.grid:
+        parser.error("--batch 与 --grid 不能同时使用")
+    if not args.batch:
+        if not args.cmd:
+            parser.error("the following arguments are required: cmd")
+        if not args.grid:
+            return _run_single(
+                args,
+                lambda a: _run_with_routes(a, lambda b: _run_with_key_pool(pool, b, run_job)),
+                estimate_cost=_estimate_job_cost,
+            )
+    elif args.cmd:
+        parser.error("批量模式下子命令写在每行 job 的 cmd 字段中")
+
+    # 不带子命令解析一次，得到全局参数的全集
+    global_keys = set(vars(parser.parse_args([])))
+
+    def build_job_args(job_id: str, job: Dict[str, Any]) -> argparse.Namespace:
+        # 命令行全局参数作为所有 job 的默认值；job 中的全局键放在子命令之前，其余键交给子命令解析
+        global_part = {k: v for k, v in job.items() if k in global_keys}
+        sub_part = {k: v for k, v in job.items() if k not in global_keys}
+        cmd = str(job.get("cmd") or "generate")
+        if args.grid:
+            # 扫参：子命令及其参数已在命令行中，网格取值追加在后面覆盖之
+            job_args = parser.parse_args(argv + _job_to_argv(sub_part))
+        else:
+            job_args = parser.parse_args(argv + _job_to_argv(global_part) + [cmd] + _job_to_argv(sub_part))
+        job_args.batch = ""
+        job_args.grid = []
+        if "prefix" not in job:
+            # 并发 job 同一秒落盘时避免文件名相互覆盖
+            job_args.prefix = f"{job_args.prefix}_{job_id}"
+        return job_args
+
+    batch_kwargs: Dict[str, Any] = dict(
+        build_job_args=build_job_args,
+        request_fingerprint=_request_fingerprint,
+        estimate_cost=_estimate_job_cost,
+        estimate_memory=_estimate_job_memory,
+        run_job=lambda job_args: _run_with_routes(job_args, lambda a: _run_with_key_pool(pool, a, run_job)),
+    )
+    if args.grid:
+        misplaced = sorted(k for k in _parse_grid(args.grid) if k in global_keys)
+        if misplaced:
+            parser.error(f"--grid 只能扫子命令参数（如 size/quality/model/prompt），全局参数请直接在命令行指定：{', '.join(misplaced)}")
+        return _run_sweep(args, **batch_kwargs)
+    return _run_batch(args, jobs=_iter_batch_jobs(args.batch), **batch_kwargs)
+
+
 if __name__ == "__main__":
     sys.exit(main())